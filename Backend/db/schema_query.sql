@@ -461,7 +461,7 @@ CREATE TABLE IF NOT EXISTS invoices (
   KEY idx_invoice_issue_date (issue_date),
   KEY idx_invoice_status (status),
   KEY idx_invoice_paid_date (paid_date),
-  KEY idx_invoice_appt (appointment_id),
+  UNIQUE KEY uq_invoice_appt (appointment_id),
   CONSTRAINT fk_invoice_patient
     FOREIGN KEY (patient_id) REFERENCES users(id)
     ON DELETE RESTRICT,
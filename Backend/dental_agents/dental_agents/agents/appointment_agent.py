@@ -5,7 +5,7 @@ from datetime import datetime, timedelta, timezone, time as dtime, date as ddate
 from typing import Any, Dict, Optional, List, Tuple
 import json
 
-from ..db import get_conn
+from ..db import _column_exists, _get_column_type, _parse_enum_vals, _table_exists, get_conn
 from ..notifications import create_notification
 
 
@@ -172,53 +172,9 @@ def _combine_date_time(d: Any, t: Any) -> Optional[datetime]:
     return None
 
 
-def _table_exists(cur, name: str) -> bool:
-    cur.execute(
-        """
-        SELECT 1 FROM INFORMATION_SCHEMA.TABLES
-        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s
-        LIMIT 1
-        """,
-        (name,),
-    )
-    return cur.fetchone() is not None
-
-
-def _column_exists(cur, table: str, col: str) -> bool:
-    cur.execute(
-        """
-        SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
-        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME=%s
-        LIMIT 1
-        """,
-        (table, col),
-    )
-    return cur.fetchone() is not None
-
-
 def _get_status_enum_values(cur) -> List[str]:
     try:
-        cur.execute(
-            """
-            SELECT COLUMN_TYPE
-            FROM INFORMATION_SCHEMA.COLUMNS
-            WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='appointments' AND COLUMN_NAME='status'
-            LIMIT 1
-            """
-        )
-        row = cur.fetchone()
-        if not row:
-            return []
-        coltype = row["COLUMN_TYPE"] if isinstance(row, dict) else row[0]
-        if not coltype or "enum(" not in coltype.lower():
-            return []
-        inside = coltype[coltype.find("(") + 1 : coltype.rfind(")")]
-        vals = []
-        for part in inside.split(","):
-            p = part.strip().strip("'").strip('"')
-            if p:
-                vals.append(p)
-        return vals
+        return _parse_enum_vals(_get_column_type(cur, "appointments", "status"))
     except Exception:
         return []
 
@@ -249,23 +205,8 @@ def _predict_duration_minutes(conn, procedure_type: str) -> int:
                 return int(DEFAULT_DURATIONS_MIN.get(proc, 30))
 
             col = "procedure_code"
-            try:
-                cur.execute(
-                    """
-                    SELECT COLUMN_NAME
-                    FROM INFORMATION_SCHEMA.COLUMNS
-                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME='visit_procedures'
-                          AND COLUMN_NAME IN ('procedure_code','procedure_type')
-                    LIMIT 1
-                    """
-                )
-                c = cur.fetchone()
-                if c:
-                    cname = c["COLUMN_NAME"] if isinstance(c, dict) else c[0]
-                    if cname:
-                        col = cname
-            except Exception:
-                pass
+            if not _column_exists(cur, "visit_procedures", col) and _column_exists(cur, "visit_procedures", "procedure_type"):
+                col = "procedure_type"
 
             cur.execute(
                 f"""
@@ -9,7 +9,8 @@ import re
 import hashlib
 import traceback
 
-from ..db import get_conn
+from ..db import get_conn, enqueue_event_in_tx, execute_prepared
+from ..events import CASE_GENERATE_SUMMARY
 from ..notifications import create_notification
 
 
@@ -39,6 +40,23 @@ def _today() -> date:
     return _now().date()
 
 
+def _as_date(x: Any) -> Optional[date]:
+    """
+    Coerce a DB value to a date: datetime -> .date(), date passthrough,
+    'YYYY-MM-DD...' strings parsed; anything else -> None.
+    """
+    if isinstance(x, datetime):
+        return x.date()
+    if isinstance(x, date):
+        return x
+    if isinstance(x, str) and len(x) >= 10:
+        try:
+            return date.fromisoformat(x[:10])
+        except ValueError:
+            return None
+    return None
+
+
 # -----------------------------
 # DB helpers (schema-adaptive)
 # -----------------------------
@@ -94,6 +112,24 @@ def _digits_only(s: str) -> str:
     return re.sub(r"\D+", "", s or "")
 
 
+_CASE_ID_KEYS = ("caseId", "caseDbId", "caseDbID")
+
+
+def _coerce_case_id(payload: Dict[str, Any]) -> int:
+    """
+    First usable case id from the payload (Node emits caseId and/or caseDbId).
+    Non-numeric values (e.g. display codes) fall through to the next key.
+    """
+    for k in _CASE_ID_KEYS:
+        v = payload.get(k)
+        if v:
+            try:
+                return int(v)
+            except Exception:
+                continue
+    return 0
+
+
 def _set_session_tz(cur) -> None:
     try:
         cur.execute("SET time_zone = '+05:30'")
@@ -115,6 +151,7 @@ def _notify_one(
     related_table: Optional[str] = None,
     related_id: Optional[int] = None,
     meta: Optional[dict] = None,
+    meta_encoded: Optional[str] = None,
 ) -> None:
     """
     Wrap create_notification safely (your notifications.py may accept different kwargs).
@@ -133,12 +170,14 @@ def _notify_one(
         kwargs["user_role"] = user_role
     if meta is not None:
         kwargs["meta"] = meta
+    if meta_encoded is not None:
+        kwargs["meta_encoded"] = meta_encoded
 
     try:
         create_notification(**kwargs)
     except TypeError:
         # Back-compat: remove unsupported fields
-        for k in ["channel", "user_role", "meta"]:
+        for k in ["channel", "user_role", "meta", "meta_encoded"]:
             if k in kwargs:
                 kwargs.pop(k, None)
         try:
@@ -201,10 +240,13 @@ def _notify_multi(
     related_id: Optional[int],
     priority_hint: str = "NORMAL",
     meta: Optional[dict] = None,
+    meta_encoded: Optional[str] = None,
 ) -> None:
     """
     Send IN_APP always, and also the user's preferred channels when "urgent-ish".
     You can tune routing later; this keeps the workflow promise without breaking.
+    meta_encoded (already-encoded JSON, e.g. shared with the timeline row) is stored as-is
+    on every channel's row instead of encoding meta per row.
     """
     if not user_id and not user_role:
         return
@@ -231,19 +273,31 @@ def _notify_multi(
             related_table=related_table,
             related_id=related_id,
             meta=meta or {},
+            meta_encoded=meta_encoded,
         )
 
 
 # -----------------------------
 # Timeline + attachments
 # -----------------------------
-def _insert_timeline(conn, *, case_id: int, event_type: str, title: str, body: str, meta: dict) -> None:
+def _insert_timeline(
+    conn,
+    *,
+    case_id: int,
+    event_type: str,
+    title: str,
+    body: str,
+    meta: Optional[dict] = None,
+    meta_json: Optional[str] = None,
+) -> int:
     """
     case_timeline schema (as per your project direction): event_type, title, body, meta_json, created_at
+    Pass meta_json (already encoded) when the same meta is shared with notifications.
+    Returns the new row id (0 if nothing was written).
     """
     with _cursor(conn) as cur:
         if not _table_exists(cur, "case_timeline"):
-            return
+            return 0
         cols = {
             "case_id": _column_exists(cur, "case_timeline", "case_id"),
             "event_type": _column_exists(cur, "case_timeline", "event_type"),
@@ -270,17 +324,17 @@ def _insert_timeline(conn, *, case_id: int, event_type: str, title: str, body: s
             vals.append((body or "")[:8000])
         if cols["meta_json"]:
             fields.append("meta_json")
-            vals.append(json.dumps(meta or {}, ensure_ascii=False))
+            vals.append(meta_json if meta_json is not None else json.dumps(meta or {}, ensure_ascii=False, default=str))
         if cols["created_at"]:
             fields.append("created_at")
             vals.append(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
 
         if not fields:
-            return
+            return 0
 
         placeholders = ",".join(["%s"] * len(fields))
         sql = f"INSERT INTO case_timeline ({','.join(fields)}) VALUES ({placeholders})"
-        cur.execute(sql, tuple(vals))
+    return execute_prepared(conn, sql, tuple(vals))
 
 
 def _ensure_dir(p: str) -> None:
@@ -569,7 +623,19 @@ def _resolve_patient_id(conn, payload: Dict[str, Any]) -> Optional[int]:
     return None
 
 
-def _get_recent_cases_for_patient(conn, patient_id: int, limit: int = 5) -> List[dict]:
+def _get_recent_cases_for_patient(
+    conn,
+    patient_id: int,
+    limit: int = 5,
+    *,
+    exclude_case_id: Optional[int] = None,
+    case_ids: Optional[List[int]] = None,
+) -> List[dict]:
+    """
+    Fetch candidate cases for a patient in a single round-trip (whole rows, no id-then-select).
+    - exclude_case_id: skip the case the event is about
+    - case_ids: optional caller hint; restricts candidates to those ids
+    """
     with _cursor(conn) as cur:
         if not _table_exists(cur, "cases"):
             return []
@@ -578,16 +644,29 @@ def _get_recent_cases_for_patient(conn, patient_id: int, limit: int = 5) -> List
             "updated_at": _column_exists(cur, "cases", "updated_at"),
         }
         order_col = "updated_at" if cols["updated_at"] else ("created_at" if cols["created_at"] else "id")
+        select_cols = "id, stage, diagnosis, next_review_date, notes"
+        if cols["created_at"]:
+            select_cols += ", created_at"
+
+        where = "patient_id=%s"
+        params: List[Any] = [patient_id]
+        if exclude_case_id:
+            where += " AND id <> %s"
+            params.append(int(exclude_case_id))
+        if case_ids:
+            where += " AND id IN (" + ",".join(["%s"] * len(case_ids)) + ")"
+            params.extend(case_ids)
+        params.append(int(limit))
         try:
             cur.execute(
                 f"""
-                SELECT id, stage, diagnosis, next_review_date, notes
+                SELECT {select_cols}
                 FROM cases
-                WHERE patient_id=%s
+                WHERE {where}
                 ORDER BY {order_col} DESC
                 LIMIT %s
                 """,
-                (patient_id, int(limit)),
+                tuple(params),
             )
             return cur.fetchall() or []
         except Exception:
@@ -636,73 +715,6 @@ def _store_pending_field(conn, case_id: int, field: str, value: Any) -> None:
 # -----------------------------
 # Summaries & doc drafts
 # -----------------------------
-def _draft_summary(case_row: dict) -> dict:
-    from ..ai import ai_json
-
-    diagnosis = case_row.get("diagnosis") or case_row.get("diagnosis_text") or "Not specified"
-    stage = case_row.get("stage") or "ACTIVE"
-    notes = case_row.get("notes") or ""
-
-    system_prompt = (
-        "You are an expert dental case manager AI. "
-        "Summarize the patient case status in 4-5 concise lines. "
-        "Then provide 3 simple, actionable suggestions for the doctor. "
-        "Keep the tone professional but simple."
-    )
-    user_prompt = (
-        f"Case Data:\nDiagnosis: {diagnosis}\nStage: {stage}\nNotes: {notes}\n"
-        "Generate a JSON response with keys: 'summary', 'recommendation', 'patient_explanation', 'confidence'."
-    )
-    
-    schema_hint = (
-        "{"
-        "  'summary': '4-5 lines text',"
-        "  'recommendation': 'Bullet points or clear steps',"
-        "  'patient_explanation': 'Simple language for patient',"
-        "  'confidence': 85"
-        "}"
-    )
-
-    try:
-        data = ai_json(system_prompt, user_prompt, schema_hint)
-        if data and data.get("summary"):
-            return {
-                "summary": data.get("summary"),
-                "recommendation": data.get("recommendation"),
-                "patient_explanation": data.get("patient_explanation"),
-                "signals": {
-                    "has_notes": bool(notes),
-                    "has_diagnosis": bool(case_row.get("diagnosis") or case_row.get("diagnosis_text")),
-                },
-                "confidence": data.get("confidence", 70),
-            }
-    except Exception:
-        pass
-
-    # Fallback if AI fails
-    plan = [
-        "Review diagnosis and confirm treatment plan.",
-        "Verify required procedures and estimated duration.",
-        "Ensure follow-up date is set and reminders are enabled.",
-    ]
-    patient_explain = (
-        f"Your case is currently in '{stage}'. "
-        f"Diagnosis noted: {diagnosis}. "
-        f"Next steps will be confirmed by your doctor."
-    )
-
-    return {
-        "summary": f"Draft case summary (pending doctor approval). Diagnosis: {diagnosis}. Stage: {stage}.",
-        "recommendation": " | ".join(plan),
-        "patient_explanation": patient_explain,
-        "signals": {
-            "has_notes": bool(notes),
-            "has_diagnosis": bool(diagnosis and diagnosis != "Not specified"),
-        },
-        "confidence": 55,
-    }
-
-
 def _insert_case_summary(conn, case_id: int, summary: str, recommendation: str, confidence: int, meta: dict) -> None:
     with _cursor(conn) as cur:
         if not _table_exists(cur, "case_summaries"):
@@ -752,10 +764,10 @@ def _insert_case_summary(conn, case_id: int, summary: str, recommendation: str,
 
         placeholders = ",".join(["%s"] * len(fields))
         sql = f"INSERT INTO case_summaries ({','.join(fields)}) VALUES ({placeholders})"
-        try:
-            cur.execute(sql, tuple(vals))
-        except Exception:
-            return
+    try:
+        execute_prepared(conn, sql, tuple(vals))
+    except Exception:
+        return
 
 
 def _get_latest_case_summary(conn, case_id: int) -> Optional[dict]:
@@ -816,9 +828,7 @@ def _draft_docs_if_needed(conn, case_id: int, case_row: dict) -> None:
     """
     stage = str(case_row.get("stage") or "").upper()
     diagnosis = str(case_row.get("diagnosis") or case_row.get("diagnosis_text") or "Not specified")
-    nrd = case_row.get("next_review_date")
-    if isinstance(nrd, datetime):
-        nrd = nrd.date()
+    nrd = _as_date(case_row.get("next_review_date"))
 
     base_dir = os.getenv("EXPORT_DIR") or os.getenv("REPORTS_DIR") or os.path.join(os.getcwd(), "exports")
     case_dir = os.path.join(base_dir, "cases", f"case_{case_id}")
@@ -932,7 +942,7 @@ def _fetch_case(conn, case_id: int) -> Optional[dict]:
 
 
 def _on_case_updated_conn(conn, payload: Dict[str, Any]) -> None:
-    case_id = int(payload.get("caseDbId") or payload.get("caseId") or 0)
+    case_id = _coerce_case_id(payload)
     if not case_id:
         return
 
@@ -956,7 +966,7 @@ def _on_case_updated_conn(conn, payload: Dict[str, Any]) -> None:
     changed = bool(last_hash and last_hash != current_hash)
 
     # store snapshot (no schema change required)
-    _insert_timeline(
+    snapshot_id = _insert_timeline(
         conn,
         case_id=case_id,
         event_type="CASE_SNAPSHOT",
@@ -965,69 +975,61 @@ def _on_case_updated_conn(conn, payload: Dict[str, Any]) -> None:
         meta={"snapshot_hash": current_hash},
     )
 
-    # Draft summary (approval-gated)
-    draft = _draft_summary(case_row)
-    _insert_case_summary(
-        conn,
-        case_id,
-        summary=draft.get("summary") or "",
-        recommendation=draft.get("recommendation") or "",
-        confidence=int(draft.get("confidence") or 0),
-        meta={"patient_explanation": draft.get("patient_explanation"), "signals": draft.get("signals")},
-    )
-    _mirror_summary_to_case(conn, case_id, draft.get("summary") or "", draft.get("recommendation") or "")
+    # Summary/insights only when something material changed (or this is the first snapshot);
+    # cosmetic saves stop here apart from follow-up/doc checks below.
+    needs_summary = changed or not last_hash
 
-    # Insights
-    nrd = case_row.get("next_review_date")
-    if isinstance(nrd, datetime):
-        nrd = nrd.date()
-    st = str(case_row.get("stage") or "ACTIVE")
-    risk = _risk_score(st, nrd if isinstance(nrd, date) else None)
+    nrd = _as_date(case_row.get("next_review_date"))
 
-    # Missed follow-ups: count timeline followup due alerts (simple heuristic)
-    missed_followups = 0
-    try:
-        with _cursor(conn) as cur:
-            if _table_exists(cur, "case_timeline") and _column_exists(cur, "case_timeline", "event_type"):
-                cur.execute(
-                    """
-                    SELECT COUNT(1) AS c
-                    FROM case_timeline
-                    WHERE case_id=%s AND event_type='FOLLOWUP_DUE'
-                    """,
-                    (case_id,),
-                )
-                row = cur.fetchone() or {}
-                missed_followups = int(row.get("c") or 0)
-    except Exception:
+    if needs_summary:
+        st = str(case_row.get("stage") or "ACTIVE")
+        risk = _risk_score(st, nrd)
+
+        # Missed follow-ups: count timeline followup due alerts (simple heuristic)
         missed_followups = 0
+        try:
+            with _cursor(conn) as cur:
+                if _table_exists(cur, "case_timeline") and _column_exists(cur, "case_timeline", "event_type"):
+                    cur.execute(
+                        """
+                        SELECT COUNT(1) AS c
+                        FROM case_timeline
+                        WHERE case_id=%s AND event_type='FOLLOWUP_DUE'
+                        """,
+                        (case_id,),
+                    )
+                    row = cur.fetchone() or {}
+                    missed_followups = int(row.get("c") or 0)
+        except Exception:
+            missed_followups = 0
 
-    compliance = _compute_compliance_score(nrd if isinstance(nrd, date) else None, missed_followups)
-
-    insights = {
-        "risk_score": risk,
-        "compliance_score": compliance,
-        "on_track": True if not (isinstance(nrd, date) and nrd < _today()) else False,
-        "expected_next_steps": [
-            "Doctor review/approval pending for generated draft summary.",
-            "Confirm next review date and ensure reminders are enabled.",
-        ],
-        "generated_at": _now().isoformat(),
-    }
-    _update_case_insights(conn, case_id, insights)
+        compliance = _compute_compliance_score(nrd, missed_followups)
+
+        insights = {
+            "risk_score": risk,
+            "compliance_score": compliance,
+            "on_track": not (nrd and nrd < _today()),
+            "expected_next_steps": [
+                "Doctor review/approval pending for generated draft summary.",
+                "Confirm next review date and ensure reminders are enabled.",
+            ],
+            "generated_at": _now().isoformat(),
+        }
+        _update_case_insights(conn, case_id, insights)
 
     # If notes/condition changed, alert doctor (health change detection)
     doctor_id = int(case_row.get("doctor_id") or 0) if case_row else 0
     patient_id = int(case_row.get("patient_id") or 0) if case_row else 0
 
     if changed and doctor_id:
+        change_json = json.dumps({"prev_hash": last_hash, "new_hash": current_hash}, ensure_ascii=False)
         _insert_timeline(
             conn,
             case_id=case_id,
             event_type="CHANGE_DETECTED",
             title="Health/notes change detected",
             body="The case details changed compared to the previous snapshot.",
-            meta={"prev_hash": last_hash, "new_hash": current_hash},
+            meta_json=change_json,
         )
         _notify_multi(
             conn=conn,
@@ -1039,33 +1041,20 @@ def _on_case_updated_conn(conn, payload: Dict[str, Any]) -> None:
             related_table="cases",
             related_id=case_id,
             priority_hint="HIGH",
-            meta={"prev_hash": last_hash, "new_hash": current_hash},
-        )
-
-    # Doctor review needed (always)
-    if doctor_id:
-        _notify_multi(
-            conn=conn,
-            user_id=doctor_id,
-            user_role=None,
-            title="Case Review Needed",
-            message=f"A draft summary was generated for Case #{case_id}. Please review and approve.",
-            notif_type="CASE_REVIEW",
-            related_table="cases",
-            related_id=case_id,
-            priority_hint="NORMAL",
-            meta={"case_id": case_id},
+            meta_encoded=change_json,
         )
 
     # Follow-up due (doctor + patient)
-    if isinstance(nrd, date) and nrd <= _today() and doctor_id:
+    if nrd and nrd <= _today() and doctor_id:
+        # one meta shared by the timeline row and both notifications
+        nrd_json = json.dumps({"next_review_date": str(nrd)}, ensure_ascii=False)
         _insert_timeline(
             conn,
             case_id=case_id,
             event_type="FOLLOWUP_DUE",
             title="Follow-up due",
             body=f"Follow-up due (next review date: {nrd})",
-            meta={"next_review_date": str(nrd)},
+            meta_json=nrd_json,
         )
         _notify_multi(
             conn=conn,
@@ -1077,7 +1066,7 @@ def _on_case_updated_conn(conn, payload: Dict[str, Any]) -> None:
             related_table="cases",
             related_id=case_id,
             priority_hint="HIGH",
-            meta={"next_review_date": str(nrd)},
+            meta_encoded=nrd_json,
         )
         if patient_id:
             _notify_multi(
@@ -1090,12 +1079,25 @@ def _on_case_updated_conn(conn, payload: Dict[str, Any]) -> None:
                 related_table="cases",
                 related_id=case_id,
                 priority_hint="NORMAL",
-                meta={"next_review_date": str(nrd)},
+                meta_encoded=nrd_json,
             )
 
     # Draft documents (consent/post-op) when applicable
     _draft_docs_if_needed(conn, case_id, case_row)
 
+    # Defer summary drafting to its own event (the summary handler notifies the doctor).
+    # The event joins this handler's transaction, so the snapshot hash and the queued
+    # summary commit (or roll back and retry) together. The dedupe key is per snapshot row:
+    # a hash-based key would block a case that returns to an earlier snapshot (A -> B -> A).
+    if needs_summary:
+        enqueue_event_in_tx(
+            conn,
+            CASE_GENERATE_SUMMARY,
+            {"caseId": case_id, "source": "CaseUpdated"},
+            priority=40,
+            dedupe_key=f"case_summary:{case_id}:{snapshot_id}" if snapshot_id else None,
+        )
+
 
 def _on_appointment_completed_conn(conn, payload: Dict[str, Any]) -> None:
     appt_id = int(payload.get("appointmentId") or 0)
@@ -1140,7 +1142,7 @@ def _on_case_generate_summary_conn(conn, payload: Dict[str, Any]) -> None:
     Payload:
       { "caseId": int, "visitIds": [int]?, "requestedBy": int? }
     """
-    case_id = int(payload.get("caseId") or payload.get("caseDbId") or 0)
+    case_id = _coerce_case_id(payload)
     if not case_id:
         return
 
@@ -1165,55 +1167,73 @@ def _on_case_generate_summary_conn(conn, payload: Dict[str, Any]) -> None:
     doctor_id = int(case_row.get("doctor_id") or 0)
     patient_id = int(case_row.get("patient_id") or 0)
 
-    rows: List[dict] = []
+    notes_sections: List[str] = []
+    procedures: List[str] = []
+    seen_visit_ids: List[int] = []
+    n_vis = 0
+
+    # Stream visit rows (unbuffered) and fold them as they arrive instead of buffering the whole case.
     with _cursor(conn) as cur:
         _set_session_tz(cur)
-        if not _table_exists(cur, "visits"):
-            rows = []
-        else:
-            params: List[Any] = [case_id]
-            extra = ""
-            if visit_ids:
-                extra = " AND v.id IN (" + ",".join(["%s"] * len(visit_ids)) + ")"
-                params.extend(visit_ids)
+        has_visits = _table_exists(cur, "visits")
+
+    if has_visits:
+        params: List[Any] = [case_id]
+        extra = ""
+        if visit_ids:
+            extra = " AND v.id IN (" + ",".join(["%s"] * len(visit_ids)) + ")"
+            params.extend(visit_ids)
+        try:
+            stream = conn.cursor(dictionary=True, buffered=False)
+        except TypeError:
+            stream = conn.cursor()
+        try:
+            stream.execute(
+                """
+                SELECT v.id, v.started_at, v.ended_at, v.chief_complaint, v.clinical_notes,
+                       v.diagnosis_text, v.procedures_json
+                FROM visits v
+                WHERE v.linked_case_id=%s
+                """
+                + extra
+                + " ORDER BY v.started_at ASC",
+                tuple(params),
+            )
+            for r in stream:
+                n_vis += 1
+                if r.get("id"):
+                    seen_visit_ids.append(r.get("id"))
+
+                parts: List[str] = []
+                if r.get("chief_complaint"):
+                    parts.append(f"Complaint: {r.get('chief_complaint')}")
+                if r.get("diagnosis_text"):
+                    parts.append(f"Diagnosis: {r.get('diagnosis_text')}")
+                if r.get("clinical_notes"):
+                    parts.append(str(r.get("clinical_notes")))
+                if parts:
+                    notes_sections.append(" | ".join(parts))
+
+                arr = _safe_json_loads(r.get("procedures_json"))
+                if isinstance(arr, list):
+                    for it in arr:
+                        if isinstance(it, dict):
+                            code = it.get("code") or it.get("procedure_code") or it.get("procedure_type")
+                            if code:
+                                procedures.append(str(code))
+        except Exception:
+            # drain so the connection is not left with an unread result set
             try:
-                cur.execute(
-                    """
-                    SELECT v.id, v.started_at, v.ended_at, v.chief_complaint, v.clinical_notes,
-                           v.diagnosis_text, v.procedures_json
-                    FROM visits v
-                    WHERE v.linked_case_id=%s
-                    """
-                    + extra
-                    + " ORDER BY v.started_at ASC",
-                    tuple(params),
-                )
-                rows = cur.fetchall() or []
+                stream.fetchall()
             except Exception:
-                rows = []
-
-    notes_sections: List[str] = []
-    procedures: List[str] = []
-
-    for r in rows:
-        parts: List[str] = []
-        if r.get("chief_complaint"):
-            parts.append(f"Complaint: {r.get('chief_complaint')}")
-        if r.get("diagnosis_text"):
-            parts.append(f"Diagnosis: {r.get('diagnosis_text')}")
-        if r.get("clinical_notes"):
-            parts.append(str(r.get("clinical_notes")))
-        if parts:
-            notes_sections.append(" | ".join(parts))
-
-        pj = r.get("procedures_json")
-        arr = _safe_json_loads(pj)
-        if isinstance(arr, list):
-            for it in arr:
-                if isinstance(it, dict):
-                    code = it.get("code") or it.get("procedure_code") or it.get("procedure_type")
-                    if code:
-                        procedures.append(str(code))
+                pass
+            # a partial fold would publish a summary from a truncated visit list; treat as no rows
+            notes_sections, procedures, seen_visit_ids, n_vis = [], [], [], 0
+        finally:
+            try:
+                stream.close()
+            except Exception:
+                pass
 
     if not notes_sections:
         # Fallback: use case metadata to avoid empty summaries
@@ -1252,7 +1272,7 @@ def _on_case_generate_summary_conn(conn, payload: Dict[str, Any]) -> None:
         clinical_summary += f" Next review: {next_review_date}."
 
     # Alternative operational summary (kept inside recommendation to diversify outputs)
-    ops_lines = [f"Case stage is {stage_label} with {len(rows)} documented visit(s)."]
+    ops_lines = [f"Case stage is {stage_label} with {n_vis} documented visit(s)."]
     if case_type:
         ops_lines.append(f"Case type: {case_type}.")
     if latest_note:
@@ -1311,7 +1331,6 @@ def _on_case_generate_summary_conn(conn, payload: Dict[str, Any]) -> None:
         return
 
     conf = 50
-    n_vis = len(rows)
     if n_vis >= 3:
         conf = 85
     elif n_vis == 2:
@@ -1320,7 +1339,7 @@ def _on_case_generate_summary_conn(conn, payload: Dict[str, Any]) -> None:
         conf = 60
 
     meta = {
-        "visit_ids": visit_ids or [r.get("id") for r in rows if r.get("id")],
+        "visit_ids": visit_ids or seen_visit_ids,
         "patient_explanation": patient_summary,
     }
 
@@ -1373,7 +1392,7 @@ def _on_case_generate_summary_conn(conn, payload: Dict[str, Any]) -> None:
 
 
 def _on_stage_transition_requested_conn(conn, payload: Dict[str, Any]) -> None:
-    case_id = int(payload.get("caseId") or payload.get("caseDbId") or 0)
+    case_id = _coerce_case_id(payload)
     requested_stage = (payload.get("requestedStage") or payload.get("toStage") or "").strip()
     reason = (payload.get("reason") or "Stage change requested").strip()
     if not case_id or not requested_stage:
@@ -1431,19 +1450,51 @@ def _on_stage_transition_requested_conn(conn, payload: Dict[str, Any]) -> None:
         )
 
 
+_CASES_UPDATE_TEMPLATE: Optional[Dict[str, Any]] = None
+
+
+def _cases_update_template(conn) -> Dict[str, Any]:
+    """
+    Schema-derived pieces for the stage-approval path, probed once per process:
+      - has_pending_stage: cases.pending_stage exists
+      - stage_sql: UPDATE applying an approved stage (None if cases.stage is missing)
+    """
+    global _CASES_UPDATE_TEMPLATE
+    if _CASES_UPDATE_TEMPLATE is not None:
+        return _CASES_UPDATE_TEMPLATE
+
+    tpl: Dict[str, Any] = {"has_pending_stage": False, "stage_sql": None}
+    with _cursor(conn) as cur:
+        if _table_exists(cur, "cases"):
+            tpl["has_pending_stage"] = _column_exists(cur, "cases", "pending_stage")
+            if _column_exists(cur, "cases", "stage"):
+                sets = ["stage=%s"]
+                if _column_exists(cur, "cases", "approval_required"):
+                    sets.append("approval_required=0")
+                if tpl["has_pending_stage"]:
+                    sets.append("pending_stage=NULL")
+                if _column_exists(cur, "cases", "updated_at"):
+                    sets.append("updated_at=NOW()")
+                tpl["stage_sql"] = f"UPDATE cases SET {', '.join(sets)} WHERE id=%s"
+
+    _CASES_UPDATE_TEMPLATE = tpl
+    return tpl
+
+
 def _on_stage_transition_approved_conn(conn, payload: Dict[str, Any]) -> None:
-    case_id = int(payload.get("caseId") or payload.get("caseDbId") or 0)
+    case_id = _coerce_case_id(payload)
     approved_stage = (payload.get("approvedStage") or payload.get("toStage") or payload.get("stage") or "").strip()
     if not case_id:
         return
 
+    tpl = _cases_update_template(conn)
+
     # If stage not in payload, attempt to read from cases.pending_stage
-    if not approved_stage:
+    if not approved_stage and tpl["has_pending_stage"]:
         with _cursor(conn) as cur:
-            if _table_exists(cur, "cases") and _column_exists(cur, "cases", "pending_stage"):
-                cur.execute("SELECT pending_stage FROM cases WHERE id=%s", (case_id,))
-                row = cur.fetchone() or {}
-                approved_stage = str(row.get("pending_stage") or "").strip()
+            cur.execute("SELECT pending_stage FROM cases WHERE id=%s", (case_id,))
+            row = cur.fetchone() or {}
+            approved_stage = str(row.get("pending_stage") or "").strip()
 
     if not approved_stage:
         return
@@ -1456,19 +1507,10 @@ def _on_stage_transition_approved_conn(conn, payload: Dict[str, Any]) -> None:
     patient_id = int(case_row.get("patient_id") or 0)
 
     # Apply stage
-    with _cursor(conn) as cur:
-        if _table_exists(cur, "cases") and _column_exists(cur, "cases", "stage"):
-            sets = ["stage=%s"]
-            vals: List[Any] = [approved_stage]
-            if _column_exists(cur, "cases", "approval_required"):
-                sets.append("approval_required=0")
-            if _column_exists(cur, "cases", "pending_stage"):
-                sets.append("pending_stage=NULL")
-            if _column_exists(cur, "cases", "updated_at"):
-                sets.append("updated_at=NOW()")
-            vals.append(case_id)
+    if tpl["stage_sql"]:
+        with _cursor(conn) as cur:
             try:
-                cur.execute(f"UPDATE cases SET {', '.join(sets)} WHERE id=%s", tuple(vals))
+                cur.execute(tpl["stage_sql"], (approved_stage, case_id))
             except Exception:
                 return
 
@@ -1562,17 +1604,16 @@ def _on_case_monitor_tick_conn(conn, payload: Dict[str, Any]) -> None:
                 continue
             doctor_id = int(row.get("doctor_id") or 0)
             patient_id = int(row.get("patient_id") or 0)
-            nrd = row.get("next_review_date")
-            if isinstance(nrd, datetime):
-                nrd = nrd.date()
+            nrd = _as_date(row.get("next_review_date")) or row.get("next_review_date")
 
+            tick_json = json.dumps({"next_review_date": str(nrd), "monitor_tick": True}, ensure_ascii=False)
             _insert_timeline(
                 conn,
                 case_id=case_id,
                 event_type="FOLLOWUP_DUE",
                 title="Follow-up due",
                 body=f"Follow-up due (next review date: {nrd})",
-                meta={"next_review_date": str(nrd), "monitor_tick": True},
+                meta_json=tick_json,
             )
 
             if doctor_id:
@@ -1586,7 +1627,7 @@ def _on_case_monitor_tick_conn(conn, payload: Dict[str, Any]) -> None:
                     related_table="cases",
                     related_id=case_id,
                     priority_hint="HIGH",
-                    meta={"next_review_date": str(nrd), "monitor_tick": True},
+                    meta_encoded=tick_json,
                 )
             if patient_id:
                 _notify_multi(
@@ -1599,7 +1640,7 @@ def _on_case_monitor_tick_conn(conn, payload: Dict[str, Any]) -> None:
                     related_table="cases",
                     related_id=case_id,
                     priority_hint="NORMAL",
-                    meta={"next_review_date": str(nrd), "monitor_tick": True},
+                    meta_encoded=tick_json,
                 )
         except Exception:
             continue
@@ -1611,14 +1652,32 @@ def _on_case_auto_match_requested_conn(conn, payload: Dict[str, Any]) -> None:
     Since agents are DB-only, we write candidates into timeline meta + notify doctor.
 
     Payload:
-      { patientPhone/name/patientId, caseId? }
+      { patientPhone/name/patientId, caseId?, caseIds? }
     """
     patient_id = _resolve_patient_id(conn, payload)
     if not patient_id:
         return
 
-    candidates = _get_recent_cases_for_patient(conn, patient_id, limit=5)
-    case_id = int(payload.get("caseId") or payload.get("caseDbId") or 0)
+    case_id = _coerce_case_id(payload)
+
+    hint_ids: List[int] = []
+    hint = payload.get("caseIds")
+    if isinstance(hint, list):
+        for cid in hint:
+            try:
+                n = int(cid)
+                if n > 0:
+                    hint_ids.append(n)
+            except Exception:
+                continue
+
+    candidates = _get_recent_cases_for_patient(
+        conn,
+        patient_id,
+        limit=5,
+        exclude_case_id=case_id or None,
+        case_ids=hint_ids or None,
+    )
 
     # If a case_id is provided, store candidates against that case; else just notify doctor role-broadcast.
     if case_id:
@@ -1722,54 +1781,36 @@ class CaseTrackingAgent:
       - Documents are drafted as PDFs only if ReportLab is available; otherwise it silently skips.
     """
 
+    # event_type -> handler; exact names matter in your outbox
+    _DISPATCH = {
+        "CaseUpdated": _on_case_updated_conn,
+        "CaseGenerateSummary": _on_case_generate_summary_conn,
+        "AppointmentCompleted": _on_appointment_completed_conn,
+        "CaseStageTransitionRequested": _on_stage_transition_requested_conn,
+        "CaseStageTransitionApproved": _on_stage_transition_approved_conn,
+        "CaseMonitorTick": _on_case_monitor_tick_conn,
+        "CaseAutoMatchRequested": _on_case_auto_match_requested_conn,
+    }
+
     def handle(self, conn, event_type: str, event_id: int, payload: Dict[str, Any]) -> None:
-        # Normalize (exact names matter in your outbox)
         et = (event_type or "").strip()
 
-        try:
-            if et == "CaseUpdated":
-                _on_case_updated_conn(conn, payload)
-                return
+        fn = self._DISPATCH.get(et)
+        if fn is None:
+            # Ignore unknown event types gracefully.
+            return
 
+        try:
+            fn(conn, payload)
             if et == "CaseGenerateSummary":
-                _on_case_generate_summary_conn(conn, payload)
                 try:
                     conn.commit()
                 except Exception:
                     pass
-                return
-
-            if et == "AppointmentCompleted":
-                _on_appointment_completed_conn(conn, payload)
-                return
-
-            if et == "CaseStageTransitionRequested":
-                _on_stage_transition_requested_conn(conn, payload)
-                return
-
-            if et == "CaseStageTransitionApproved":
-                _on_stage_transition_approved_conn(conn, payload)
-                return
-
-            if et == "CaseMonitorTick":
-                _on_case_monitor_tick_conn(conn, payload)
-                return
-
-            if et == "CaseAutoMatchRequested":
-                _on_case_auto_match_requested_conn(conn, payload)
-                return
-
-            # Ignore unknown event types gracefully.
-            return
-
         except Exception:
             # Never crash the worker loop without context; record a timeline row if possible.
             # (Worker should also mark the event FAILED and store last_error.)
-            case_id = 0
-            try:
-                case_id = int(payload.get("caseId") or payload.get("caseDbId") or payload.get("caseDbID") or 0)
-            except Exception:
-                case_id = 0
+            case_id = _coerce_case_id(payload)
 
             if case_id:
                 _insert_timeline(
@@ -3,28 +3,62 @@ from __future__ import annotations
 
 from datetime import datetime, timedelta, date, timezone
 from typing import Any, Dict, Optional, List, Tuple
+from collections import OrderedDict
 import os
 import json
+import logging
+import contextlib
+import functools
+import heapq
+import re
+import time
+import queue
+import atexit
+import threading
 
 from .. import config as _config  # loads .env for INVENTORY_PO_AUTO and DB settings
-from ..db import get_conn
-from ..notifications import create_notification
-
-# --- timezone safe (Windows-friendly) ---
+from ..db import (
+    _as_text,
+    _column_exists,
+    _get_column_type,
+    _table_exists,
+    execute_prepared_rowcount,
+    get_conn,
+    load_schema,
+    on_schema_clear,
+    schema_cache_clear,
+)
+from ..notifications import create_notification, create_notifications
+
+log = logging.getLogger(__name__)
+
+# --- optional fast JSON encoder (falls back to stdlib json) ---
 try:
-    from zoneinfo import ZoneInfo  # py3.9+
-    try:
-        IST = ZoneInfo("Asia/Kolkata")
-    except Exception:
-        IST = timezone(timedelta(hours=5, minutes=30), name="IST")
-except Exception:
-    IST = timezone(timedelta(hours=5, minutes=30), name="IST")
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+
+def _json_dumps(obj: Any) -> str:
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            pass  # non-str keys / unsupported types: let json decide
+    return json.dumps(obj, ensure_ascii=False)
+
+
+# --- timezone (Windows-friendly) ---
+# India has no DST, so a fixed +05:30 offset is exact and avoids zoneinfo rule lookups.
+IST = timezone(timedelta(hours=5, minutes=30), name="IST")
 
 
 LOW_STOCK_DEFAULT_THRESHOLD = 5
 EXPIRY_ALERT_DAYS = 30
 ANOMALY_MULTIPLIER = 3
 ANOMALY_MIN_QTY = 3
+PO_DRAFTS_PER_TICK = 20  # daily_inventory_checks drafts POs for the lowest items only
+DAILY_SCAN_BATCH = 1000  # fetchmany size for the daily scan
 
 
 def _env_flag(name: str) -> bool:
@@ -47,22 +81,87 @@ DEFAULT_PROCEDURE_CONSUMABLES = [
 ]
 
 
+def _build_procedure_matcher() -> Tuple["re.Pattern[str]", Dict[str, frozenset]]:
+    """
+    Compile every procedure keyword into one overlapping-match regex (longest alternative first)
+    so a text is scanned once instead of once per keyword per rule.
+    Each keyword maps to the rule indices of every keyword it contains, so reporting only the
+    longest keyword at a position still yields all rules that a substring scan would hit.
+    """
+    kw_rules: Dict[str, set] = {}
+    for idx, (keys, _items) in enumerate(DEFAULT_PROCEDURE_CONSUMABLES):
+        for k in keys:
+            kw_rules.setdefault(k.lower(), set()).add(idx)
+    closure = {
+        kw: frozenset(i for other, idxs in kw_rules.items() if other in kw for i in idxs)
+        for kw in kw_rules
+    }
+    alts = sorted(kw_rules, key=len, reverse=True)
+    pattern = re.compile("(?=(" + "|".join(re.escape(k) for k in alts) + "))")
+    return pattern, closure
+
+
+_PROC_KW_RE, _PROC_KW_RULES = _build_procedure_matcher()
+
+
+def _matched_rule_indices(text_lower: str) -> List[int]:
+    """
+    Indices into DEFAULT_PROCEDURE_CONSUMABLES whose keywords occur in text_lower, in rule order.
+    """
+    hits: set = set()
+    for m in _PROC_KW_RE.finditer(text_lower):
+        hits |= _PROC_KW_RULES[m.group(1)]
+    return sorted(hits)
+
+
 # ----------------------------
 # cursor / row helpers (dict-safe)
 # ----------------------------
+_CURSOR_FACTORIES: Dict[type, Any] = {}  # connection class -> cursor callable
+
+
+def _dict_cursor(conn):
+    return conn.cursor(dictionary=True)  # mysql-connector
+
+
+def _plain_cursor(conn):
+    return conn.cursor()  # pymysql (DictCursor set in db.get_conn)
+
+
 def _cursor(conn):
     """
     mysql-connector: conn.cursor(dictionary=True)
     pymysql (DictCursor set in db.get_conn): conn.cursor()
+    The driver is probed once per connection class; later calls are a dict lookup.
     """
+    factory = _CURSOR_FACTORIES.get(type(conn))
+    if factory is not None:
+        return factory(conn)
     try:
-        return conn.cursor(dictionary=True)  # mysql-connector
+        cur = _dict_cursor(conn)
+        _CURSOR_FACTORIES[type(conn)] = _dict_cursor
+        return cur
     except TypeError:
-        return conn.cursor()  # pymysql
+        _CURSOR_FACTORIES[type(conn)] = _plain_cursor
+        return _plain_cursor(conn)
     except Exception:
         return conn.cursor()
 
 
+def _stream_cursor(conn, *, dictionary: bool = True):
+    """
+    Unbuffered cursor for scans whose rows are consumed in one pass (mysql-connector);
+    rows are pulled from the socket as iterated instead of being copied into a client buffer first.
+    Falls back to _cursor on drivers without the buffered flag. Read every row before reusing conn.
+    """
+    if _CURSOR_FACTORIES.get(type(conn)) is _plain_cursor:
+        return _cursor(conn)
+    try:
+        return conn.cursor(dictionary=dictionary, buffered=False)
+    except TypeError:
+        return _cursor(conn)
+
+
 def _row_to_dict(cur, row):
     if row is None:
         return None
@@ -87,94 +186,175 @@ def _rows_to_dicts(cur, rows):
     return [_row_to_dict(cur, r) for r in rows]
 
 
+@contextlib.contextmanager
+def _shared_cursor(conn):
+    """
+    Per-connection cursor kept on conn._inventory_cur and reused across helper calls.
+    Re-entrant: a nested user while it is busy gets a private cursor instead.
+    A cursor that saw an error is dropped and reopened on next use.
+    """
+    slot = getattr(conn, "_inventory_cur", None)
+    if slot is None or slot[1]:
+        if slot is None:
+            slot = [None, False]
+            try:
+                conn._inventory_cur = slot
+            except Exception:
+                slot = [None, True]  # cannot attach: behave as always-busy
+        if slot[1]:
+            own = _cursor(conn)
+            try:
+                yield own
+            finally:
+                try:
+                    own.close()
+                except Exception:
+                    pass
+            return
+
+    if slot[0] is None:
+        slot[0] = _cursor(conn)
+    slot[1] = True
+    try:
+        yield slot[0]
+    except BaseException:
+        try:
+            slot[0].close()
+        except Exception:
+            pass
+        slot[0] = None
+        raise
+    finally:
+        slot[1] = False
+
+
+@contextlib.contextmanager
+def _use_cursor(conn, cur=None):
+    """
+    Reuse the caller's cursor when one is threaded through, else the connection's shared one.
+    Lets an operation share one cursor across helpers that also work standalone.
+    """
+    if cur is not None:
+        yield cur
+        return
+    with _shared_cursor(conn) as shared:
+        yield shared
+
+
+@functools.lru_cache(maxsize=256)
+def _insert_sql(
+    table: str,
+    cols: Tuple[str, ...],
+    nrows: int = 1,
+    suffix: str = "",
+    now_cols: Tuple[str, ...] = (),
+) -> str:
+    """
+    INSERT text for a discovered column shape; built once per (table, cols, nrows, suffix, now_cols).
+    cols are bound as %s params; now_cols are filled server-side with NOW() (no param).
+    """
+    row_sql = "(" + ", ".join(["%s"] * len(cols) + ["NOW()"] * len(now_cols)) + ")"
+    sql = f"INSERT INTO {table} ({', '.join(cols + now_cols)}) VALUES {', '.join([row_sql] * nrows)}"
+    return f"{sql} {suffix}" if suffix else sql
+
+
+def _iter_rows(cur, *cols: str):
+    """
+    Yield tuples of the named columns straight off the cursor.
+    Dict rows are read in place; tuple rows are indexed by position from cur.description,
+    so no per-row dict is built.
+    """
+    idx: Optional[List[Optional[int]]] = None
+    for row in cur:
+        if isinstance(row, dict):
+            yield tuple(row.get(c) for c in cols)
+            continue
+        if idx is None:
+            pos = {d[0]: i for i, d in enumerate(cur.description or [])}
+            idx = [pos.get(c) for c in cols]
+        yield tuple(row[i] if i is not None else None for i in idx)
+
+
 def _today() -> date:
     return datetime.now(tz=IST).date()
 
 
-def _table_exists(cur, name: str) -> bool:
-    cur.execute(
-        """
-        SELECT 1 FROM INFORMATION_SCHEMA.TABLES
-        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s
-        LIMIT 1
-        """,
-        (name,),
-    )
-    return cur.fetchone() is not None
+def _to_int(v: Any) -> int:
+    """int for a numeric column value; ints (the common driver case) pass straight through."""
+    return v if type(v) is int else int(float(v or 0))
 
 
-def _column_exists(cur, table: str, col: str) -> bool:
-    cur.execute(
-        """
-        SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
-        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME=%s
-        LIMIT 1
-        """,
-        (table, col),
-    )
-    return cur.fetchone() is not None
+# ----------------------------
+# schema-derived caches (the schema itself is cached in db.py)
+# ----------------------------
+_VISIT_CONSUMPTION_SQL: Dict[bool, Optional[str]] = {}  # with_procedure_consumables -> fused SQL
+_ENUM_VALUES: Dict[Tuple[str, str], Tuple[str, ...]] = {}  # (table, column) -> parsed enum values
+_CONSUME_SQL: Dict[Tuple[str, bool], Tuple[str, str, bool]] = {}  # (stock_col, has_updated_at) -> see _consume_sql
+
+
+@on_schema_clear
+def _clear_schema_derived() -> None:
+    global _ALERT_SHAPE, _STOCK_COLS, _PO_PLAN, _LOCK_PLAN
+    _ALERT_SHAPE = None
+    _STOCK_COLS = None
+    _PO_PLAN = None
+    _LOCK_PLAN = None
+    _VISIT_CONSUMPTION_SQL.clear()
+    _ENUM_VALUES.clear()
+    _CONSUME_SQL.clear()
+    _ROLE_CACHE.clear()
+    _ADMIN_IDS_CACHE.clear()
+
+
+_ENUM_RE = re.compile(r"'((?:[^'\\]|\\.|'')*)'")
 
 
 def _get_enum_values(cur, table: str, col: str) -> List[str]:
     """
-    Reads enum('A','B',...) values from information_schema if column is ENUM.
+    Reads enum('A','B',...) values from the cached column types if column is ENUM.
     Returns [] if not enum or cannot parse.
     """
     try:
-        cur.execute(
-            """
-            SELECT COLUMN_TYPE
-            FROM INFORMATION_SCHEMA.COLUMNS
-            WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME=%s
-            LIMIT 1
-            """,
-            (table, col),
-        )
-        row = cur.fetchone()
-        if not row:
-            return []
-        if isinstance(row, dict):
-            ct = row.get("COLUMN_TYPE") or ""
-        else:
-            # single column
-            ct = row[0] if len(row) else ""
-        ct = str(ct or "")
-        if not ct.lower().startswith("enum("):
-            return []
-        inside = ct[5:-1]  # strip enum( ... )
-        # split by ',' but keep quoted strings
-        vals: List[str] = []
-        curv = ""
-        inq = False
-        for ch in inside:
-            if ch == "'" and not inq:
-                inq = True
-                curv = ""
-                continue
-            if ch == "'" and inq:
-                inq = False
-                vals.append(curv)
-                curv = ""
-                continue
-            if inq:
-                curv += ch
-        return vals
+        return _enum_values_of(table, col, _get_column_type(cur, table, col))
     except Exception:
         return []
 
 
+def _enum_values_of(table: str, col: str, ct: Optional[str]) -> List[str]:
+    key = (table.lower(), col.lower())
+    hit = _ENUM_VALUES.get(key)
+    if hit is not None:
+        return list(hit)
+    vals: List[str] = []
+    if (ct or "").lower().startswith("enum("):
+        # MySQL doubles embedded quotes in COLUMN_TYPE
+        vals = [v.replace("''", "'") for v in _ENUM_RE.findall(ct)]
+    _ENUM_VALUES[key] = tuple(vals)
+    return vals
+
+
+_ROLE_CACHE: Dict[str, str] = {}  # desired upper -> users.role value; depends only on the schema
+_ADMIN_IDS_CACHE: Dict[str, Tuple[float, List[int]]] = {}  # admin role value -> (expires monotonic, ids)
+ADMIN_IDS_TTL_SEC = 60
+
+
 def _normalize_user_role(conn, desired: str) -> str:
     """
     Normalize roles to your DB reality.
     Your schema often uses users.role ENUM('Admin','Doctor','Patient') (case-sensitive).
     We map 'ADMIN'->'Admin', 'DOCTOR'->'Doctor', 'PATIENT'->'Patient' if enum supports it.
     If not, we return desired as given.
+    Results are cached until the next schema refresh.
     """
     desired_u = str(desired or "").strip()
     if not desired_u:
         return desired_u
     desired_upper = desired_u.upper()
 
+    hit = _ROLE_CACHE.get(desired_upper)
+    if hit is not None:
+        return hit
+
     # default mapping
     mapped = {
         "ADMIN": "Admin",
@@ -182,51 +362,56 @@ def _normalize_user_role(conn, desired: str) -> str:
         "PATIENT": "Patient",
     }.get(desired_upper, desired_u)
 
+    out = mapped
     cur = _cursor(conn)
     try:
-        if not _table_exists(cur, "users") or not _column_exists(cur, "users", "role"):
-            return mapped
-        enums = _get_enum_values(cur, "users", "role")
-        if not enums:
-            return mapped
-
-        # find best case-insensitive match in enum list
-        for e in enums:
-            if str(e).upper() == mapped.upper():
-                return e
-        for e in enums:
-            if str(e).upper() == desired_upper:
-                return e
-        return mapped
+        if _table_exists(cur, "users") and _column_exists(cur, "users", "role"):
+            enums = _get_enum_values(cur, "users", "role")
+            # find best case-insensitive match in enum list
+            match = next((e for e in enums if str(e).upper() == mapped.upper()), None)
+            if match is None:
+                match = next((e for e in enums if str(e).upper() == desired_upper), None)
+            if match is not None:
+                out = match
     finally:
         try:
             cur.close()
         except Exception:
             pass
 
+    _ROLE_CACHE[desired_upper] = out
+    return out
+
 
 def _list_admin_user_ids(conn) -> List[int]:
     """
     Returns all user IDs with role Admin/ADMIN etc (case-safe).
+    Cached per admin role value for ADMIN_IDS_TTL_SEC; the admin set rarely changes within a burst.
     """
+    admin_role = _normalize_user_role(conn, "ADMIN")
+    now = time.monotonic()
+    hit = _ADMIN_IDS_CACHE.get(admin_role)
+    if hit and hit[0] > now:
+        return list(hit[1])
+
     cur = _cursor(conn)
     try:
         if not _table_exists(cur, "users") or not _column_exists(cur, "users", "role"):
             return []
-        admin_role = _normalize_user_role(conn, "ADMIN")
         # also accept uppercase if stored that way
         cur.execute(
             "SELECT id FROM users WHERE role=%s OR UPPER(role)='ADMIN'",
             (admin_role,),
         )
-        rows = _rows_to_dicts(cur, cur.fetchall() or [])
         out: List[int] = []
-        for r in rows:
+        for (uid,) in _iter_rows(cur, "id"):
             try:
-                out.append(int(r.get("id") or 0))
+                out.append(int(uid or 0))
             except Exception:
                 pass
-        return [x for x in out if x > 0]
+        ids = [x for x in out if x > 0]
+        _ADMIN_IDS_CACHE[admin_role] = (now + ADMIN_IDS_TTL_SEC, ids)
+        return list(ids)
     finally:
         try:
             cur.close()
@@ -237,10 +422,27 @@ def _list_admin_user_ids(conn) -> List[int]:
 # ----------------------------
 # notifications (schema-aligned)
 # ----------------------------
-def _create_notification(
-    conn,
+_NOTIFICATION_INTO = (
+    "INSERT INTO notifications"
+    " (user_id, user_role, channel, type, title, message, status, scheduled_at, meta_json, created_at)"
+)
+_NOTIFICATION_INSERT = _NOTIFICATION_INTO + " VALUES "
+_NOTIFICATION_VALUES = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())"
+# broadcast row + one row per admin user + legacy user_id=1, in one statement;
+# every branch binds the same 8 non-user_id params, the admin branch also the role
+_NOTIFICATION_SHARED = "%s, %s, %s, %s, %s, %s, %s, %s, NOW()"
+_ADMIN_NOTIFICATION_INSERT = (
+    _NOTIFICATION_INTO
+    + f" SELECT NULL, {_NOTIFICATION_SHARED}"
+    + f" UNION ALL SELECT u.id, {_NOTIFICATION_SHARED} FROM users u WHERE u.role=%s OR UPPER(u.role)='ADMIN'"
+    + f" UNION ALL SELECT 1, {_NOTIFICATION_SHARED}"
+)
+
+
+def _build_notification_row(
     *,
     user_id: Optional[int],
+    norm_role: Optional[str],
     title: str,
     message: str,
     notif_type: str,
@@ -249,50 +451,113 @@ def _create_notification(
     scheduled_at: Optional[datetime] = None,
     meta: Optional[dict] = None,
     channel: str = "IN_APP",
-    user_role: Optional[str] = None,
-    status: str = "PENDING",  # NEW/PENDING/SENT/FAILED/READ supported in your schema
-) -> None:
+    status: str = "PENDING",
+) -> Tuple[Any, ...]:
     """
-    Inserts into notifications table.
-    Safe if table doesn't exist.
+    Bind params for one notifications row (see _NOTIFICATION_VALUES).
+    user_role must already be normalized via _normalize_user_role.
     """
-    cur = _cursor(conn)
-    try:
-        if not _table_exists(cur, "notifications"):
-            return
-
+    meta_json = None
+    if meta or related_table or related_id is not None:
         meta_payload = dict(meta or {})
         if related_table:
             meta_payload["related_table"] = related_table
         if related_id is not None:
             meta_payload["related_id"] = related_id
+        meta_json = _json_dumps(meta_payload) if meta_payload else None
+
+    sched = None
+    if scheduled_at:
+        sched = scheduled_at.astimezone(IST).replace(tzinfo=None).isoformat(sep=" ", timespec="seconds")
+
+    return (
+        int(user_id) if user_id else None,
+        norm_role,
+        channel,
+        notif_type,
+        (title or "")[:200],
+        message or "",
+        (status or "PENDING").upper(),
+        sched,
+        meta_json,
+    )
 
-        sched = None
-        if scheduled_at:
-            sched = scheduled_at.astimezone(IST).strftime("%Y-%m-%d %H:%M:%S")
 
-        # normalize roles to your schema (Admin/Doctor/Patient)
-        norm_role = _normalize_user_role(conn, user_role) if user_role else None
+def _insert_notification_rows(cur, rows: List[Tuple[Any, ...]]) -> None:
+    """
+    Single multi-row INSERT for rows built by _build_notification_row.
+    """
+    if not rows:
+        return
+    cur.execute(
+        _NOTIFICATION_INSERT + ", ".join([_NOTIFICATION_VALUES] * len(rows)),
+        tuple(v for row in rows for v in row),
+    )
 
-        cur.execute(
-            """
-            INSERT INTO notifications
-              (user_id, user_role, channel, type, title, message, status, scheduled_at, meta_json, created_at)
-            VALUES
-              (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
-            """,
-            (
-                int(user_id) if user_id else None,
-                norm_role,
-                channel,
-                notif_type,
-                (title or "")[:200],
-                message or "",
-                (status or "PENDING").upper(),
-                sched,
-                json.dumps(meta_payload, ensure_ascii=False) if meta_payload else None,
-            ),
-        )
+
+# ----------------------------
+# optional async writer for notifications / inventory_alerts
+# ----------------------------
+# INVENTORY_NOTIFY_ASYNC=1 moves these inserts to a background thread with its own
+# connection, coalescing up to NOTIFY_BATCH_MAX rows (or NOTIFY_BATCH_WAIT_SEC) per INSERT.
+# Rows then commit independently of the consuming transaction, so it is off by default.
+# Deduped create_notification calls (_emit_many) ride the same queue as _CREATE_NOTIFICATION
+# items, so their idempotency-lock + insert roundtrips leave the event path too.
+NOTIFY_ASYNC = _env_flag("INVENTORY_NOTIFY_ASYNC")
+NOTIFY_BATCH_MAX = 50
+NOTIFY_BATCH_WAIT_SEC = 0.1
+
+_NOTIF_QUEUE: "queue.Queue[Optional[Tuple[str, Tuple[str, ...], Tuple[str, ...], Tuple[Any, ...]]]]" = queue.Queue()
+_NOTIF_THREAD: Optional[threading.Thread] = None
+_NOTIF_LOCK = threading.Lock()
+_CREATE_NOTIFICATION = "create_notification"
+
+
+def _enqueue_write(
+    table: str,
+    cols: Tuple[str, ...],
+    vals: Tuple[Any, ...],
+    now_cols: Tuple[str, ...] = (),
+) -> None:
+    """
+    Hand one row to the background writer (started on first use).
+    For notifications, cols is empty and vals come from _build_notification_row;
+    for _CREATE_NOTIFICATION, vals is the create_notification kwargs dict.
+    """
+    global _NOTIF_THREAD
+    if _NOTIF_THREAD is None:
+        with _NOTIF_LOCK:
+            if _NOTIF_THREAD is None:
+                t = threading.Thread(target=_notif_writer_loop, name="inventory-notify", daemon=True)
+                t.start()
+                atexit.register(_notif_writer_stop)
+                _NOTIF_THREAD = t
+    _NOTIF_QUEUE.put_nowait((table, cols, now_cols, vals))
+
+
+def _write_batch(conn, batch: List[Tuple[str, Tuple[str, ...], Tuple[str, ...], Tuple[Any, ...]]]) -> None:
+    groups: Dict[Tuple[str, Tuple[str, ...], Tuple[str, ...]], List[Tuple[Any, ...]]] = {}
+    calls: List[Dict[str, Any]] = []
+    for table, cols, now_cols, vals in batch:
+        if table == _CREATE_NOTIFICATION:
+            calls.append(vals)
+            continue
+        groups.setdefault((table, cols, now_cols), []).append(vals)
+
+    cur = _cursor(conn)
+    try:
+        for kwargs in calls:
+            create_notification(conn=conn, **kwargs)
+        for (table, cols, now_cols), rows in groups.items():
+            if table == "notifications":
+                _insert_notification_rows(cur, rows)
+                continue
+            cur.execute(
+                _insert_sql(table, cols, len(rows), now_cols=now_cols),
+                tuple(v for r in rows for v in r),
+            )
+        conn.commit()
+        _mark_emitted([kw["dedupe_key"] for kw in calls if kw.get("dedupe_key")])
     finally:
         try:
             cur.close()
@@ -300,133 +565,259 @@ def _create_notification(
             pass
 
 
-def _notify_admins(
+def _notif_writer_loop() -> None:
+    conn = None
+    stop = False
+    while not stop:
+        item = _NOTIF_QUEUE.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = time.monotonic() + NOTIFY_BATCH_WAIT_SEC
+        while len(batch) < NOTIFY_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                nxt = _NOTIF_QUEUE.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if nxt is None:
+                stop = True
+                break
+            batch.append(nxt)
+
+        try:
+            if conn is None:
+                conn = get_conn()
+            _write_batch(conn, batch)
+        except Exception as e:
+            log.warning("async notification write failed (%d rows): %s", len(batch), e)
+            try:
+                if conn is not None:
+                    conn.close()
+            except Exception:
+                pass
+            conn = None
+
+    try:
+        if conn is not None:
+            conn.close()
+    except Exception:
+        pass
+
+
+def _notif_writer_stop(timeout: float = 5.0) -> None:
+    """Flush queued rows and stop the writer (registered with atexit)."""
+    t = _NOTIF_THREAD
+    if t is None or not t.is_alive():
+        return
+    _NOTIF_QUEUE.put(None)
+    t.join(timeout)
+
+
+def _write_notification_rows(cur, rows: List[Tuple[Any, ...]]) -> None:
+    if NOTIFY_ASYNC:
+        for row in rows:
+            _enqueue_write("notifications", (), row)
+    else:
+        _insert_notification_rows(cur, rows)
+
+
+def _create_notification(
     conn,
     *,
+    user_id: Optional[int],
     title: str,
     message: str,
     notif_type: str,
     related_table: Optional[str] = None,
     related_id: Optional[int] = None,
+    scheduled_at: Optional[datetime] = None,
     meta: Optional[dict] = None,
-    status: str = "PENDING",
+    channel: str = "IN_APP",
+    user_role: Optional[str] = None,
+    status: str = "PENDING",  # NEW/PENDING/SENT/FAILED/READ supported in your schema
+    cur=None,
 ) -> None:
     """
-    Workflow-aligned:
-      - broadcast notification for Admin role (user_id NULL, user_role Admin)
-      - also notify all Admin users in users table
-      - keep legacy fallback user_id=1 so nothing breaks
+    Inserts into notifications table.
+    Safe if table doesn't exist.
     """
-    # broadcast (admins see it via (user_id IS NULL AND user_role='Admin') query logic)
-    _create_notification(
-        conn,
-        user_id=None,
-        user_role="ADMIN",
-        title=title,
-        message=message,
-        notif_type=notif_type,
-        related_table=related_table,
-        related_id=related_id,
-        meta=meta,
-        status=status,
-    )
+    with _use_cursor(conn, cur) as cur:
+        if not _table_exists(cur, "notifications"):
+            return
+
+        # normalize roles to your schema (Admin/Doctor/Patient)
+        norm_role = _normalize_user_role(conn, user_role) if user_role else None
 
-    # direct to admin users (if any)
-    admin_ids = _list_admin_user_ids(conn)
-    for aid in admin_ids:
-        _create_notification(
-            conn,
-            user_id=aid,
-            user_role="ADMIN",
+        row = _build_notification_row(
+            user_id=user_id,
+            norm_role=norm_role,
             title=title,
             message=message,
             notif_type=notif_type,
             related_table=related_table,
             related_id=related_id,
+            scheduled_at=scheduled_at,
             meta=meta,
+            channel=channel,
             status=status,
         )
-
-    # legacy fallback (preserve your existing behavior)
-    _create_notification(
-        conn,
-        user_id=1,
-        user_role="ADMIN",
-        title=title,
-        message=message,
-        notif_type=notif_type,
-        related_table=related_table,
-        related_id=related_id,
-        meta=meta,
-        status=status,
-    )
+        _write_notification_rows(cur, [row])
 
 
-def _upsert_inventory_alert_if_table_exists(
+def _notify_admins(
     conn,
     *,
-    item_id: int,
-    alert_type: str,
+    title: str,
     message: str,
-    severity: int = 100,
+    notif_type: str,
+    related_table: Optional[str] = None,
+    related_id: Optional[int] = None,
     meta: Optional[dict] = None,
+    status: str = "PENDING",
+    cur=None,
 ) -> None:
     """
-    If inventory_alerts table exists, record an alert row.
-    Does NOT require any fixed schema — inserts only if columns exist.
+    Workflow-aligned:
+      - broadcast notification for Admin role (user_id NULL, user_role Admin)
+      - also notify all Admin users in users table
+      - keep legacy fallback user_id=1 so nothing breaks
+    All rows go out in one INSERT ... SELECT (users joined server-side) or,
+    without a users table / in async mode, one multi-row INSERT.
     """
-    cur = _cursor(conn)
-    try:
-        if not _table_exists(cur, "inventory_alerts"):
+    with _use_cursor(conn, cur) as cur:
+        if not _table_exists(cur, "notifications"):
+            return
+
+        norm_role = _normalize_user_role(conn, "ADMIN")
+
+        def row(uid: Optional[int]) -> Tuple[Any, ...]:
+            return _build_notification_row(
+                user_id=uid,
+                norm_role=norm_role,
+                title=title,
+                message=message,
+                notif_type=notif_type,
+                related_table=related_table,
+                related_id=related_id,
+                meta=meta,
+                status=status,
+            )
+
+        has_users = _table_exists(cur, "users") and _column_exists(cur, "users", "role")
+        if has_users and not NOTIFY_ASYNC:
+            # admin fan-out joined in the DB: no admin-id SELECT round-trip
+            shared = row(None)[1:]
+            cur.execute(_ADMIN_NOTIFICATION_INSERT, shared + shared + (norm_role,) + shared)
+            return
+
+        # broadcast (admins see it via (user_id IS NULL AND user_role='Admin') query logic)
+        rows = [row(None)]
+        # direct to admin users (if any)
+        rows.extend(row(aid) for aid in _list_admin_user_ids(conn))
+        # legacy fallback (preserve your existing behavior)
+        rows.append(row(1))
+
+        _write_notification_rows(cur, rows)
+
+
+def _notify_admins_many(conn, notes: List[Dict[str, Any]], *, cur=None) -> None:
+    """
+    _notify_admins for several notifications at once (kwargs dicts, same keys as
+    _notify_admins). Each note still fans out to broadcast + admin users + user_id=1,
+    but all rows go out in one multi-row INSERT using the cached admin-id list.
+    """
+    if not notes:
+        return
+    if len(notes) == 1:
+        _notify_admins(conn, cur=cur, **notes[0])
+        return
+    with _use_cursor(conn, cur) as cur:
+        if not _table_exists(cur, "notifications"):
             return
 
-        cols: List[str] = []
-        vals: List[Any] = []
+        norm_role = _normalize_user_role(conn, "ADMIN")
+        recipients: List[Optional[int]] = [None, *_list_admin_user_ids(conn), 1]
+        rows: List[Tuple[Any, ...]] = []
+        for note in notes:
+            shared = _build_notification_row(user_id=None, norm_role=norm_role, **note)[1:]
+            rows.extend((uid,) + shared for uid in recipients)
+        _write_notification_rows(cur, rows)
+
+
+_ALERT_SHAPE: Optional[Tuple[Tuple[str, ...], Tuple[Any, ...], Tuple[str, ...]]] = None  # (cols, extractors, now_cols)
+
+
+def _alert_shape(cur) -> Tuple[Tuple[str, ...], Tuple[Any, ...], Tuple[str, ...]]:
+    """
+    inventory_alerts columns present in this schema, each with its value extractor,
+    plus the columns filled with NOW(). Discovered once; reset by schema_cache_clear().
+    """
+    global _ALERT_SHAPE
+    if _ALERT_SHAPE is not None:
+        return _ALERT_SHAPE
 
+    shape: List[Tuple[str, Any]] = []
+    now_cols: Tuple[str, ...] = ()
+    if _table_exists(cur, "inventory_alerts"):
         # common columns (best-effort)
         if _column_exists(cur, "inventory_alerts", "item_id"):
-            cols.append("item_id")
-            vals.append(int(item_id))
+            shape.append(("item_id", lambda ctx: int(ctx["item_id"])))
         if _column_exists(cur, "inventory_alerts", "alert_type"):
-            cols.append("alert_type")
-            vals.append(str(alert_type)[:64])
-        if _column_exists(cur, "inventory_alerts", "type") and "alert_type" not in cols:
-            cols.append("type")
-            vals.append(str(alert_type)[:64])
+            shape.append(("alert_type", lambda ctx: str(ctx["alert_type"])[:64]))
+        elif _column_exists(cur, "inventory_alerts", "type"):
+            shape.append(("type", lambda ctx: str(ctx["alert_type"])[:64]))
 
         if _column_exists(cur, "inventory_alerts", "message"):
-            cols.append("message")
-            vals.append(message)
+            shape.append(("message", lambda ctx: ctx["message"]))
         if _column_exists(cur, "inventory_alerts", "severity"):
-            cols.append("severity")
-            vals.append(int(severity))
+            shape.append(("severity", lambda ctx: int(ctx["severity"])))
 
         if _column_exists(cur, "inventory_alerts", "meta_json"):
-            cols.append("meta_json")
-            vals.append(json.dumps(meta or {}, ensure_ascii=False) if meta else None)
+            shape.append(("meta_json", lambda ctx: _json_dumps(ctx["meta"]) if ctx["meta"] else None))
 
         if _column_exists(cur, "inventory_alerts", "status"):
-            cols.append("status")
-            vals.append("OPEN")
+            shape.append(("status", lambda ctx: "OPEN"))
 
         if _column_exists(cur, "inventory_alerts", "created_at"):
-            cols.append("created_at")
-            vals.append(datetime.now(tz=IST).strftime("%Y-%m-%d %H:%M:%S"))
+            now_cols = ("created_at",)
 
-        if not cols:
-            return
+    _ALERT_SHAPE = (tuple(c for c, _ in shape), tuple(e for _, e in shape), now_cols)
+    return _ALERT_SHAPE
 
-        cur.execute(
-            f"INSERT INTO inventory_alerts ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))})",
-            tuple(vals),
-        )
-    except Exception:
-        # never fail the agent
-        pass
-    finally:
+
+def _record_inventory_alerts(conn, alerts: List[Dict[str, Any]], *, cur=None) -> None:
+    """
+    If inventory_alerts table exists, record one alert row per entry in a single multi-VALUES insert.
+    Does NOT require any fixed schema — inserts only if columns exist.
+    alerts: [{ item_id, alert_type, message, severity, meta }]
+    """
+    if not alerts:
+        return
+    with _use_cursor(conn, cur) as cur:
         try:
-            cur.close()
+            if not _table_exists(cur, "inventory_alerts"):
+                return
+
+            cols, extractors, now_cols = _alert_shape(cur)
+            if not cols and not now_cols:
+                return
+
+            rows = [tuple(ext(a) for ext in extractors) for a in alerts]
+
+            if NOTIFY_ASYNC:
+                for vals in rows:
+                    _enqueue_write("inventory_alerts", cols, vals, now_cols)
+                return
+
+            cur.execute(
+                _insert_sql("inventory_alerts", cols, len(rows), now_cols=now_cols),
+                tuple(v for r in rows for v in r),
+            )
         except Exception:
+            # never fail the agent
             pass
 
 
@@ -456,155 +847,204 @@ def _get_visit_for_appointment(conn, appointment_id: int) -> Optional[Dict[str,
             pass
 
 
-def _consume_items_from_visit(conn, visit_id: int) -> List[Dict[str, Any]]:
+def _visit_consumables_select(cur) -> Optional[str]:
     """
     Primary: visit_consumables(visit_id, item_code, qty_used)
-    Returns: [{ item_code: str, qty: int }]
+    Shape: (src, item_code, qty, procedure_code, procedure_id, procedure_name)
     """
-    cur = _cursor(conn)
-    try:
-        if not _table_exists(cur, "visit_consumables"):
-            return []
+    if not _table_exists(cur, "visit_consumables"):
+        return None
 
-        item_col = None
-        for c in ("item_code", "inventory_item_code", "inventory_item_id", "item_id"):
-            if _column_exists(cur, "visit_consumables", c):
-                item_col = c
-                break
-        if not item_col:
-            return []
+    item_col = None
+    for c in ("item_code", "inventory_item_code", "inventory_item_id", "item_id"):
+        if _column_exists(cur, "visit_consumables", c):
+            item_col = c
+            break
+    if not item_col:
+        return None
 
-        qty_col = "qty_used" if _column_exists(cur, "visit_consumables", "qty_used") else (
-            "qty" if _column_exists(cur, "visit_consumables", "qty") else (
-                "quantity" if _column_exists(cur, "visit_consumables", "quantity") else "qty_used"
-            )
+    qty_col = "qty_used" if _column_exists(cur, "visit_consumables", "qty_used") else (
+        "qty" if _column_exists(cur, "visit_consumables", "qty") else (
+            "quantity" if _column_exists(cur, "visit_consumables", "quantity") else "qty_used"
         )
-        item_is_id = item_col in ("inventory_item_id", "item_id")
-        if item_is_id and _table_exists(cur, "inventory_items") and _column_exists(cur, "inventory_items", "item_code"):
-            cur.execute(
-                f"""
-                SELECT ii.item_code AS item_code, vc.{qty_col} AS qty_used
-                FROM visit_consumables vc
-                JOIN inventory_items ii ON ii.id = vc.{item_col}
-                WHERE vc.visit_id=%s
-                """,
-                (visit_id,),
-            )
-        else:
-            cur.execute(
-                f"SELECT {item_col} AS item_code, {qty_col} AS qty_used FROM visit_consumables WHERE visit_id=%s",
-                (visit_id,),
-            )
-        rows = _rows_to_dicts(cur, cur.fetchall() or [])
-        out: List[Dict[str, Any]] = []
-        for r in rows:
-            code = str(r.get("item_code") or "").strip()
-            qty = r.get("qty_used")
-            try:
-                qty_i = int(float(qty or 0))
-            except Exception:
-                qty_i = 0
-            if code and qty_i > 0:
-                out.append({"item_code": code, "qty": qty_i})
-        return out
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
+    )
+    item_is_id = item_col in ("inventory_item_id", "item_id")
+    if item_is_id and _table_exists(cur, "inventory_items") and _column_exists(cur, "inventory_items", "item_code"):
+        return f"""
+            SELECT 'vc' AS src, ii.item_code AS item_code, vc.{qty_col} AS qty,
+                   NULL AS procedure_code, NULL AS procedure_id, NULL AS procedure_name
+            FROM visit_consumables vc
+            JOIN inventory_items ii ON ii.id = vc.{item_col}
+            WHERE vc.visit_id=%s
+            """
+    return f"""
+            SELECT 'vc' AS src, vc.{item_col} AS item_code, vc.{qty_col} AS qty,
+                   NULL AS procedure_code, NULL AS procedure_id, NULL AS procedure_name
+            FROM visit_consumables vc
+            WHERE vc.visit_id=%s
+            """
 
 
-def _consume_items_from_procedures_if_needed(conn, visit_id: int) -> List[Dict[str, Any]]:
+def _procedure_consumables_select(cur) -> Optional[str]:
     """
     Fallback consumption derived from:
       visit_procedures + procedure_consumables
     This matches the workflow where consumables are tied to procedures.
-    Returns: [{ item_code, qty }]
     """
-    cur = _cursor(conn)
-    try:
-        if not _table_exists(cur, "visit_procedures"):
-            return []
-        if not _table_exists(cur, "procedure_consumables"):
-            return []
+    if not _table_exists(cur, "visit_procedures"):
+        return None
+    if not _table_exists(cur, "procedure_consumables"):
+        return None
 
-        # Columns vary; we handle common names:
-        # visit_procedures: (id, visit_id, procedure_code/procedure_id)
-        # procedure_consumables: (procedure_code/procedure_id, item_code, qty_used/qty)
-        vp_proc_col = None
-        for c in ("procedure_code", "procedure_id", "code"):
-            if _column_exists(cur, "visit_procedures", c):
-                vp_proc_col = c
-                break
-        pc_proc_col = None
-        for c in ("procedure_code", "procedure_id", "procedure_type", "code"):
-            if _column_exists(cur, "procedure_consumables", c):
-                pc_proc_col = c
-                break
-        if not vp_proc_col or not pc_proc_col:
-            return []
+    # Columns vary; we handle common names:
+    # visit_procedures: (id, visit_id, procedure_code/procedure_id)
+    # procedure_consumables: (procedure_code/procedure_id, item_code, qty_used/qty)
+    vp_proc_col = None
+    for c in ("procedure_code", "procedure_id", "code"):
+        if _column_exists(cur, "visit_procedures", c):
+            vp_proc_col = c
+            break
+    pc_proc_col = None
+    for c in ("procedure_code", "procedure_id", "procedure_type", "code"):
+        if _column_exists(cur, "procedure_consumables", c):
+            pc_proc_col = c
+            break
+    if not vp_proc_col or not pc_proc_col:
+        return None
 
-        pc_item_col = None
-        for c in ("item_code", "inventory_item_code", "inventory_item_id", "item_id"):
-            if _column_exists(cur, "procedure_consumables", c):
-                pc_item_col = c
-                break
-        if not pc_item_col:
-            return []
+    pc_item_col = None
+    for c in ("item_code", "inventory_item_code", "inventory_item_id", "item_id"):
+        if _column_exists(cur, "procedure_consumables", c):
+            pc_item_col = c
+            break
+    if not pc_item_col:
+        return None
 
-        qty_col = "qty_used" if _column_exists(cur, "procedure_consumables", "qty_used") else (
-            "qty" if _column_exists(cur, "procedure_consumables", "qty") else None
-        )
-        if not qty_col:
-            return []
+    qty_col = "qty_used" if _column_exists(cur, "procedure_consumables", "qty_used") else (
+        "qty" if _column_exists(cur, "procedure_consumables", "qty") else None
+    )
+    if not qty_col:
+        return None
 
-        item_expr = f"pc.{pc_item_col}"
-        item_join = ""
-        if pc_item_col in ("inventory_item_id", "item_id") and _table_exists(cur, "inventory_items") and _column_exists(cur, "inventory_items", "item_code"):
-            item_expr = "ii.item_code"
-            item_join = f" LEFT JOIN inventory_items ii ON ii.id = pc.{pc_item_col}"
+    item_expr = f"pc.{pc_item_col}"
+    item_join = ""
+    if pc_item_col in ("inventory_item_id", "item_id") and _table_exists(cur, "inventory_items") and _column_exists(cur, "inventory_items", "item_code"):
+        item_expr = "ii.item_code"
+        item_join = f" LEFT JOIN inventory_items ii ON ii.id = pc.{pc_item_col}"
 
-        cur.execute(
-            f"""
+    return f"""
             SELECT
+              'pc' AS src,
+              {item_expr} AS item_code,
+              SUM(pc.{qty_col}) AS qty,
               vp.{vp_proc_col} AS procedure_code,
               vp.id AS procedure_id,
-              {item_expr} AS item_code,
-              SUM(pc.{qty_col}) AS qty
+              NULL AS procedure_name
             FROM visit_procedures vp
             JOIN procedure_consumables pc
               ON pc.{pc_proc_col} = vp.{vp_proc_col}
             {item_join}
             WHERE vp.visit_id=%s
             GROUP BY vp.{vp_proc_col}, vp.id, {item_expr}
-            """,
-            (visit_id,),
-        )
-        rows = _rows_to_dicts(cur, cur.fetchall() or [])
-        out: List[Dict[str, Any]] = []
-        for r in rows:
-            code = str(r.get("item_code") or "").strip()
+            """
+
+
+def _visit_procedures_select(cur) -> Optional[str]:
+    """
+    Procedure rows for the final keyword fallback (_consume_items_from_default_mapping).
+    """
+    if not _table_exists(cur, "visit_procedures"):
+        return None
+
+    has_catalog = _table_exists(cur, "procedure_catalog") and _column_exists(cur, "procedure_catalog", "code")
+    name_col = "name" if has_catalog and _column_exists(cur, "procedure_catalog", "name") else None
+
+    if has_catalog and name_col:
+        return f"""
+            SELECT 'vp' AS src, NULL AS item_code, NULL AS qty,
+                   vp.procedure_code AS procedure_code, vp.id AS procedure_id, cat.{name_col} AS procedure_name
+            FROM visit_procedures vp
+            LEFT JOIN procedure_catalog cat ON cat.code = vp.procedure_code
+            WHERE vp.visit_id=%s
+            """
+    return """
+            SELECT 'vp' AS src, NULL AS item_code, NULL AS qty,
+                   vp.procedure_code AS procedure_code, vp.id AS procedure_id, vp.procedure_code AS procedure_name
+            FROM visit_procedures vp
+            WHERE vp.visit_id=%s
+            """
+
+
+def _visit_consumption_sql(cur, *, with_procedure_consumables: bool = True) -> Optional[str]:
+    """
+    UNION ALL of the visit-scoped consumption sources, built once from the cached schema.
+    Returns None when none of the source tables exist.
+    """
+    key = bool(with_procedure_consumables)
+    if key in _VISIT_CONSUMPTION_SQL:
+        return _VISIT_CONSUMPTION_SQL[key]
+    parts = [
+        _visit_consumables_select(cur),
+        _procedure_consumables_select(cur) if key else None,
+        _visit_procedures_select(cur),
+    ]
+    sql = " UNION ALL ".join(f"({p.strip()})" for p in parts if p) or None
+    _VISIT_CONSUMPTION_SQL[key] = sql
+    return sql
+
+
+def _load_visit_consumption(conn, visit_id: int, *, cur=None) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    One round-trip for every visit-scoped consumption source:
+      vc: visit_consumables              -> [{ item_code, qty }]
+      pc: visit_procedures + consumables -> [{ item_code, qty, procedure_code, procedure_id }]
+      vp: visit_procedures rows (procedure_code, procedure_id, procedure_name) for the keyword fallback
+    The caller picks the highest-priority non-empty source.
+    """
+    out: Dict[str, List[Dict[str, Any]]] = {"vc": [], "pc": [], "vp": []}
+    with _use_cursor(conn, cur) as cur:
+        sql = _visit_consumption_sql(cur)
+        if not sql:
+            return out
+        try:
+            cur.execute(sql, (visit_id,) * sql.count("%s"))
+        except Exception:
+            # procedure_consumables join is best-effort (mismatched column types); retry without it
+            fallback = _visit_consumption_sql(cur, with_procedure_consumables=False)
+            if not fallback or fallback == sql:
+                raise
+            cur.execute(fallback, (visit_id,) * fallback.count("%s"))
+
+        rows = _iter_rows(cur, "src", "item_code", "qty", "procedure_code", "procedure_id", "procedure_name")
+        for src, item_code, qty, procedure_code, procedure_id, procedure_name in rows:
+            src = _as_text(src)
+            if src == "vp":
+                out["vp"].append(
+                    {"procedure_code": procedure_code, "procedure_id": procedure_id, "procedure_name": procedure_name}
+                )
+                continue
+            code = str(item_code or "").strip()
             try:
-                qty_i = int(float(r.get("qty") or 0))
+                qty_i = _to_int(qty)
             except Exception:
                 qty_i = 0
-            if code and qty_i > 0:
-                out.append(
+            if not code or qty_i <= 0:
+                continue
+            if src == "vc":
+                out["vc"].append({"item_code": code, "qty": qty_i})
+            elif src == "pc":
+                out["pc"].append(
                     {
                         "item_code": code,
                         "qty": qty_i,
-                        "procedure_code": r.get("procedure_code"),
-                        "procedure_id": r.get("procedure_id"),
+                        "procedure_code": procedure_code,
+                        "procedure_id": procedure_id,
                     }
                 )
         return out
-    except Exception:
-        return []
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
+
+
+_STOCK_COLS: Optional[Tuple[Optional[str], Optional[str], Optional[str]]] = None
 
 
 def _get_inventory_stock_cols(cur) -> Tuple[Optional[str], Optional[str], Optional[str]]:
@@ -613,8 +1053,12 @@ def _get_inventory_stock_cols(cur) -> Tuple[Optional[str], Optional[str], Option
       inventory_items.stock
       inventory_items.reorder_threshold
       inventory_items.expiry_date
-    Keep safe fallbacks.
+    Keep safe fallbacks. Resolved once per schema load.
     """
+    global _STOCK_COLS
+    if _STOCK_COLS is not None:
+        return _STOCK_COLS
+
     stock_col = None
     for c in ("stock", "quantity_on_hand", "current_stock", "qty_on_hand"):
         if _column_exists(cur, "inventory_items", c):
@@ -628,7 +1072,8 @@ def _get_inventory_stock_cols(cur) -> Tuple[Optional[str], Optional[str], Option
     else:
         th_col = None
     exp_col = "expiry_date" if _column_exists(cur, "inventory_items", "expiry_date") else None
-    return stock_col, th_col, exp_col
+    _STOCK_COLS = (stock_col, th_col, exp_col)
+    return _STOCK_COLS
 
 
 def _pick_usage_source(cur) -> str:
@@ -644,49 +1089,126 @@ def _pick_usage_source(cur) -> str:
     return "AUTO"
 
 
-def _find_item_code_by_keywords(conn, keywords: List[str]) -> Optional[str]:
-    cur = _cursor(conn)
-    try:
-        if not _table_exists(cur, "inventory_items"):
-            return None
-        if not _column_exists(cur, "inventory_items", "item_code"):
-            return None
+ITEM_INDEX_TTL_SEC = 60
+_ITEM_INDEX_CACHE: Dict[int, Tuple[float, List[Tuple[str, str, str]]]] = {}  # id(conn) -> (expires, index)
+# keyword -> item_code (None = no match), valid for the lifetime of the cached index it was resolved against
+_ITEM_KW_MEMO: Dict[int, Tuple[float, Dict[str, Optional[str]]]] = {}
 
-        has_name = _column_exists(cur, "inventory_items", "name")
-        conds = []
-        params: List[Any] = []
-        for kw in keywords:
-            k = str(kw or "").strip().lower()
-            if not k:
-                continue
-            if has_name:
-                conds.append("(LOWER(item_code) LIKE %s OR LOWER(name) LIKE %s)")
-                params.extend([f"%{k}%", f"%{k}%"])
-            else:
-                conds.append("LOWER(item_code) LIKE %s")
-                params.append(f"%{k}%")
 
-        if not conds:
-            return None
+def _load_item_index(conn) -> List[Tuple[str, str, str]]:
+    """
+    (item_code, lower(item_code), lower(name)) for all inventory items, ordered by item_code.
+    One catalog read per connection every ITEM_INDEX_TTL_SEC instead of a LIKE scan per keyword.
+    """
+    key = id(conn)
+    now = time.monotonic()
+    hit = _ITEM_INDEX_CACHE.get(key)
+    if hit and hit[0] > now:
+        return hit[1]
 
-        cur.execute(
-            f"""
-            SELECT item_code
-            FROM inventory_items
-            WHERE {" OR ".join(conds)}
-            ORDER BY item_code ASC
-            LIMIT 1
-            """,
-            tuple(params),
-        )
-        row = _row_to_dict(cur, cur.fetchone())
-        return row.get("item_code") if row else None
+    index: List[Tuple[str, str, str]] = []
+    cur = _cursor(conn)
+    try:
+        if _table_exists(cur, "inventory_items") and _column_exists(cur, "inventory_items", "item_code"):
+            has_name = _column_exists(cur, "inventory_items", "name")
+            cur.execute(
+                f"""
+                SELECT item_code{', name' if has_name else ''}
+                FROM inventory_items
+                WHERE item_code IS NOT NULL
+                ORDER BY item_code ASC
+                """
+            )
+            for code, name in _iter_rows(cur, "item_code", "name"):
+                code = str(code or "")
+                if code:
+                    index.append((code, code.lower(), str(name or "").lower()))
     finally:
         try:
             cur.close()
         except Exception:
             pass
 
+    expires = now + ITEM_INDEX_TTL_SEC
+    _ITEM_INDEX_CACHE[key] = (expires, index)
+    _ITEM_KW_MEMO[key] = (expires, {})
+    return index
+
+
+def _find_item_codes_for_keywords(conn, keywords: List[str]) -> Dict[str, str]:
+    """
+    Resolve each keyword to the first item_code (by item_code order) whose code or name contains it.
+    One pass over the cached catalog for the whole batch; unmatched keywords are absent.
+    """
+    wanted = {str(kw or "").strip().lower() for kw in keywords}
+    wanted.discard("")
+    out: Dict[str, str] = {}
+    if not wanted:
+        return out
+
+    index = _load_item_index(conn)
+    memo = _ITEM_KW_MEMO[id(conn)][1]
+    remaining = set()
+    for k in wanted:
+        if k in memo:
+            if memo[k]:
+                out[k] = memo[k]
+        else:
+            remaining.add(k)
+    if not remaining:
+        return out
+
+    for k in remaining:
+        memo[k] = None
+    for code, lc_code, lc_name in index:
+        for k in [k for k in remaining if k in lc_code or k in lc_name]:
+            out[k] = memo[k] = code
+            remaining.discard(k)
+        if not remaining:
+            break
+    return out
+
+
+class InventorySchema:
+    """
+    Connection-scoped view over the process-wide schema cache.
+    Built once at pipeline entry; table/column/enum checks and the derived column
+    picks (stock cols, usage source, item catalog) are then plain lookups.
+    """
+
+    def __init__(self, conn, cur=None):
+        self._conn = conn
+        with _use_cursor(conn, cur) as c:
+            self._schema = load_schema(c)
+            self._stock_cols = _get_inventory_stock_cols(c)
+            self._usage_source = _pick_usage_source(c)
+
+    def _columns(self, table: str) -> Dict[str, str]:
+        return self._schema.get(table.lower(), {})
+
+    def has_table(self, name: str) -> bool:
+        return name.lower() in self._schema
+
+    def has_column(self, table: str, col: str) -> bool:
+        return col.lower() in self._columns(table)
+
+    def enum_values(self, table: str, col: str) -> List[str]:
+        return _enum_values_of(table, col, self._columns(table).get(col.lower()))
+
+    def stock_cols(self) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        return self._stock_cols
+
+    def usage_source(self) -> str:
+        return self._usage_source
+
+    def item_catalog(self) -> List[Tuple[str, str, str]]:
+        return _load_item_index(self._conn)
+
+    @staticmethod
+    def invalidate() -> None:
+        """Drop cached schema (call after migrations)."""
+        schema_cache_clear()
+
 
 def _get_appointment_info(conn, appointment_id: int) -> Optional[Dict[str, Any]]:
     cur = _cursor(conn)
@@ -713,71 +1235,42 @@ def _get_appointment_info(conn, appointment_id: int) -> Optional[Dict[str, Any]]
             pass
 
 
-def _consume_items_from_default_mapping(conn, visit_id: int) -> List[Dict[str, Any]]:
+def _consume_items_from_default_mapping(conn, proc_rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """
     Final fallback: map procedure keywords to default consumables.
     Only deducts if matching inventory item_code exists.
+    proc_rows: the "vp" rows from _load_visit_consumption.
     """
-    cur = _cursor(conn)
-    try:
-        if not _table_exists(cur, "visit_procedures"):
-            return []
-
-        has_catalog = _table_exists(cur, "procedure_catalog") and _column_exists(cur, "procedure_catalog", "code")
-        name_col = "name" if has_catalog and _column_exists(cur, "procedure_catalog", "name") else None
+    totals: Dict[Tuple[str, Optional[str], Optional[int]], int] = {}
+
+    matched = []
+    for r in proc_rows or []:
+        proc_text = f"{r.get('procedure_code') or ''} {r.get('procedure_name') or ''}"
+        defaults = _match_procedure_defaults(proc_text)
+        if defaults:
+            matched.append((r, defaults))
+
+    codes = _find_item_codes_for_keywords(conn, [kw for _, defaults in matched for kw, _ in defaults])
+    for r, defaults in matched:
+        for kw, qty in defaults:
+            code = codes.get(kw.lower())
+            if not code:
+                continue
+            key = (code, r.get("procedure_code"), r.get("procedure_id"))
+            totals[key] = totals.get(key, 0) + int(qty)
 
-        if has_catalog and name_col:
-            cur.execute(
-                f"""
-                SELECT vp.id AS procedure_id, vp.procedure_code AS procedure_code, pc.{name_col} AS procedure_name
-                FROM visit_procedures vp
-                LEFT JOIN procedure_catalog pc ON pc.code = vp.procedure_code
-                WHERE vp.visit_id=%s
-                """,
-                (visit_id,),
-            )
-        else:
-            cur.execute(
-                """
-                SELECT id AS procedure_id, procedure_code AS procedure_code, procedure_code AS procedure_name
-                FROM visit_procedures
-                WHERE visit_id=%s
-                """,
-                (visit_id,),
+    out: List[Dict[str, Any]] = []
+    for (item_code, procedure_code, procedure_id), qty in totals.items():
+        if qty > 0:
+            out.append(
+                {
+                    "item_code": item_code,
+                    "qty": qty,
+                    "procedure_code": procedure_code,
+                    "procedure_id": procedure_id,
+                }
             )
-
-        rows = _rows_to_dicts(cur, cur.fetchall() or [])
-        totals: Dict[Tuple[str, Optional[str], Optional[int]], int] = {}
-
-        for r in rows:
-            proc_text = f"{r.get('procedure_code') or ''} {r.get('procedure_name') or ''}"
-            defaults = _match_procedure_defaults(proc_text)
-            if not defaults:
-                continue
-            for kw, qty in defaults:
-                code = _find_item_code_by_keywords(conn, [kw])
-                if not code:
-                    continue
-                key = (code, r.get("procedure_code"), r.get("procedure_id"))
-                totals[key] = totals.get(key, 0) + int(qty)
-
-        out: List[Dict[str, Any]] = []
-        for (item_code, procedure_code, procedure_id), qty in totals.items():
-            if qty > 0:
-                out.append(
-                    {
-                        "item_code": item_code,
-                        "qty": qty,
-                        "procedure_code": procedure_code,
-                        "procedure_id": procedure_id,
-                    }
-                )
-        return out
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
+    return out
 
 
 def _consume_items_from_appointment_type(conn, appointment_id: int) -> List[Dict[str, Any]]:
@@ -796,12 +1289,15 @@ def _consume_items_from_appointment_type(conn, appointment_id: int) -> List[Dict
     if not hay:
         return []
 
+    rule_idxs = _matched_rule_indices(hay)
+    codes = _find_item_codes_for_keywords(
+        conn, [item_kw for idx in rule_idxs for item_kw, _ in DEFAULT_PROCEDURE_CONSUMABLES[idx][1]]
+    )
+
     out: List[Dict[str, Any]] = []
-    for proc_keywords, items in DEFAULT_PROCEDURE_CONSUMABLES:
-        if not any(k in hay for k in proc_keywords):
-            continue
-        for (item_kw, qty) in items:
-            code = _find_item_code_by_keywords(conn, [item_kw])
+    for idx in rule_idxs:
+        for (item_kw, qty) in DEFAULT_PROCEDURE_CONSUMABLES[idx][1]:
+            code = codes.get(item_kw.lower())
             if not code:
                 continue
             out.append(
@@ -818,212 +1314,353 @@ def _consume_items_from_appointment_type(conn, appointment_id: int) -> List[Dict
 def _match_procedure_defaults(proc_text: str) -> List[Tuple[str, int]]:
     s = str(proc_text or "").lower()
     out: List[Tuple[str, int]] = []
-    for keys, items in DEFAULT_PROCEDURE_CONSUMABLES:
-        if any(k in s for k in keys):
-            out.extend(items)
+    for idx in _matched_rule_indices(s):
+        out.extend(DEFAULT_PROCEDURE_CONSUMABLES[idx][1])
     return out
 
 
-def _record_usage_daily(
-    conn,
-    *,
-    usage_date: date,
-    doctor_id: Optional[int],
-    procedure_code: Optional[str],
-    item_code: str,
-    qty: int,
-) -> None:
-    cur = _cursor(conn)
-    try:
+def _record_usage_daily_many(conn, rows: List[Dict[str, Any]], *, cur=None) -> None:
+    """
+    Batched inventory_usage_daily upsert.
+    rows: [{ usage_date, doctor_id, procedure_code, item_code, qty }]
+    Rows sharing the same optional columns go out as one multi-VALUES statement.
+    """
+    if not rows:
+        return
+    with _use_cursor(conn, cur) as cur:
         if not _table_exists(cur, "inventory_usage_daily"):
             return
 
-        cols = ["usage_date", "item_code", "qty_used"]
-        vals: List[Any] = [usage_date.strftime("%Y-%m-%d"), item_code, int(qty)]
+        has_doctor = _column_exists(cur, "inventory_usage_daily", "doctor_id")
+        has_proc = _column_exists(cur, "inventory_usage_daily", "procedure_code")
+        now_cols = ("updated_at",) if _column_exists(cur, "inventory_usage_daily", "updated_at") else ()
+
+        groups: Dict[Tuple[str, ...], List[List[Any]]] = {}
+        for r in rows:
+            cols = ["usage_date", "item_code", "qty_used"]
+            vals: List[Any] = [r["usage_date"], r["item_code"], int(r["qty"])]
+
+            doctor_id = r.get("doctor_id")
+            procedure_code = r.get("procedure_code")
+            if doctor_id and has_doctor:
+                cols.append("doctor_id")
+                vals.append(int(doctor_id))
+            if procedure_code and has_proc:
+                cols.append("procedure_code")
+                vals.append(str(procedure_code)[:64])
+            groups.setdefault(tuple(cols), []).append(vals)
+
+        for cols, vals_list in groups.items():
+            params: List[Any] = []
+            for vals in vals_list:
+                params.extend(vals)
+
+            # upsert by unique key
+            cur.execute(
+                _insert_sql(
+                    "inventory_usage_daily",
+                    cols,
+                    len(vals_list),
+                    "ON DUPLICATE KEY UPDATE qty_used = qty_used + VALUES(qty_used)",
+                    now_cols,
+                ),
+                tuple(params),
+            )
+
+
+AVG_USAGE_TTL_SEC = 300
+_AVG_CACHE: Dict[Tuple[int, str], Tuple[float, float]] = {}  # (doctor_id, item_code) -> (avg_qty, expires)
 
-        if doctor_id and _column_exists(cur, "inventory_usage_daily", "doctor_id"):
-            cols.append("doctor_id")
-            vals.append(int(doctor_id))
-        if procedure_code and _column_exists(cur, "inventory_usage_daily", "procedure_code"):
-            cols.append("procedure_code")
-            vals.append(str(procedure_code)[:64])
 
-        if _column_exists(cur, "inventory_usage_daily", "updated_at"):
-            cols.append("updated_at")
-            vals.append(datetime.now(tz=IST).strftime("%Y-%m-%d %H:%M:%S"))
+def _get_avg_usage_30d(conn, doctor_id: int, item_codes: List[str], *, cur=None) -> Dict[str, float]:
+    """
+    30-day average qty_used per item_code for one doctor, in a single grouped query.
+    Averages are cached per (doctor, item) for AVG_USAGE_TTL_SEC; only misses hit the DB.
+    Items with no usage in the window map to 0.0 (or are absent if the table is missing).
+    """
+    codes = sorted({str(c) for c in item_codes if c})
+    if not codes:
+        return {}
 
-        placeholders = ", ".join(["%s"] * len(cols))
-        col_sql = ", ".join(cols)
+    now = time.monotonic()
+    out: Dict[str, float] = {}
+    misses: List[str] = []
+    for code in codes:
+        hit = _AVG_CACHE.get((int(doctor_id), code))
+        if hit and hit[1] > now:
+            out[code] = hit[0]
+        else:
+            misses.append(code)
+    if not misses:
+        return out
+
+    with _use_cursor(conn, cur) as cur:
+        if not _table_exists(cur, "inventory_usage_logs"):
+            return out
+        if not _column_exists(cur, "inventory_usage_logs", "doctor_id"):
+            return out
+        if not _column_exists(cur, "inventory_usage_logs", "item_code"):
+            return out
 
-        # upsert by unique key
         cur.execute(
             f"""
-            INSERT INTO inventory_usage_daily ({col_sql})
-            VALUES ({placeholders})
-            ON DUPLICATE KEY UPDATE qty_used = qty_used + VALUES(qty_used)
+            SELECT item_code, AVG(qty_used) AS avg_qty
+            FROM inventory_usage_logs
+            WHERE doctor_id=%s
+              AND item_code IN ({", ".join(["%s"] * len(misses))})
+              AND created_at >= DATE_SUB(NOW(), INTERVAL 30 DAY)
+            GROUP BY item_code
             """,
-            tuple(vals),
+            (int(doctor_id), *misses),
         )
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
+        fetched = {str(code): float(avg_qty or 0) for code, avg_qty in _iter_rows(cur, "item_code", "avg_qty")}
+
+    expires = now + AVG_USAGE_TTL_SEC
+    for code in misses:
+        avg_qty = fetched.get(code, 0.0)
+        _AVG_CACHE[(int(doctor_id), code)] = (avg_qty, expires)
+        out[code] = avg_qty
+    return out
 
 
-def _check_usage_anomaly(
+def _check_usage_anomalies(
     conn,
     *,
     doctor_id: Optional[int],
-    item_code: str,
-    qty: int,
-    procedure_code: Optional[str],
+    lines: List[Dict[str, Any]],
     appointment_id: int,
     visit_id: int,
+    cur=None,
 ) -> None:
-    if qty < ANOMALY_MIN_QTY:
-        return
+    """
+    lines: [{ item_code, qty, procedure_code }] consumed for one visit.
+    Flags lines above ANOMALY_MULTIPLIER x the doctor's 30-day average.
+    """
     if not doctor_id:
         return
+    lines = [ln for ln in lines if int(ln.get("qty") or 0) >= ANOMALY_MIN_QTY]
+    if not lines:
+        return
 
-    cur = _cursor(conn)
-    try:
-        if not _table_exists(cur, "inventory_usage_logs"):
-            return
-        if not _column_exists(cur, "inventory_usage_logs", "doctor_id"):
-            return
-        if not _column_exists(cur, "inventory_usage_logs", "item_code"):
-            return
+    avgs = _get_avg_usage_30d(conn, int(doctor_id), [ln["item_code"] for ln in lines], cur=cur)
+    if not avgs:
+        return
 
-        cur.execute(
-            """
-            SELECT AVG(qty_used) AS avg_qty
-            FROM inventory_usage_logs
-            WHERE doctor_id=%s
-              AND item_code=%s
-              AND created_at >= DATE_SUB(NOW(), INTERVAL 30 DAY)
-            """,
-            (int(doctor_id), str(item_code)),
+    anomalies: List[Tuple[Dict[str, Any], float]] = []
+    for ln in lines:
+        avg_qty = avgs.get(str(ln["item_code"]), 0.0)
+        if avg_qty > 0 and int(ln["qty"]) > avg_qty * ANOMALY_MULTIPLIER:
+            anomalies.append((ln, avg_qty))
+    if not anomalies:
+        return
+
+    for ln, avg_qty in anomalies:
+        item_code, qty = ln["item_code"], int(ln["qty"])
+        msg = (
+            f"Usage anomaly: doctor {doctor_id} used {qty}x {item_code} "
+            f"(avg {avg_qty:.2f} over 30d)."
+        )
+        create_notification(
+            user_id=None,
+            user_role="Admin",
+            title="Inventory anomaly",
+            message=msg,
+            notif_type="INVENTORY_ANOMALY",
+            related_table="inventory_usage_logs",
+            related_id=None,
+            status="PENDING",
+            priority=200,
+            dedupe_key=f"inventory_anomaly:{doctor_id}:{item_code}:{appointment_id}:{qty}",
+            meta={
+                "doctor_id": doctor_id,
+                "item_code": item_code,
+                "qty": qty,
+                "avg_30d": avg_qty,
+                "procedure_code": ln.get("procedure_code"),
+                "appointment_id": appointment_id,
+                "visit_id": visit_id,
+            },
+            conn=conn,
         )
-        row = _row_to_dict(cur, cur.fetchone())
-        avg_qty = float(row.get("avg_qty") or 0) if row else 0
-        if avg_qty <= 0:
-            return
 
-        if qty > avg_qty * ANOMALY_MULTIPLIER:
-            msg = (
-                f"Usage anomaly: doctor {doctor_id} used {qty}x {item_code} "
-                f"(avg {avg_qty:.2f} over 30d)."
-            )
-            create_notification(
-                user_id=None,
-                user_role="Admin",
-                title="Inventory anomaly",
-                message=msg,
-                notif_type="INVENTORY_ANOMALY",
-                related_table="inventory_usage_logs",
-                related_id=None,
-                status="PENDING",
-                priority=200,
-                dedupe_key=f"inventory_anomaly:{doctor_id}:{item_code}:{appointment_id}:{qty}",
-                meta={
-                    "doctor_id": doctor_id,
-                    "item_code": item_code,
-                    "qty": qty,
-                    "avg_30d": avg_qty,
-                    "procedure_code": procedure_code,
-                    "appointment_id": appointment_id,
-                    "visit_id": visit_id,
-                },
-                conn=conn,
+    with _use_cursor(conn, cur) as cur:
+        if _table_exists(cur, "inventory_anomaly_logs"):
+            cur.executemany(
+                """
+                INSERT INTO inventory_anomaly_logs (doctor_id, item_code, qty, avg_30d, appointment_id, visit_id, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, NOW())
+                """,
+                [
+                    (int(doctor_id), ln["item_code"], int(ln["qty"]), float(avg_qty), int(appointment_id), int(visit_id))
+                    for ln, avg_qty in anomalies
+                ],
             )
 
-            if _table_exists(cur, "inventory_anomaly_logs"):
-                cur.execute(
-                    """
-                    INSERT INTO inventory_anomaly_logs (doctor_id, item_code, qty, avg_30d, appointment_id, visit_id, created_at)
-                    VALUES (%s, %s, %s, %s, %s, %s, NOW())
-                    """,
-                    (int(doctor_id), item_code, int(qty), float(avg_qty), int(appointment_id), int(visit_id)),
-                )
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
-
 
-def _set_item_status(conn, item_id: int, status: str) -> None:
-    cur = _cursor(conn)
-    try:
+def _set_items_status(conn, ids_by_status: Dict[str, List[int]]) -> None:
+    """One UPDATE ... WHERE id IN (...) per status bucket."""
+    with _shared_cursor(conn) as cur:
         if not _table_exists(cur, "inventory_items"):
             return
         if not _column_exists(cur, "inventory_items", "status"):
             return
-        cur.execute("UPDATE inventory_items SET status=%s, updated_at=NOW() WHERE id=%s", (status, int(item_id)))
-    finally:
+        for status, ids in ids_by_status.items():
+            ids = sorted({int(i) for i in ids if i})
+            if not ids:
+                continue
+            cur.execute(
+                f"UPDATE inventory_items SET status=%s, updated_at=NOW() WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                (status, *ids),
+            )
+
+
+# dedupe keys this process has emitted *and committed*: key -> monotonic time of the commit.
+# Only short-circuits keys create_notification's idempotency_locks row would reject anyway.
+# Keys written on the event transaction wait on the connection (_EMITTED_PENDING_ATTR)
+# until InventoryAgent.handle commits; a rollback discards them so the retry re-sends.
+_EMITTED: "OrderedDict[str, float]" = OrderedDict()
+_EMITTED_MAX = 4096
+_EMITTED_TTL_SEC = 7200.0
+_EMITTED_LOCK = threading.Lock()
+_EMITTED_PENDING_ATTR = "_inventory_emitted_pending"
+
+
+def _recently_emitted(dedupe_key: str, now: float) -> bool:
+    # caller holds _EMITTED_LOCK
+    seen = _EMITTED.get(dedupe_key)
+    if seen is not None and now - seen < _EMITTED_TTL_SEC:
+        _EMITTED.move_to_end(dedupe_key)
+        return True
+    return False
+
+
+def _mark_emitted(keys: List[str]) -> None:
+    if not keys:
+        return
+    now = time.monotonic()
+    with _EMITTED_LOCK:
+        for k in keys:
+            _EMITTED[k] = now
+            _EMITTED.move_to_end(k)
+        while len(_EMITTED) > _EMITTED_MAX:
+            _EMITTED.popitem(last=False)
+
+
+def _pending_emitted(conn) -> List[str]:
+    pending = getattr(conn, _EMITTED_PENDING_ATTR, None)
+    if pending is None:
+        pending = []
         try:
-            cur.close()
+            setattr(conn, _EMITTED_PENDING_ATTR, pending)
         except Exception:
             pass
+    return pending
 
 
-def _emit_low_stock_notification(
-    conn,
+def _settle_emitted(conn, committed: bool) -> None:
+    """Promote (after commit) or drop (after rollback) the keys pending on `conn`."""
+    pending = getattr(conn, _EMITTED_PENDING_ATTR, None)
+    if not pending:
+        return
+    keys = list(pending)
+    pending.clear()
+    if committed:
+        _mark_emitted(keys)
+
+
+def _emit_many(conn, rows: List[Dict[str, Any]]) -> None:
+    """
+    Send create_notification kwargs rows (each with a dedupe_key), skipping keys this
+    process committed recently. Several rows go out through one create_notifications batch.
+    """
+    now = time.monotonic()
+    with _EMITTED_LOCK:
+        rows = [r for r in rows if not _recently_emitted(r["dedupe_key"], now)]
+    if not rows:
+        return
+    if NOTIFY_ASYNC:
+        # the writer thread marks these keys once its own batch commits
+        for r in rows:
+            _enqueue_write(_CREATE_NOTIFICATION, (), r)
+        return
+    if len(rows) == 1:
+        create_notification(conn=conn, **rows[0])
+    else:
+        create_notifications(rows, conn=conn)
+    _pending_emitted(conn).extend(r["dedupe_key"] for r in rows)
+
+
+# %-templates for per-row alert/notification text (daily checks format hundreds per tick)
+_LOW_TITLE = "Low stock: %s"
+_LOW_NOTIF_MSG = "%s is low (stock %d, threshold %d)."
+_LOW_ALERT_MSG = "%s low: stock %d, threshold %d"
+_EXPIRING_TITLE = "Expiring soon: %s"
+_EXPIRING_NOTIF_MSG = "%s is expiring on %s."
+_EXPIRING_ALERT_MSG = "%s expiring on %s"
+_EXPIRED_TITLE = "Expired: %s"
+_EXPIRED_NOTIF_MSG = "%s expired on %s. Please remove or reconcile stock."
+_EXPIRED_ALERT_MSG = "%s expired on %s"
+_NEGATIVE_NOTIF_MSG = "%s has negative stock (%d). Please reconcile."
+_NEGATIVE_ALERT_MSG = "%s negative stock: %d"
+
+
+def _low_stock_notifications(
     *,
     item_id: int,
     item_name: str,
     stock: int,
     threshold: int,
     doctor_id: Optional[int] = None,
-) -> None:
-    dedupe_key = f"low_stock:{int(item_id)}:{int(threshold)}"
-    msg = f"{item_name} is low (stock {stock}, threshold {threshold})."
+) -> List[Dict[str, Any]]:
+    dedupe_key = "low_stock:%d:%d" % (int(item_id), int(threshold))
+    msg = _LOW_NOTIF_MSG % (item_name, stock, threshold)
+    title = _LOW_TITLE % item_name
     meta = {"stock": stock, "threshold": threshold, "item_id": item_id}
 
-    create_notification(
-        user_id=None,
-        user_role="Admin",
-        title=f"Low stock: {item_name}",
-        message=msg,
-        notif_type="INVENTORY_LOW_STOCK",
-        related_table="inventory_items",
-        related_id=item_id,
-        status="PENDING",
-        priority=120,
-        dedupe_key=dedupe_key,
-        meta=meta,
-        conn=conn,
-    )
-
-    if doctor_id:
-        create_notification(
-            user_id=int(doctor_id),
-            title=f"Low stock: {item_name}",
+    out: List[Dict[str, Any]] = [
+        dict(
+            dedupe_key=dedupe_key,
+            user_id=None,
+            user_role="Admin",
+            title=title,
             message=msg,
             notif_type="INVENTORY_LOW_STOCK",
             related_table="inventory_items",
             related_id=item_id,
             status="PENDING",
-            priority=110,
-            dedupe_key=f"{dedupe_key}:doctor:{int(doctor_id)}",
+            priority=120,
             meta=meta,
-            conn=conn,
         )
+    ]
+    if doctor_id:
+        out.append(
+            dict(
+                dedupe_key="%s:doctor:%d" % (dedupe_key, int(doctor_id)),
+                user_id=int(doctor_id),
+                title=title,
+                message=msg,
+                notif_type="INVENTORY_LOW_STOCK",
+                related_table="inventory_items",
+                related_id=item_id,
+                status="PENDING",
+                priority=110,
+                meta=meta,
+            )
+        )
+    return out
 
 
-def _emit_expiry_notification(
-    conn,
+def _expiry_notification(
     *,
     item_id: int,
-    item_name: str,
     expiry: Optional[str],
     notif_type: str,
     title: str,
     message: str,
     dedupe_key: str,
-) -> None:
-    create_notification(
+) -> Dict[str, Any]:
+    return dict(
+        dedupe_key=dedupe_key,
         user_id=None,
         user_role="Admin",
         title=title,
@@ -1033,50 +1670,152 @@ def _emit_expiry_notification(
         related_id=item_id,
         status="PENDING",
         priority=130,
-        dedupe_key=dedupe_key,
         meta={"item_id": item_id, "expiry": expiry},
-        conn=conn,
     )
 
 
+def _emit_low_stock_notification(conn, **kwargs: Any) -> None:
+    _emit_many(conn, _low_stock_notifications(**kwargs))
+
+
+def _emit_expiry_notification(conn, *, item_name: str, **kwargs: Any) -> None:
+    _emit_many(conn, [_expiry_notification(**kwargs)])
+
+
+_LOCK_PLAN: Optional[Tuple[Optional[str], bool]] = None
+
+
+def _lock_insert_plan(cur) -> Tuple[Optional[str], bool]:
+    """
+    (sql, has_locked_by) for the idempotency_locks upsert, built once per schema load.
+    sql is None when the lock table isn't usable. A duplicate key leaves the row untouched
+    (rowcount 0) unless its expires_at has already passed, in which case the hold is renewed.
+    """
+    global _LOCK_PLAN
+    if _LOCK_PLAN is not None:
+        return _LOCK_PLAN
+
+    if not (_table_exists(cur, "idempotency_locks") and _column_exists(cur, "idempotency_locks", "lock_key")):
+        _LOCK_PLAN = (None, False)
+        return _LOCK_PLAN
+
+    has_locked_by = _column_exists(cur, "idempotency_locks", "locked_by")
+    cols = ["lock_key"]
+    vals = ["%s"]
+    if has_locked_by:
+        cols.append("locked_by")
+        vals.append("%s")
+    if _column_exists(cur, "idempotency_locks", "expires_at"):
+        cols.append("expires_at")
+        vals.append("DATE_ADD(NOW(), INTERVAL 24 HOUR)")
+        on_dup = "expires_at=IF(expires_at < NOW(), VALUES(expires_at), expires_at)"
+    else:
+        on_dup = "lock_key=lock_key"
+    if _column_exists(cur, "idempotency_locks", "created_at"):
+        cols.append("created_at")
+        vals.append("NOW()")
+
+    sql = (
+        f"INSERT INTO idempotency_locks ({', '.join(cols)}) VALUES ({', '.join(vals)}) "
+        f"ON DUPLICATE KEY UPDATE {on_dup}"
+    )
+    _LOCK_PLAN = (sql, has_locked_by)
+    return _LOCK_PLAN
+
+
 def _try_lock(conn, lock_key: str) -> bool:
-    cur = _cursor(conn)
-    try:
-        if not _table_exists(cur, "idempotency_locks"):
-            return True
-        if not _column_exists(cur, "idempotency_locks", "lock_key"):
+    """
+    Single-statement dedupe on idempotency_locks: True when the key was newly claimed
+    (or its previous hold had expired), False while another live hold exists.
+    """
+    with _shared_cursor(conn) as cur:
+        try:
+            sql, has_locked_by = _lock_insert_plan(cur)
+            if sql is None:
+                return True
+            params = (lock_key[:190], "inventory_agent") if has_locked_by else (lock_key[:190],)
+            # 1 = inserted, 2 = expired hold renewed, 0 = live duplicate
+            return execute_prepared_rowcount(conn, sql, params) in (1, 2)
+        except Exception as e:
+            # Don't block PO drafts if the lock table misbehaves.
+            log.warning("lock insert failed for %s: %s", lock_key, e)
             return True
 
-        cols = ["lock_key"]
-        vals = [lock_key[:190]]
 
-        if _column_exists(cur, "idempotency_locks", "locked_by"):
-            cols.append("locked_by")
-            vals.append("inventory_agent")
-        if _column_exists(cur, "idempotency_locks", "expires_at"):
-            cols.append("expires_at")
-            vals.append((datetime.now(tz=IST) + timedelta(hours=24)).strftime("%Y-%m-%d %H:%M:%S"))
-        if _column_exists(cur, "idempotency_locks", "created_at"):
-            cols.append("created_at")
-            vals.append(datetime.now(tz=IST).strftime("%Y-%m-%d %H:%M:%S"))
+_PO_PLAN: Optional[Tuple[Tuple[Any, ...], Tuple[Any, ...]]] = None
 
-        cur.execute(
-            f"INSERT INTO idempotency_locks ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))})",
-            tuple(vals),
-        )
-        return True
-    except Exception as e:
-        # Don't block PO drafts if the lock insert fails for any reason.
-        try:
-            print(f"[inventory_agent] lock insert failed for {lock_key}: {e}", flush=True)
-        except Exception:
-            pass
-        return True
-    finally:
+
+def _po_insert_plan(cur) -> Tuple[Tuple[Any, ...], Tuple[Any, ...]]:
+    """
+    Insert plans for purchase_orders and purchase_order_items, built once per schema load:
+      ((po_cols, po_now_cols, build(vendor_id)), (item_cols, item_now_cols, build(po_id, item_code, threshold)))
+    created_at/updated_at are filled with NOW().
+    """
+    global _PO_PLAN
+    if _PO_PLAN is not None:
+        return _PO_PLAN
+
+    po: List[Tuple[str, Any]] = []
+    if _column_exists(cur, "purchase_orders", "vendor_id"):
+        po.append(("vendor_id", lambda vendor_id: int(vendor_id)))
+    if _column_exists(cur, "purchase_orders", "status"):
+        status_val = "DRAFT"
+        for v in _get_enum_values(cur, "purchase_orders", "status"):
+            if v.upper() in ("DRAFT", "REQUESTED"):
+                status_val = v
+                break
+        po.append(("status", lambda vendor_id, _v=status_val: _v))
+    if _column_exists(cur, "purchase_orders", "notes"):
+        po.append(("notes", lambda vendor_id: "Auto-draft from low stock"))
+    po_now = tuple(c for c in ("created_at", "updated_at") if _column_exists(cur, "purchase_orders", c))
+
+    item: List[Tuple[str, Any]] = []
+    if _column_exists(cur, "purchase_order_items", "purchase_order_id"):
+        item.append(("purchase_order_id", lambda po_id, item_code, threshold: po_id))
+    if _column_exists(cur, "purchase_order_items", "item_code"):
+        item.append(("item_code", lambda po_id, item_code, threshold: item_code))
+    if _column_exists(cur, "purchase_order_items", "qty"):
+        item.append(("qty", lambda po_id, item_code, threshold: int(max(1, threshold * 2))))
+    item_now = ("created_at",) if item and _column_exists(cur, "purchase_order_items", "created_at") else ()
+
+    po_exts = tuple(e for _, e in po)
+    item_exts = tuple(e for _, e in item)
+    _PO_PLAN = (
+        (tuple(c for c, _ in po), po_now, lambda vendor_id: tuple(e(vendor_id) for e in po_exts)),
+        (
+            tuple(c for c, _ in item),
+            item_now,
+            lambda po_id, item_code, threshold: tuple(e(po_id, item_code, threshold) for e in item_exts),
+        ),
+    )
+    return _PO_PLAN
+
+
+VENDOR_CONTACT_TTL_SEC = 300
+_VENDOR_CONTACT: Dict[int, Tuple[Optional[str], Optional[str], float]] = {}  # vendor_id -> (email, phone, expires)
+
+
+def _vendor_contact(cur, vendor_id: Optional[int]) -> Tuple[Optional[str], Optional[str]]:
+    """(email, phone) for a vendor, cached per process for VENDOR_CONTACT_TTL_SEC."""
+    if not vendor_id:
+        return (None, None)
+    now = time.monotonic()
+    hit = _VENDOR_CONTACT.get(int(vendor_id))
+    if hit and hit[2] > now:
+        return (hit[0], hit[1])
+
+    email = phone = None
+    if _table_exists(cur, "vendors"):
         try:
-            cur.close()
+            cur.execute("SELECT email, phone FROM vendors WHERE id=%s LIMIT 1", (int(vendor_id),))
+            vr = _row_to_dict(cur, cur.fetchone())
+            if vr:
+                email = vr.get("email")
+                phone = vr.get("phone")
         except Exception:
-            pass
+            return (None, None)
+    _VENDOR_CONTACT[int(vendor_id)] = (email, phone, now + VENDOR_CONTACT_TTL_SEC)
+    return (email, phone)
 
 
 def _maybe_create_po_draft(
@@ -1088,117 +1827,54 @@ def _maybe_create_po_draft(
     threshold: int,
 ) -> None:
     if not _env_flag("INVENTORY_PO_AUTO"):
-        try:
-            print(f"[inventory_agent] PO auto disabled (item_id={item_id})", flush=True)
-        except Exception:
-            pass
+        log.debug("PO auto disabled (item_id=%s)", item_id)
         return
     if not vendor_id or not item_code:
-        try:
-            print(
-                f"[inventory_agent] PO skipped: vendor_id/item_code missing (item_id={item_id}, vendor_id={vendor_id}, item_code={item_code})",
-                flush=True,
-            )
-        except Exception:
-            pass
+        log.debug(
+            "PO skipped: vendor_id/item_code missing (item_id=%s, vendor_id=%s, item_code=%s)",
+            item_id,
+            vendor_id,
+            item_code,
+        )
         return
 
     if not _try_lock(conn, f"po_draft:{item_id}:{threshold}"):
         return
 
-    cur = _cursor(conn)
-    try:
+    with _shared_cursor(conn) as cur:
         if not _table_exists(cur, "purchase_orders") or not _table_exists(cur, "purchase_order_items"):
-            try:
-                print(
-                    f"[inventory_agent] PO skipped: tables missing (purchase_orders={_table_exists(cur, 'purchase_orders')}, purchase_order_items={_table_exists(cur, 'purchase_order_items')})",
-                    flush=True,
-                )
-            except Exception:
-                pass
+            log.debug(
+                "PO skipped: tables missing (purchase_orders=%s, purchase_order_items=%s)",
+                _table_exists(cur, "purchase_orders"),
+                _table_exists(cur, "purchase_order_items"),
+            )
             return
 
-        cols = []
-        vals = []
-
-        if _column_exists(cur, "purchase_orders", "vendor_id"):
-            cols.append("vendor_id")
-            vals.append(int(vendor_id))
-        if _column_exists(cur, "purchase_orders", "status"):
-            enums = _get_enum_values(cur, "purchase_orders", "status")
-            status_val = "DRAFT"
-            for v in enums:
-                if v.upper() in ("DRAFT", "REQUESTED"):
-                    status_val = v
-                    break
-            cols.append("status")
-            vals.append(status_val)
-        if _column_exists(cur, "purchase_orders", "notes"):
-            cols.append("notes")
-            vals.append("Auto-draft from low stock")
-        if _column_exists(cur, "purchase_orders", "created_at"):
-            cols.append("created_at")
-            vals.append(datetime.now(tz=IST).strftime("%Y-%m-%d %H:%M:%S"))
-        if _column_exists(cur, "purchase_orders", "updated_at"):
-            cols.append("updated_at")
-            vals.append(datetime.now(tz=IST).strftime("%Y-%m-%d %H:%M:%S"))
-
-        if not cols:
-            try:
-                print("[inventory_agent] PO skipped: no writable columns on purchase_orders", flush=True)
-            except Exception:
-                pass
+        po_plan, item_plan = _po_insert_plan(cur)
+        po_cols, po_now_cols, build_po = po_plan
+        if not po_cols and not po_now_cols:
+            log.debug("PO skipped: no writable columns on purchase_orders")
             return
 
         cur.execute(
-            f"INSERT INTO purchase_orders ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))})",
-            tuple(vals),
+            _insert_sql("purchase_orders", po_cols, now_cols=po_now_cols),
+            build_po(vendor_id),
         )
         po_id = int(cur.lastrowid or 0)
         if po_id <= 0:
-            try:
-                print("[inventory_agent] PO skipped: insert returned no id", flush=True)
-            except Exception:
-                pass
+            log.warning("PO skipped: insert returned no id")
             return
 
-        item_cols = []
-        item_vals = []
-        if _column_exists(cur, "purchase_order_items", "purchase_order_id"):
-            item_cols.append("purchase_order_id")
-            item_vals.append(po_id)
-        if _column_exists(cur, "purchase_order_items", "item_code"):
-            item_cols.append("item_code")
-            item_vals.append(item_code)
-        if _column_exists(cur, "purchase_order_items", "qty"):
-            item_cols.append("qty")
-            item_vals.append(int(max(1, threshold * 2)))
-        if _column_exists(cur, "purchase_order_items", "created_at"):
-            item_cols.append("created_at")
-            item_vals.append(datetime.now(tz=IST).strftime("%Y-%m-%d %H:%M:%S"))
-
+        item_cols, item_now_cols, build_item = item_plan
         if item_cols:
             cur.execute(
-                f"INSERT INTO purchase_order_items ({', '.join(item_cols)}) VALUES ({', '.join(['%s'] * len(item_cols))})",
-                tuple(item_vals),
+                _insert_sql("purchase_order_items", item_cols, now_cols=item_now_cols),
+                build_item(po_id, item_code, threshold),
             )
         else:
-            try:
-                print("[inventory_agent] PO item insert skipped: no compatible columns on purchase_order_items", flush=True)
-            except Exception:
-                pass
+            log.debug("PO item insert skipped: no compatible columns on purchase_order_items")
 
-        vendor_email = None
-        vendor_phone = None
-        if _table_exists(cur, "vendors") and vendor_id:
-            try:
-                cur.execute("SELECT email, phone FROM vendors WHERE id=%s LIMIT 1", (int(vendor_id),))
-                vr = _row_to_dict(cur, cur.fetchone())
-                if vr:
-                    vendor_email = vr.get("email")
-                    vendor_phone = vr.get("phone")
-            except Exception:
-                pass
+        vendor_email, vendor_phone = _vendor_contact(cur, vendor_id)
 
         create_notification(
             user_id=None,
@@ -1219,41 +1895,40 @@ def _maybe_create_po_draft(
             },
             conn=conn,
         )
-        try:
-            print(f"[inventory_agent] PO draft created id={po_id} item_code={item_code} vendor_id={vendor_id}", flush=True)
-        except Exception:
-            pass
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
+        log.info("PO draft created id=%s item_code=%s vendor_id=%s", po_id, item_code, vendor_id)
 
 
-def _already_consumed(conn, appointment_id: int) -> bool:
-    cur = _cursor(conn)
-    try:
-        if not _table_exists(cur, "appointment_audit_logs"):
-            return False
-        if not _column_exists(cur, "appointment_audit_logs", "appointment_id"):
-            return False
-        if not _column_exists(cur, "appointment_audit_logs", "action"):
-            return False
-        cur.execute(
+def _consume_sql(cur, stock_col: str, has_updated_at: bool) -> Tuple[str, str, bool]:
+    """
+    (decrement UPDATE, item SELECT, has_expiry) for _apply_consumption_by_code,
+    built once per (stock_col, has_updated_at) and schema load.
+    """
+    key = (stock_col, bool(has_updated_at))
+    hit = _CONSUME_SQL.get(key)
+    if hit is not None:
+        return hit
+
+    has_expiry = _column_exists(cur, "inventory_items", "expiry_date")
+    update_sql = f"""
+            UPDATE inventory_items
+            SET {stock_col}={stock_col}-%s
+            {', updated_at=NOW()' if has_updated_at else ''}
+            WHERE item_code=%s
+            {'AND (expiry_date IS NULL OR expiry_date >= %s)' if has_expiry else ''}
+            ORDER BY id
+            LIMIT 1
             """
-            SELECT 1
-            FROM appointment_audit_logs
-            WHERE appointment_id=%s AND action='INVENTORY_CONSUMED'
+    select_sql = f"""
+            SELECT id, item_code, name, {stock_col} AS stock
+            {', expiry_date AS expiry' if has_expiry else ''}
+            {', vendor_id AS vendor_id' if _column_exists(cur, "inventory_items", "vendor_id") else ''}
+            FROM inventory_items
+            WHERE item_code=%s
+            ORDER BY id
             LIMIT 1
-            """,
-            (appointment_id,),
-        )
-        return cur.fetchone() is not None
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
+            """
+    _CONSUME_SQL[key] = (update_sql, select_sql, has_expiry)
+    return _CONSUME_SQL[key]
 
 
 def _apply_consumption_by_code(
@@ -1266,35 +1941,42 @@ def _apply_consumption_by_code(
     appointment_id: int,
     procedure_code: Optional[str] = None,
     procedure_id: Optional[int] = None,
+    usage_log_rows: Optional[List[Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[Any, ...]]]] = None,
+    cur=None,
+    stock_col: Optional[str] = None,
+    has_updated_at: Optional[bool] = None,
+    today: Optional[date] = None,
 ) -> Tuple[int, int, Optional[int], Optional[str], Optional[str], Optional[int], bool]:
     """
     Decrement inventory_items stock by item_code.
     Returns (before, after, item_id, item_name).
+    If usage_log_rows is given, the inventory_usage_logs row is appended there
+    (see _insert_usage_logs) instead of being inserted immediately.
+    Callers looping over a visit's items pass stock_col/has_updated_at/today resolved once per event.
     """
     if qty <= 0 or not item_code:
         return (0, 0, None, None, None, None, False)
 
-    cur = _cursor(conn)
-    try:
-        if not _table_exists(cur, "inventory_items"):
-            return (0, 0, None, None, None, None, False)
-
-        stock_col, _, _ = _get_inventory_stock_cols(cur)
+    with _use_cursor(conn, cur) as cur:
+        if stock_col is None:
+            if not _table_exists(cur, "inventory_items"):
+                return (0, 0, None, None, None, None, False)
+            stock_col, _, _ = _get_inventory_stock_cols(cur)
         if not stock_col:
             return (0, 0, None, None, None, None, False)
+        if has_updated_at is None:
+            has_updated_at = _column_exists(cur, "inventory_items", "updated_at")
 
-        # lock row for safe decrement
-        cur.execute(
-            f"""
-            SELECT id, item_code, name, {stock_col} AS stock
-            {', expiry_date AS expiry' if _column_exists(cur, "inventory_items", "expiry_date") else ''}
-            {', vendor_id AS vendor_id' if _column_exists(cur, "inventory_items", "vendor_id") else ''}
-            FROM inventory_items
-            WHERE item_code=%s
-            FOR UPDATE
-            """,
-            (item_code,),
-        )
+        update_sql, select_sql, has_expiry = _consume_sql(cur, stock_col, has_updated_at)
+        today = today or _today()
+
+        # decrement in place: the UPDATE takes the row lock itself, expired rows are skipped server-side.
+        # Runs once per consumed item, so it goes through a cached prepared statement.
+        decremented = execute_prepared_rowcount(
+            conn, update_sql, (int(qty), item_code, today) if has_expiry else (int(qty), item_code)
+        ) > 0
+
+        cur.execute(select_sql, (item_code,))
         row = _row_to_dict(cur, cur.fetchone())
         if not row:
             return (0, 0, None, None, None, None, False)
@@ -1303,72 +1985,32 @@ def _apply_consumption_by_code(
         name = row.get("name") or item_code
         code = row.get("item_code") or item_code
         vendor_id = row.get("vendor_id")
+        stock_now = _to_int(row.get("stock"))
 
-        before = int(float(row.get("stock") or 0))
-        after = before - int(qty)
-
-        exp = row.get("expiry")
-        if exp:
+        if not decremented:
+            exp = row.get("expiry")
             try:
-                exp_date = exp if isinstance(exp, date) else datetime.strptime(str(exp)[:10], "%Y-%m-%d").date()
-                if exp_date < _today():
-                    _emit_expiry_notification(
-                        conn,
-                        item_id=item_id,
-                        item_name=name,
-                        expiry=str(exp_date),
-                        notif_type="INVENTORY_EXPIRED",
-                        title=f"Expired item blocked: {name}",
-                        message=f"Attempted to use expired item {name} (expired {exp_date}). Deduction blocked.",
-                        dedupe_key=f"inventory_expired_blocked:{item_id}:{exp_date}",
-                    )
-                    return (before, before, item_id, name, code, vendor_id, True)
-            except Exception:
-                pass
-
-        # your schema has updated_at
-        has_updated_at = _column_exists(cur, "inventory_items", "updated_at")
-        if has_updated_at:
-            cur.execute(
-                f"UPDATE inventory_items SET {stock_col}=%s, updated_at=NOW() WHERE id=%s",
-                (after, item_id),
-            )
-        else:
-            cur.execute(
-                f"UPDATE inventory_items SET {stock_col}=%s WHERE id=%s",
-                (after, item_id),
-            )
-
-        if after != before - int(qty):
-            create_notification(
-                user_id=None,
-                user_role="Admin",
-                title="Inventory mismatch",
-                message=f"{name} stock mismatch: before {before}, after {after}, expected {before - int(qty)}.",
-                notif_type="INVENTORY_ANOMALY",
-                related_table="inventory_items",
-                related_id=item_id,
-                status="PENDING",
-                priority=210,
-                dedupe_key=f"inventory_mismatch:{item_id}:{appointment_id}:{visit_id}",
-                meta={
-                    "before": before,
-                    "after": after,
-                    "expected": before - int(qty),
-                    "appointment_id": appointment_id,
-                    "visit_id": visit_id,
-                },
-                conn=conn,
-            )
-
-            if _table_exists(cur, "inventory_anomaly_logs"):
-                cur.execute(
-                    """
-                    INSERT INTO inventory_anomaly_logs (doctor_id, item_code, qty, avg_30d, appointment_id, visit_id, created_at, note)
-                    VALUES (%s, %s, %s, %s, %s, %s, NOW(), %s)
-                    """,
-                    (int(doctor_id), code, int(qty), None, int(appointment_id), int(visit_id), "stock_mismatch"),
+                exp_date = exp if isinstance(exp, date) else date.fromisoformat(str(exp)[:10])
+            except (TypeError, ValueError):
+                exp_date = None
+            if exp_date and exp_date < today:
+                _emit_expiry_notification(
+                    conn,
+                    item_id=item_id,
+                    item_name=name,
+                    expiry=str(exp_date),
+                    notif_type="INVENTORY_EXPIRED",
+                    title=f"Expired item blocked: {name}",
+                    message=f"Attempted to use expired item {name} (expired {exp_date}). Deduction blocked.",
+                    dedupe_key=f"inventory_expired_blocked:{item_id}:{exp_date}",
                 )
+                return (stock_now, stock_now, item_id, name, code, vendor_id, True)
+            return (0, 0, None, None, None, None, False)
+
+        # the UPDATE already applied the decrement under the row lock, so the row read back
+        # is the post-update stock (negative stock is alerted by on_appointment_completed)
+        after = stock_now
+        before = after + int(qty)
 
         # optional audit: inventory_usage_logs if present
         if _table_exists(cur, "inventory_usage_logs"):
@@ -1388,6 +2030,7 @@ def _apply_consumption_by_code(
 
                 cols = []
                 vals = []
+                now_cols: Tuple[str, ...] = ()
 
                 if item_code_ok:
                     cols.append("item_code")
@@ -1404,11 +2047,9 @@ def _apply_consumption_by_code(
                     vals.append(int(qty))
 
                 if used_at_ok:
-                    cols.append("used_at")
-                    vals.append(datetime.now(tz=IST).strftime("%Y-%m-%d %H:%M:%S"))
+                    now_cols = ("used_at",)
                 elif created_at_ok:
-                    cols.append("created_at")
-                    vals.append(datetime.now(tz=IST).strftime("%Y-%m-%d %H:%M:%S"))
+                    now_cols = ("created_at",)
 
                 if reason_ok:
                     cols.append("reason")
@@ -1429,7 +2070,7 @@ def _apply_consumption_by_code(
                 if meta_col_ok:
                     cols.append("meta_json")
                     vals.append(
-                        json.dumps(
+                        _json_dumps(
                             {
                                 "appointment_id": appointment_id,
                                 "item_code": item_code,
@@ -1437,56 +2078,91 @@ def _apply_consumption_by_code(
                                 "procedure_id": procedure_id,
                                 "qty_before": before,
                                 "qty_after": after,
-                            },
-                            ensure_ascii=False,
+                            }
                         )
                     )
 
                 if cols:
-                    cur.execute(
-                        f"INSERT INTO inventory_usage_logs ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))})",
-                        tuple(vals),
-                    )
+                    log_row = (tuple(cols), now_cols, tuple(vals))
+                    if usage_log_rows is not None:
+                        usage_log_rows.append(log_row)
+                    else:
+                        _insert_usage_logs(cur, [log_row])
             except Exception:
                 pass
 
         return (before, after, item_id, name, code, vendor_id, False)
-    finally:
+
+
+def _insert_usage_logs(cur, rows: List[Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[Any, ...]]]) -> None:
+    """
+    Multi-row inventory_usage_logs insert for rows collected by _apply_consumption_by_code.
+    Best-effort audit: failures never block consumption.
+    """
+    groups: Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], List[Tuple[Any, ...]]] = {}
+    for cols, now_cols, vals in rows:
+        groups.setdefault((cols, now_cols), []).append(vals)
+    for (cols, now_cols), vals_list in groups.items():
         try:
-            cur.close()
+            cur.execute(
+                _insert_sql("inventory_usage_logs", cols, len(vals_list), now_cols=now_cols),
+                tuple(v for vals in vals_list for v in vals),
+            )
         except Exception:
             pass
 
 
-def _mark_inventory_consumed(conn, appointment_id: int) -> None:
-    cur = _cursor(conn)
-    try:
+_SOURCE_META = _json_dumps({"source": "inventory_agent"})
+
+
+def _claim_inventory_consumption(conn, appointment_id: int) -> Tuple[bool, Optional[int]]:
+    """
+    Writes the INVENTORY_CONSUMED audit row up front, only if none exists yet, in one
+    INSERT ... SELECT ... WHERE NOT EXISTS. Returns (claimed, audit_row_id).
+    The NOT EXISTS probe locks the (appointment_id, action) index range, so a concurrent
+    delivery of the same event waits for this transaction instead of consuming twice.
+    Without a usable audit table nothing is claimed and the event is processed.
+    """
+    with _shared_cursor(conn) as cur:
         if not _table_exists(cur, "appointment_audit_logs"):
-            return
+            return True, None
         if not _column_exists(cur, "appointment_audit_logs", "appointment_id"):
-            return
+            return True, None
         if not _column_exists(cur, "appointment_audit_logs", "action"):
-            return
+            return True, None
 
         cols = ["appointment_id", "action"]
-        vals = [int(appointment_id), "INVENTORY_CONSUMED"]
-
-        if _column_exists(cur, "appointment_audit_logs", "created_at"):
-            cols.append("created_at")
-            vals.append(datetime.now(tz=IST).strftime("%Y-%m-%d %H:%M:%S"))
+        exprs = ["%s", "'INVENTORY_CONSUMED'"]
+        params: List[Any] = [int(appointment_id)]
         if _column_exists(cur, "appointment_audit_logs", "meta_json"):
             cols.append("meta_json")
-            vals.append(json.dumps({"source": "inventory_agent"}, ensure_ascii=False))
+            exprs.append("%s")
+            params.append(_SOURCE_META)
+        if _column_exists(cur, "appointment_audit_logs", "created_at"):
+            cols.append("created_at")
+            exprs.append("NOW()")
+        params.append(int(appointment_id))
 
         cur.execute(
-            f"INSERT INTO appointment_audit_logs ({', '.join(cols)}) VALUES ({', '.join(['%s'] * len(cols))})",
-            tuple(vals),
+            f"""
+            INSERT INTO appointment_audit_logs ({", ".join(cols)})
+            SELECT {", ".join(exprs)} FROM DUAL
+            WHERE NOT EXISTS (
+              SELECT 1 FROM appointment_audit_logs
+              WHERE appointment_id=%s AND action='INVENTORY_CONSUMED'
+            )
+            """,
+            tuple(params),
         )
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
+        if (cur.rowcount or 0) == 0:
+            return False, None
+        return True, int(cur.lastrowid or 0) or None
+
+
+def _release_inventory_consumption(cur, audit_id: Optional[int]) -> None:
+    # nothing was consumed: drop the claim so a later delivery (e.g. after consumables are added) can run
+    if audit_id:
+        cur.execute("DELETE FROM appointment_audit_logs WHERE id=%s", (audit_id,))
 
 
 def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
@@ -1504,8 +2180,6 @@ def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
     appt_id = int(payload.get("appointmentId") or payload.get("appointment_id") or 0)
     if not appt_id:
         return
-    if _already_consumed(conn, appt_id):
-        return
 
     try:
         conn.start_transaction()
@@ -1515,6 +2189,10 @@ def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
         except Exception:
             pass
 
+    claimed, audit_id = _claim_inventory_consumption(conn, appt_id)
+    if not claimed:
+        return
+
     appt_info = _get_appointment_info(conn, appt_id) or {}
 
     vr = _get_visit_for_appointment(conn, appt_id)
@@ -1522,97 +2200,111 @@ def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
     patient_id = int(vr.get("patient_id") or 0) if vr else int(appt_info.get("patient_id") or 0)
     doctor_id = int(vr.get("doctor_id") or 0) if vr else int(appt_info.get("doctor_id") or 0)
 
-    items: List[Dict[str, Any]] = []
-    if visit_id > 0:
-        items = _consume_items_from_visit(conn, visit_id)
+    # one cursor for the whole operation, threaded through the helpers below
+    cur = _cursor(conn)
+    try:
+        sources = _load_visit_consumption(conn, visit_id, cur=cur) if visit_id > 0 else {}
 
-    # ✅ Workflow fallback: derive consumables from procedures if visit_consumables empty
-    if not items and visit_id > 0:
-        items = _consume_items_from_procedures_if_needed(conn, visit_id)
+        # visit_consumables first; ✅ workflow fallback: derive consumables from procedures
+        items: List[Dict[str, Any]] = sources.get("vc") or sources.get("pc") or []
 
-    # ✅ Fallback: use appointment type/reason when visit/procedures are missing
-    if not items:
-        items = _consume_items_from_appointment_type(conn, appt_id)
+        # ✅ Fallback: use appointment type/reason when visit/procedures are missing
+        if not items:
+            items = _consume_items_from_appointment_type(conn, appt_id)
 
-    # Final fallback if visit exists but no procedures matched
-    if not items and visit_id > 0:
-        items = _consume_items_from_default_mapping(conn, visit_id)
+        # Final fallback if visit exists but no procedures matched
+        if not items and sources.get("vp"):
+            items = _consume_items_from_default_mapping(conn, sources["vp"])
 
-    if not items:
-        return
+        if not items:
+            _release_inventory_consumption(cur, audit_id)
+            return
 
-    touched: List[Tuple[int, int, int, str, str, Optional[int]]] = []  # (item_id, before, after, name, code, vendor_id)
-
-    for it in items:
-        code = str(it.get("item_code") or "").strip()
-        qty = int(it.get("qty") or 0)
-        procedure_code = it.get("procedure_code")
-        procedure_id = it.get("procedure_id")
-        before, after, item_id, name, code, vendor_id, blocked = _apply_consumption_by_code(
-            conn,
-            item_code=code,
-            qty=qty,
-            visit_id=visit_id,
-            doctor_id=doctor_id,
-            appointment_id=appt_id,
-            procedure_code=procedure_code,
-            procedure_id=procedure_id,
-        )
-        if item_id and name and not blocked:
-            touched.append((item_id, before, after, name, code, vendor_id))
+        touched: List[Tuple[int, int, int, str, str, Optional[int]]] = []  # (item_id, before, after, name, code, vendor_id)
+        usage_rows: List[Dict[str, Any]] = []
+        usage_log_rows: List[Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[Any, ...]]] = []
 
-            _record_usage_daily(
+        # resolved once per event and reused by every item and the low-stock pass below
+        schema = InventorySchema(conn, cur)
+        if schema.has_table("inventory_items"):
+            stock_col, th_col, _ = schema.stock_cols()
+        else:
+            stock_col, th_col = "", None
+        has_updated_at = schema.has_column("inventory_items", "updated_at")
+
+        usage_date = _today()
+        for it in items:
+            code = str(it.get("item_code") or "").strip()
+            qty = int(it.get("qty") or 0)
+            procedure_code = it.get("procedure_code")
+            procedure_id = it.get("procedure_id")
+            before, after, item_id, name, code, vendor_id, blocked = _apply_consumption_by_code(
                 conn,
-                usage_date=_today(),
-                doctor_id=doctor_id,
-                procedure_code=procedure_code,
                 item_code=code,
                 qty=qty,
-            )
-
-            _check_usage_anomaly(
-                conn,
+                visit_id=visit_id,
                 doctor_id=doctor_id,
-                item_code=code,
-                qty=qty,
-                procedure_code=procedure_code,
                 appointment_id=appt_id,
-                visit_id=visit_id,
+                procedure_code=procedure_code,
+                procedure_id=procedure_id,
+                usage_log_rows=usage_log_rows,
+                cur=cur,
+                stock_col=stock_col,
+                has_updated_at=has_updated_at,
+                today=usage_date,
             )
+            if item_id and name and not blocked:
+                touched.append((item_id, before, after, name, code, vendor_id))
 
-    if not touched:
-        return
+                usage_rows.append(
+                    {
+                        "usage_date": usage_date,
+                        "doctor_id": doctor_id,
+                        "procedure_code": procedure_code,
+                        "item_code": code,
+                        "qty": qty,
+                    }
+                )
 
-    _mark_inventory_consumed(conn, appt_id)
+        _insert_usage_logs(cur, usage_log_rows)
+        _record_usage_daily_many(conn, usage_rows, cur=cur)
+        _check_usage_anomalies(conn, doctor_id=doctor_id, lines=usage_rows, appointment_id=appt_id, visit_id=visit_id, cur=cur)
 
-    # low-stock + anomalies
-    cur = _cursor(conn)
-    try:
-        if not _table_exists(cur, "inventory_items"):
+        if not touched:
+            _release_inventory_consumption(cur, audit_id)
             return
 
-        stock_col, th_col, _ = _get_inventory_stock_cols(cur)
+        # low-stock + anomalies
         if not stock_col:
             return
 
+        # only rows that crossed the threshold (or went negative) come back; 0/NULL threshold -> default
+        ids = sorted({int(t[0]) for t in touched})
+        th_expr = f"COALESCE(NULLIF({th_col}, 0), %s)" if th_col else "%s"
+        cur.execute(
+            f"""
+            SELECT id, name, {stock_col} AS stock, {th_expr} AS th
+            {', item_code AS code' if schema.has_column("inventory_items", "item_code") else ''}
+            {', vendor_id AS vendor_id' if schema.has_column("inventory_items", "vendor_id") else ''}
+            FROM inventory_items
+            WHERE id IN ({", ".join(["%s"] * len(ids))})
+              AND ({stock_col} <= {th_expr} OR {stock_col} < 0)
+            """,
+            (int(LOW_STOCK_DEFAULT_THRESHOLD), *ids, int(LOW_STOCK_DEFAULT_THRESHOLD)),
+        )
+        by_id = {int(r["id"]): r for r in _rows_to_dicts(cur, cur.fetchall() or [])}
+        if not by_id:
+            return
+
+        alerts: List[Dict[str, Any]] = []
+
         for (item_id, before, after, name, code, vendor_id) in touched:
-            cur.execute(
-                f"""
-                SELECT id, name, {stock_col} AS stock
-                {', ' + th_col + ' AS th' if th_col else ''}
-                {', item_code AS code' if _column_exists(cur, "inventory_items", "item_code") else ''}
-                {', vendor_id AS vendor_id' if _column_exists(cur, "inventory_items", "vendor_id") else ''}
-                FROM inventory_items
-                WHERE id=%s
-                """,
-                (item_id,),
-            )
-            r = _row_to_dict(cur, cur.fetchone())
+            r = by_id.get(int(item_id))
             if not r:
                 continue
 
-            stock = int(float(r.get("stock") or 0))
-            th = int(float(r.get("th") or LOW_STOCK_DEFAULT_THRESHOLD)) if th_col else int(LOW_STOCK_DEFAULT_THRESHOLD)
+            stock = _to_int(r.get("stock"))
+            th = _to_int(r.get("th") or LOW_STOCK_DEFAULT_THRESHOLD)
             item_name = r.get("name") or name or f"Item #{item_id}"
 
             if stock <= th:
@@ -1632,13 +2324,14 @@ def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
                     threshold=th,
                 )
 
-                _upsert_inventory_alert_if_table_exists(
-                    conn,
-                    item_id=item_id,
-                    alert_type="LOW_STOCK",
-                    message=f"{item_name} low: stock {stock}, threshold {th}",
-                    severity=200,
-                    meta={"stock": stock, "threshold": th},
+                alerts.append(
+                    dict(
+                        item_id=item_id,
+                        alert_type="LOW_STOCK",
+                        message=f"{item_name} low: stock {stock}, threshold {th}",
+                        severity=200,
+                        meta={"stock": stock, "threshold": th},
+                    )
                 )
 
             if stock < 0:
@@ -1653,6 +2346,7 @@ def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
                     related_id=item_id,
                     meta={"before": before, "after": stock, "appointment_id": appt_id, "visit_id": visit_id},
                     status="PENDING",
+                    cur=cur,
                 )
                 _notify_admins(
                     conn,
@@ -1663,15 +2357,122 @@ def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
                     related_id=item_id,
                     meta={"before": before, "after": stock, "appointment_id": appt_id, "visit_id": visit_id},
                     status="PENDING",
+                    cur=cur,
                 )
-                _upsert_inventory_alert_if_table_exists(
-                    conn,
-                    item_id=item_id,
-                    alert_type="ANOMALY",
-                    message=f"{item_name} negative stock: {stock}",
-                    severity=300,
-                    meta={"before": before, "after": stock},
+                alerts.append(
+                    dict(
+                        item_id=item_id,
+                        alert_type="ANOMALY",
+                        message=f"{item_name} negative stock: {stock}",
+                        severity=300,
+                        meta={"before": before, "after": stock},
+                    )
+                )
+
+        _record_inventory_alerts(conn, alerts, cur=cur)
+    finally:
+        try:
+            cur.close()
+        except Exception:
+            pass
+
+
+class _ScanRow:
+    """One daily-scan row: the columns the alert loops read, in slots instead of a dict."""
+
+    __slots__ = (
+        "id",
+        "item_code",
+        "name",
+        "stock",
+        "th",
+        "vendor_id",
+        "expiry",
+        "is_low",
+        "is_neg",
+        "is_soon",
+        "is_expired",
+    )
+
+    def __init__(self, id, item_code, name, stock, th, vendor_id, expiry, is_low, is_neg, is_soon, is_expired):
+        self.id = id
+        self.item_code = item_code
+        self.name = name
+        self.stock = stock
+        self.th = th
+        self.vendor_id = vendor_id
+        self.expiry = expiry
+        self.is_low = is_low
+        self.is_neg = is_neg
+        self.is_soon = is_soon
+        self.is_expired = is_expired
+
+
+def _scan_rows(cur, batch: List[Any]) -> List[_ScanRow]:
+    """_ScanRow per fetched row; tuple rows are indexed from cur.description once per batch."""
+    if not batch:
+        return []
+    fields = _ScanRow.__slots__
+    if isinstance(batch[0], dict):
+        return [_ScanRow(*[r.get(f) for f in fields]) for r in batch]
+    pos = {d[0]: i for i, d in enumerate(cur.description or [])}
+    idx = [pos.get(f) for f in fields]
+    return [_ScanRow(*[r[i] if i is not None else None for i in idx]) for r in batch]
+
+
+def _item_label(r: _ScanRow) -> Tuple[int, Optional[str], str]:
+    """(item_id, item_code, display name) for a daily-scan row."""
+    item_id = int(r.id or 0)
+    code = r.item_code
+    return item_id, code, r.name or code or f"Item #{r.id}"
+
+
+def _stock(r: _ScanRow) -> float:
+    return float(r.stock or 0)
+
+
+def _expiry_key(r: _ScanRow) -> str:
+    return str(r.expiry)
+
+
+def _detect_manual_edit_spikes(conn) -> None:
+    """Admin notification per item_code with >= 3 manual/adjustment usage logs in 24h."""
+    # source/created_at predicates lead so the GROUP BY runs off idx_iul_src_time_code
+    # (sql/inventory_agent_migration.sql)
+    cur = _cursor(conn)
+    try:
+        if _table_exists(cur, "inventory_usage_logs") and _column_exists(cur, "inventory_usage_logs", "source"):
+            cur.execute(
+                """
+                SELECT item_code, COUNT(*) AS cnt
+                FROM inventory_usage_logs
+                WHERE source IN ('MANUAL','ADJUSTMENT')
+                  AND created_at >= DATE_SUB(NOW(), INTERVAL 1 DAY)
+                GROUP BY item_code
+                HAVING cnt >= 3
+                """,
+            )
+            today = _today()
+            spikes: List[Dict[str, Any]] = []
+            for code, cnt in _iter_rows(cur, "item_code", "cnt"):
+                code = code or "unknown"
+                cnt = int(cnt or 0)
+                spikes.append(
+                    dict(
+                        dedupe_key=f"manual_edits:{code}:{today}",
+                        user_id=None,
+                        user_role="Admin",
+                        title="Manual stock edits detected",
+                        message=f"{code} has {cnt} manual adjustments in the last 24h.",
+                        notif_type="INVENTORY_ANOMALY",
+                        related_table="inventory_usage_logs",
+                        related_id=None,
+                        status="PENDING",
+                        priority=190,
+                        meta={"item_code": code, "count": cnt},
+                    )
                 )
+            _emit_many(conn, spikes)
     finally:
         try:
             cur.close()
@@ -1691,7 +2492,7 @@ def daily_inventory_checks(conn, *, horizon_days: int = EXPIRY_ALERT_DAYS) -> No
     """
     horizon_days = int(horizon_days or EXPIRY_ALERT_DAYS)
 
-    cur = _cursor(conn)
+    cur = _stream_cursor(conn, dictionary=False)
     try:
         if not _table_exists(cur, "inventory_items"):
             return
@@ -1700,242 +2501,201 @@ def daily_inventory_checks(conn, *, horizon_days: int = EXPIRY_ALERT_DAYS) -> No
         if not stock_col:
             return
 
-        # low stock rows
-        if th_col:
-            cur.execute(
-                f"""
-                SELECT id, item_code, name, {stock_col} AS stock,
-                       COALESCE({th_col}, %s) AS th
-                       {', vendor_id AS vendor_id' if _column_exists(cur, "inventory_items", "vendor_id") else ''}
-                FROM inventory_items
-                WHERE {stock_col} <= COALESCE({th_col}, %s)
-                ORDER BY {stock_col} ASC
-                LIMIT 200
-                """,
-                (LOW_STOCK_DEFAULT_THRESHOLD, LOW_STOCK_DEFAULT_THRESHOLD),
-            )
-        else:
-            cur.execute(
-                f"""
-                SELECT id, item_code, name, {stock_col} AS stock,
-                       %s AS th
-                       {', vendor_id AS vendor_id' if _column_exists(cur, "inventory_items", "vendor_id") else ''}
-                FROM inventory_items
-                WHERE {stock_col} <= %s
-                ORDER BY {stock_col} ASC
-                LIMIT 200
-                """,
-                (LOW_STOCK_DEFAULT_THRESHOLD, LOW_STOCK_DEFAULT_THRESHOLD),
-            )
-        low_rows = _rows_to_dicts(cur, cur.fetchall() or [])
-
-        # expiring & expired rows
-        expiring_rows: List[dict] = []
-        expired_rows: List[dict] = []
+        # one scan for low / expiring / expired / negative; flags and the display name
+        # are computed server-side so the loops below only branch on them
+        th_expr = f"COALESCE({th_col}, %s)" if th_col else "%s"
+        has_vendor = _column_exists(cur, "inventory_items", "vendor_id")
+        today = _today()
+        cutoff = today + timedelta(days=horizon_days)
+        params: List[Any] = [LOW_STOCK_DEFAULT_THRESHOLD, LOW_STOCK_DEFAULT_THRESHOLD, LOW_STOCK_DEFAULT_THRESHOLD]
+        exp_sql = ""
+        exp_where = ""
         if exp_col:
-            cutoff = _today() + timedelta(days=horizon_days)
-            today = _today()
-
-            # expiring soon (includes today..cutoff)
-            cur.execute(
-                f"""
-                SELECT id, item_code, name, {exp_col} AS expiry
-                FROM inventory_items
-                WHERE {exp_col} IS NOT NULL AND {exp_col} >= %s AND {exp_col} <= %s
-                ORDER BY {exp_col} ASC
-                LIMIT 200
-                """,
-                (today, cutoff),
-            )
-            expiring_rows = _rows_to_dicts(cur, cur.fetchall() or [])
-
-            # expired (expiry < today)
-            cur.execute(
-                f"""
-                SELECT id, item_code, name, {exp_col} AS expiry
-                FROM inventory_items
-                WHERE {exp_col} IS NOT NULL AND {exp_col} < %s
-                ORDER BY {exp_col} ASC
-                LIMIT 200
-                """,
-                (today,),
-            )
-            expired_rows = _rows_to_dicts(cur, cur.fetchall() or [])
+            exp_sql = f""",
+                   {exp_col} AS expiry,
+                   ({exp_col} IS NOT NULL AND {exp_col} >= %s AND {exp_col} <= %s) AS is_soon,
+                   ({exp_col} IS NOT NULL AND {exp_col} < %s) AS is_expired"""
+            exp_where = f" OR ({exp_col} IS NOT NULL AND {exp_col} <= %s)"
+            params = [
+                LOW_STOCK_DEFAULT_THRESHOLD,
+                LOW_STOCK_DEFAULT_THRESHOLD,
+                today,
+                cutoff,
+                today,
+                LOW_STOCK_DEFAULT_THRESHOLD,
+                cutoff,
+            ]
 
-        # negative stock
         cur.execute(
             f"""
-            SELECT id, item_code, name, {stock_col} AS stock
+            SELECT id, item_code, {stock_col} AS stock,
+                   {th_expr} AS th,
+                   COALESCE(NULLIF(name, ''), NULLIF(item_code, ''), CONCAT('Item #', id)) AS name,
+                   ({stock_col} <= {th_expr}) AS is_low,
+                   ({stock_col} < 0) AS is_neg
+                   {', vendor_id AS vendor_id' if has_vendor else ''}
+                   {exp_sql}
             FROM inventory_items
-            WHERE {stock_col} < 0
-            ORDER BY {stock_col} ASC
-            LIMIT 50
-            """
+            WHERE {stock_col} <= {th_expr} OR {stock_col} < 0{exp_where}
+            """,
+            tuple(params),
         )
-        neg_rows = _rows_to_dicts(cur, cur.fetchall() or [])
+        # streamed in fetchmany batches; each category is trimmed to its cap after every
+        # batch so memory stays O(batch + caps) however many rows match
+        low_rows: List[_ScanRow] = []
+        expiring_rows: List[_ScanRow] = []
+        expired_rows: List[_ScanRow] = []
+        neg_rows: List[_ScanRow] = []
+        while True:
+            batch = cur.fetchmany(DAILY_SCAN_BATCH)
+            if not batch:
+                break
+            for r in _scan_rows(cur, batch):
+                if r.is_low:
+                    low_rows.append(r)
+                if r.is_neg:
+                    neg_rows.append(r)
+                if r.is_soon:
+                    expiring_rows.append(r)
+                if r.is_expired:
+                    expired_rows.append(r)
+            # nsmallest is stable, so trimming per batch matches sorted(all)[:cap]
+            low_rows = heapq.nsmallest(200, low_rows, key=_stock)
+            neg_rows = heapq.nsmallest(50, neg_rows, key=_stock)
+            expiring_rows = heapq.nsmallest(200, expiring_rows, key=_expiry_key)
+            expired_rows = heapq.nsmallest(200, expired_rows, key=_expiry_key)
     finally:
         try:
             cur.close()
         except Exception:
             pass
 
-    # Admin notifications (broadcast)
-    for r in low_rows:
-        stock = int(float(r.get("stock") or 0))
-        th = int(float(r.get("th") or LOW_STOCK_DEFAULT_THRESHOLD))
-        name = r.get("name") or r.get("item_code") or f"Item #{r.get('id')}"
-        item_id = int(r.get("id") or 0)
-
-        _emit_low_stock_notification(
-            conn,
-            item_id=item_id,
-            item_name=name,
-            stock=stock,
-            threshold=th,
-        )
-        _maybe_create_po_draft(
-            conn,
-            item_id=item_id,
-            item_code=r.get("item_code"),
-            vendor_id=r.get("vendor_id"),
-            threshold=th,
+    if not (low_rows or expiring_rows or expired_rows or neg_rows):
+        # nothing flagged by the scan; the manual-edit check does not depend on it
+        _detect_manual_edit_spikes(conn)
+        return
+
+    alerts: List[Dict[str, Any]] = []
+    pending_notifs: List[Dict[str, Any]] = []  # create_notification kwargs, sent as one batch
+    anomaly_notes: List[Dict[str, Any]] = []  # _notify_admins kwargs, fanned out in one INSERT
+
+    # Admin notifications (broadcast); purchase order drafts (optional, guarded) for the first few
+    for idx, r in enumerate(low_rows):
+        item_id, code, name = _item_label(r)
+        stock = _to_int(r.stock)
+        th = _to_int(r.th or LOW_STOCK_DEFAULT_THRESHOLD)
+
+        pending_notifs.extend(
+            _low_stock_notifications(
+                item_id=item_id,
+                item_name=name,
+                stock=stock,
+                threshold=th,
+            )
         )
-        _upsert_inventory_alert_if_table_exists(
-            conn,
-            item_id=item_id,
-            alert_type="LOW_STOCK",
-            message=f"{name} low: stock {stock}, threshold {th}",
-            severity=200,
-            meta={"stock": stock, "threshold": th, "item_code": r.get("item_code")},
+        if idx < PO_DRAFTS_PER_TICK:
+            _maybe_create_po_draft(
+                conn,
+                item_id=item_id,
+                item_code=code,
+                vendor_id=r.vendor_id,
+                threshold=th,
+            )
+        alerts.append(
+            dict(
+                item_id=item_id,
+                alert_type="LOW_STOCK",
+                message=_LOW_ALERT_MSG % (name, stock, th),
+                severity=200,
+                meta={"stock": stock, "threshold": th, "item_code": code},
+            )
         )
 
     for r in expiring_rows:
-        name = r.get("name") or r.get("item_code") or f"Item #{r.get('id')}"
-        item_id = int(r.get("id") or 0)
-        exp = r.get("expiry")
-
-        _set_item_status(conn, item_id, "Expiring soon")
-
-        _emit_expiry_notification(
-            conn,
-            item_id=item_id,
-            item_name=name,
-            expiry=str(exp),
-            notif_type="INVENTORY_EXPIRING_SOON",
-            title=f"Expiring soon: {name}",
-            message=f"{name} is expiring on {exp}.",
-            dedupe_key=f"inventory_expiring:{item_id}:{str(exp)}",
+        item_id, code, name = _item_label(r)
+        exp = str(r.expiry)
+
+        pending_notifs.append(
+            _expiry_notification(
+                item_id=item_id,
+                expiry=exp,
+                notif_type="INVENTORY_EXPIRING_SOON",
+                title=_EXPIRING_TITLE % name,
+                message=_EXPIRING_NOTIF_MSG % (name, exp),
+                dedupe_key="inventory_expiring:%d:%s" % (item_id, exp),
+            )
         )
-        _upsert_inventory_alert_if_table_exists(
-            conn,
-            item_id=item_id,
-            alert_type="EXPIRING",
-            message=f"{name} expiring on {exp}",
-            severity=150,
-            meta={"expiry": str(exp), "item_code": r.get("item_code")},
+        alerts.append(
+            dict(
+                item_id=item_id,
+                alert_type="EXPIRING",
+                message=_EXPIRING_ALERT_MSG % (name, exp),
+                severity=150,
+                meta={"expiry": exp, "item_code": code},
+            )
         )
 
     for r in expired_rows:
-        name = r.get("name") or r.get("item_code") or f"Item #{r.get('id')}"
-        item_id = int(r.get("id") or 0)
-        exp = r.get("expiry")
-
-        _set_item_status(conn, item_id, "Expired")
-
-        _emit_expiry_notification(
-            conn,
-            item_id=item_id,
-            item_name=name,
-            expiry=str(exp),
-            notif_type="INVENTORY_EXPIRED",
-            title=f"Expired: {name}",
-            message=f"{name} expired on {exp}. Please remove or reconcile stock.",
-            dedupe_key=f"inventory_expired:{item_id}:{str(exp)}",
+        item_id, code, name = _item_label(r)
+        exp = str(r.expiry)
+
+        pending_notifs.append(
+            _expiry_notification(
+                item_id=item_id,
+                expiry=exp,
+                notif_type="INVENTORY_EXPIRED",
+                title=_EXPIRED_TITLE % name,
+                message=_EXPIRED_NOTIF_MSG % (name, exp),
+                dedupe_key="inventory_expired:%d:%s" % (item_id, exp),
+            )
         )
-        _upsert_inventory_alert_if_table_exists(
-            conn,
-            item_id=item_id,
-            alert_type="EXPIRED",
-            message=f"{name} expired on {exp}",
-            severity=250,
-            meta={"expiry": str(exp), "item_code": r.get("item_code")},
+        alerts.append(
+            dict(
+                item_id=item_id,
+                alert_type="EXPIRED",
+                message=_EXPIRED_ALERT_MSG % (name, exp),
+                severity=250,
+                meta={"expiry": exp, "item_code": code},
+            )
         )
 
     for r in neg_rows:
-        stock = int(float(r.get("stock") or 0))
-        name = r.get("name") or r.get("item_code") or f"Item #{r.get('id')}"
-        item_id = int(r.get("id") or 0)
-
-        _notify_admins(
-            conn,
-            title="Inventory Anomaly",
-            message=f"{name} has negative stock ({stock}). Please reconcile.",
-            notif_type="INVENTORY_ANOMALY",
-            related_table="inventory_items",
-            related_id=item_id,
-            meta={"stock": stock, "item_code": r.get("item_code")},
-            status="PENDING",
+        item_id, code, name = _item_label(r)
+        stock = _to_int(r.stock)
+
+        anomaly_notes.append(
+            dict(
+                title="Inventory Anomaly",
+                message=_NEGATIVE_NOTIF_MSG % (name, stock),
+                notif_type="INVENTORY_ANOMALY",
+                related_table="inventory_items",
+                related_id=item_id,
+                meta={"stock": stock, "item_code": code},
+                status="PENDING",
+            )
         )
-        _upsert_inventory_alert_if_table_exists(
-            conn,
-            item_id=item_id,
-            alert_type="ANOMALY",
-            message=f"{name} negative stock: {stock}",
-            severity=300,
-            meta={"stock": stock, "item_code": r.get("item_code")},
+        alerts.append(
+            dict(
+                item_id=item_id,
+                alert_type="ANOMALY",
+                message=_NEGATIVE_ALERT_MSG % (name, stock),
+                severity=300,
+                meta={"stock": stock, "item_code": code},
+            )
         )
 
-    # manual edit spike detection (last 24h)
-    cur = _cursor(conn)
-    try:
-        if _table_exists(cur, "inventory_usage_logs") and _column_exists(cur, "inventory_usage_logs", "source"):
-            cur.execute(
-                """
-                SELECT item_code, COUNT(*) AS cnt
-                FROM inventory_usage_logs
-                WHERE source IN ('MANUAL','ADJUSTMENT')
-                  AND created_at >= DATE_SUB(NOW(), INTERVAL 1 DAY)
-                GROUP BY item_code
-                HAVING cnt >= 3
-                """,
-            )
-            rows = _rows_to_dicts(cur, cur.fetchall() or [])
-            for r in rows:
-                code = r.get("item_code") or "unknown"
-                cnt = int(r.get("cnt") or 0)
-                create_notification(
-                    user_id=None,
-                    user_role="Admin",
-                    title="Manual stock edits detected",
-                    message=f"{code} has {cnt} manual adjustments in the last 24h.",
-                    notif_type="INVENTORY_ANOMALY",
-                    related_table="inventory_usage_logs",
-                    related_id=None,
-                    status="PENDING",
-                    priority=190,
-                    dedupe_key=f"manual_edits:{code}:{_today()}",
-                    meta={"item_code": code, "count": cnt},
-                    conn=conn,
-                )
-    finally:
-        try:
-            cur.close()
-        except Exception:
-            pass
+    _set_items_status(
+        conn,
+        {
+            "Expiring soon": [int(r.id or 0) for r in expiring_rows],
+            "Expired": [int(r.id or 0) for r in expired_rows],
+        },
+    )
+    _emit_many(conn, pending_notifs)
+    _notify_admins_many(conn, anomaly_notes)
+    _record_inventory_alerts(conn, alerts)
 
-    # purchase order drafts (optional, guarded)
-    for r in low_rows[:20]:
-        item_id = int(r.get("id") or 0)
-        item_code = r.get("item_code")
-        th = int(float(r.get("th") or LOW_STOCK_DEFAULT_THRESHOLD))
-        vendor_id = r.get("vendor_id") if r.get("vendor_id") is not None else None
-        _maybe_create_po_draft(
-            conn,
-            item_id=item_id,
-            item_code=item_code,
-            vendor_id=vendor_id,
-            threshold=th,
-        )
+    _detect_manual_edit_spikes(conn)
 
 
 # ----------------------------
@@ -1943,39 +2703,32 @@ def daily_inventory_checks(conn, *, horizon_days: int = EXPIRY_ALERT_DAYS) -> No
 # ----------------------------
 class InventoryAgent:
     def handle(self, conn, event_type: str, event_id: int, payload: Dict[str, Any]) -> None:
-        if event_type == "AppointmentCompleted":
-            on_appointment_completed(conn, payload or {})
-            try:
-                conn.commit()
-            except Exception:
-                pass
-            return
-
-        if event_type == "VisitConsumablesUpdated":
-            # Treat consumables update as a signal to record usage if not yet consumed.
-            on_appointment_completed(conn, payload or {})
-            try:
-                conn.commit()
-            except Exception:
-                pass
-            return
-
-        if event_type in ("InventoryDailyTick", "InventoryDailyCheck", "InventoryMonitorTick", "DailyInventoryChecks"):
-            horizon = int((payload or {}).get("horizon_days") or EXPIRY_ALERT_DAYS)
-            daily_inventory_checks(conn, horizon_days=horizon)
-            try:
-                conn.commit()
-            except Exception:
-                pass
-            return
+        """
+        One transaction per event: the handler's writes (stock, usage, alerts, notifications,
+        PO drafts) share the connection's open transaction and are committed once here.
+        On error nothing is committed; the worker rolls back and retries the event.
+        """
+        payload = payload or {}
+        _settle_emitted(conn, committed=False)  # nothing from an earlier event carries over
+        try:
+            if event_type in ("AppointmentCompleted", "VisitConsumablesUpdated"):
+                # VisitConsumablesUpdated: record usage if not yet consumed.
+                on_appointment_completed(conn, payload)
+            elif event_type in ("InventoryDailyTick", "InventoryDailyCheck", "InventoryMonitorTick", "DailyInventoryChecks"):
+                horizon = int(payload.get("horizon_days") or EXPIRY_ALERT_DAYS)
+                daily_inventory_checks(conn, horizon_days=horizon)
+            elif event_type == "InventoryRulesUpdated":
+                # Re-run checks after rule changes.
+                daily_inventory_checks(conn, horizon_days=EXPIRY_ALERT_DAYS)
+            else:
+                return
+        except Exception:
+            _settle_emitted(conn, committed=False)
+            raise
 
-        if event_type == "InventoryRulesUpdated":
-            # Re-run checks after rule changes.
-            daily_inventory_checks(conn, horizon_days=EXPIRY_ALERT_DAYS)
-            try:
-                conn.commit()
-            except Exception:
-                pass
+        try:
+            conn.commit()
+        except Exception:
+            _settle_emitted(conn, committed=False)
             return
-
-        return
+        _settle_emitted(conn, committed=True)
@@ -2,16 +2,22 @@
 from __future__ import annotations
 
 from datetime import datetime, timedelta, date, timezone
+from dataclasses import dataclass
 from decimal import Decimal
 from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import json
+import os
+import time
 
 try:
     from zoneinfo import ZoneInfo
 except Exception:
     ZoneInfo = None  # type: ignore
 
-from ..notifications import create_notification
+from ..db import _claim_idempotency_locks, _column_exists, _table_exists, get_conn, on_schema_clear
+from ..notifications import create_notification, create_notifications
 
 
 def _ist_tz():
@@ -32,6 +38,18 @@ CLAIM_DELAY_DAYS = 30
 UNDERCODE_FACTOR = 0.7
 
 
+def _env_flag(name: str) -> bool:
+    v = os.environ.get(name)
+    if v is None:
+        return False
+    return str(v).strip().lower() in ("1", "true", "yes", "y", "on")
+
+
+# REVENUE_FORECAST_PARALLEL=1 runs the forecast's payment/claim summaries on their own
+# connections while the series query runs on the worker connection.
+FORECAST_PARALLEL = _env_flag("REVENUE_FORECAST_PARALLEL")
+
+
 def _today() -> date:
     return datetime.now(tz=IST).date()
 
@@ -40,88 +58,219 @@ def _now_str() -> str:
     return datetime.now(tz=IST).strftime("%Y-%m-%d %H:%M:%S")
 
 
+_NORM_TABLE = str.maketrans("- ", "__")
+
+
+@functools.lru_cache(maxsize=2048)
+def _norm_str(s: str) -> str:
+    return s.strip().translate(_NORM_TABLE).upper()[:80] or "CONSULTATION"
+
+
 def _norm(s: Any) -> str:
-    return (str(s or "").strip().upper().replace("-", "_").replace(" ", "_"))[:80] or "CONSULTATION"
+    # procedure codes are a small, repeating set; str inputs hit the cache
+    if isinstance(s, str):
+        return _norm_str(s)
+    return _norm_str(str(s or ""))
 
-def _json_safe(obj: Any) -> Any:
+def _json_default(obj: Any) -> Any:
+    # json.dumps calls this only for values it cannot encode itself
     if isinstance(obj, Decimal):
         return float(obj)
     if isinstance(obj, (date, datetime)):
         return obj.isoformat()
     if isinstance(obj, bytes):
-        try:
-            return obj.decode("utf-8", errors="replace")
-        except Exception:
-            return str(obj)
+        return obj.decode("utf-8", errors="replace")
     if isinstance(obj, set):
-        return [_json_safe(v) for v in obj]
-    if isinstance(obj, dict):
-        return {k: _json_safe(v) for k, v in obj.items()}
-    if isinstance(obj, (list, tuple)):
-        return [_json_safe(v) for v in obj]
-    return obj
+        return list(obj)
+    return str(obj)
 
 
 def _json_dumps_safe(payload: Dict[str, Any]) -> str:
     # Normalize non-JSON types (Decimal, dates) to avoid crashes in worker.
-    safe_payload = _json_safe(payload)
-    return json.dumps(safe_payload, ensure_ascii=False, default=str)
+    return json.dumps(payload, ensure_ascii=False, default=_json_default)
 
 
-def _table_exists(cur, name: str) -> bool:
-    cur.execute(
-        """
-        SELECT 1 FROM INFORMATION_SCHEMA.TABLES
-        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s
-        LIMIT 1
-        """,
-        (name,),
-    )
-    return cur.fetchone() is not None
+def _row_values(cur, rows: List[Any], *cols: str) -> List[Tuple[Any, ...]]:
+    """
+    The named columns of each fetched row, as tuples. Dict vs tuple rows is decided once
+    from the first row; tuple rows are indexed by position from cur.description.
+    """
+    if not rows:
+        return []
+    if isinstance(rows[0], dict):
+        return [tuple(r.get(c) for c in cols) for r in rows]
+    pos = {d[0]: i for i, d in enumerate(cur.description or [])}
+    idx = [pos.get(c) for c in cols]
+    return [tuple(r[i] if i is not None else None for i in idx) for r in rows]
+
+
+# index probes; table/column probes come from the db.py schema cache
+_SCHEMA_CACHE: Dict[tuple, bool] = {}
+
 
+@on_schema_clear
+def _clear_schema_derived() -> None:
+    global _INVOICE_SCHEMA
+    _SCHEMA_CACHE.clear()
+    _VISIT_ITEMS_SQL.clear()
+    _INVOICE_SCHEMA = None
 
-def _column_exists(cur, table: str, col: str) -> bool:
+
+def _has_unique_key(cur, table: str, col: str) -> bool:
+    """True if `col` alone carries a UNIQUE index, so ON DUPLICATE KEY can target it."""
+    key = ("u", table, col)
+    hit = _SCHEMA_CACHE.get(key)
+    if hit is not None:
+        return hit
     cur.execute(
         """
-        SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
-        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME=%s
+        SELECT 1 FROM INFORMATION_SCHEMA.STATISTICS s
+        WHERE s.TABLE_SCHEMA=DATABASE() AND s.TABLE_NAME=%s AND s.COLUMN_NAME=%s
+          AND s.NON_UNIQUE=0 AND s.SEQ_IN_INDEX=1
+          AND NOT EXISTS (
+            SELECT 1 FROM INFORMATION_SCHEMA.STATISTICS s2
+            WHERE s2.TABLE_SCHEMA=s.TABLE_SCHEMA AND s2.TABLE_NAME=s.TABLE_NAME
+              AND s2.INDEX_NAME=s.INDEX_NAME AND s2.SEQ_IN_INDEX > 1
+          )
         LIMIT 1
         """,
         (table, col),
     )
-    return cur.fetchone() is not None
-
-
-def _insert_idempotency_lock(cur, key: str, ttl_hours: int = 24, locked_by: str = "revenue-agent") -> bool:
-    if not _table_exists(cur, "idempotency_locks"):
-        return True
-    if not _column_exists(cur, "idempotency_locks", "lock_key"):
-        return True
-
-    cols: List[str] = ["lock_key"]
-    vals: List[Any] = [key[:190]]
-
-    if _column_exists(cur, "idempotency_locks", "locked_by"):
-        cols.append("locked_by")
-        vals.append(locked_by)
-    if _column_exists(cur, "idempotency_locks", "expires_at"):
-        exp = datetime.now(tz=IST) + timedelta(hours=int(ttl_hours or 24))
-        cols.append("expires_at")
-        vals.append(exp.strftime("%Y-%m-%d %H:%M:%S"))
-    if _column_exists(cur, "idempotency_locks", "created_at"):
-        cols.append("created_at")
-        vals.append(_now_str())
-
-    placeholders = ", ".join(["%s"] * len(cols))
-    col_sql = ", ".join([f"`{c}`" for c in cols])
-    try:
-        cur.execute(
-            f"INSERT INTO idempotency_locks ({col_sql}) VALUES ({placeholders})",
-            tuple(vals),
+    _SCHEMA_CACHE[key] = cur.fetchone() is not None
+    return _SCHEMA_CACHE[key]
+
+
+@dataclass(frozen=True)
+class InvoiceSchema:
+    """
+    invoices column picks and the report/forecast/claim statements built from them,
+    resolved once from the memoized probes so the helpers skip the per-call column
+    checks and string formatting and only bind parameters.
+    """
+
+    has_invoices: bool
+    date_col: str = "created_at"  # issue_date when present
+    paid_col: Optional[str] = None
+    has_patient_id: bool = False
+    has_status: bool = False
+    claim_status_col: Optional[str] = None  # claim_status, else insurance_status
+    claim_select: Optional[str] = None  # _detect_claim_issues row query, None without claim columns
+    range_kpi_sql: Optional[str] = None  # param: days
+    forecast_sql: Optional[str] = None  # param: days
+    payment_prob_sql: Optional[str] = None  # None without patient_id/status
+    claim_approval_sql: Optional[str] = None  # None without a claim status column
+
+    @classmethod
+    def from_cursor(cls, cur) -> "InvoiceSchema":
+        if not _table_exists(cur, "invoices"):
+            return cls(has_invoices=False)
+
+        has = {c: _column_exists(cur, "invoices", c) for c in (
+            "issue_date",
+            "paid_date",
+            "patient_id",
+            "status",
+            "claim_status",
+            "insurance_status",
+            "claim_submitted_at",
+            "claim_rejected_at",
+            "claim_denied_at",
+        )}
+        claim_status_col = "claim_status" if has["claim_status"] else (
+            "insurance_status" if has["insurance_status"] else None
         )
-        return True
-    except Exception:
-        return False
+        claim_select = None
+        if claim_status_col:
+            picks = ", ".join(
+                f"{c if has[c] else 'NULL'} AS {c}"
+                for c in (
+                    "claim_status",
+                    "insurance_status",
+                    "claim_submitted_at",
+                    "claim_rejected_at",
+                    "claim_denied_at",
+                    "paid_date",
+                )
+            )
+            claim_select = f"SELECT {picks} FROM invoices WHERE id=%s LIMIT 1"
+
+        date_col = "issue_date" if has["issue_date"] else "created_at"
+        paid_col = "paid_date" if has["paid_date"] else None
+
+        range_kpi_sql = f"""
+            SELECT
+              COUNT(*) AS invoice_count,
+              COALESCE(SUM(amount),0) AS total_billed,
+              COALESCE(SUM(CASE WHEN status IN ('Paid','PAID','paid') THEN amount ELSE 0 END),0) AS total_paid,
+              COALESCE(SUM(CASE WHEN status IN ('Pending','PENDING','Overdue','OVERDUE') THEN amount ELSE 0 END),0) AS total_pending
+            FROM invoices
+            WHERE {date_col} >= DATE_SUB(CURDATE(), INTERVAL %s DAY)
+            """
+
+        # daily totals ranked newest-first; the trailing-window sums are taken server-side
+        # over the most recent days that had revenue (rn), so one row comes back
+        forecast_sql = f"""
+            SELECT COUNT(*) AS n,
+                   COALESCE(SUM(CASE WHEN rn <= 7 THEN total END), 0) AS s7,
+                   COALESCE(SUM(CASE WHEN rn <= 30 THEN total END), 0) AS s30,
+                   COALESCE(SUM(CASE WHEN rn BETWEEN 8 AND 14 THEN total END), 0) AS s_prev7
+            FROM (
+              SELECT SUM(amount) AS total,
+                     ROW_NUMBER() OVER (ORDER BY {date_col} DESC) AS rn
+              FROM invoices
+              WHERE {date_col} >= DATE_SUB(CURDATE(), INTERVAL %s DAY)
+                AND (status IN ('Paid','PAID','paid') { "OR " + paid_col + " IS NOT NULL" if paid_col else "" })
+              GROUP BY {date_col}
+            ) daily
+            """
+
+        payment_prob_sql = None
+        if has["patient_id"] and has["status"]:
+            # mean of per-patient paid ratios, averaged server-side
+            payment_prob_sql = f"""
+                SELECT AVG(paid_cnt / total_cnt) AS p
+                FROM (
+                  SELECT SUM(CASE WHEN status IN ('Paid','PAID','paid') THEN 1 ELSE 0 END) AS paid_cnt,
+                         COUNT(*) AS total_cnt
+                  FROM invoices
+                  WHERE {date_col} >= DATE_SUB(CURDATE(), INTERVAL 180 DAY)
+                  GROUP BY patient_id
+                ) per_patient
+                """
+
+        claim_approval_sql = None
+        if claim_status_col:
+            claim_approval_sql = f"""
+                SELECT
+                  SUM(CASE WHEN {claim_status_col} IN ('APPROVED','Approved','PAID','Paid') THEN 1 ELSE 0 END) AS ok_cnt,
+                  SUM(CASE WHEN {claim_status_col} IN ('REJECTED','Rejected','DENIED','Denied') THEN 1 ELSE 0 END) AS bad_cnt
+                FROM invoices
+                WHERE {date_col} >= DATE_SUB(CURDATE(), INTERVAL 180 DAY)
+                """
+
+        return cls(
+            has_invoices=True,
+            date_col=date_col,
+            paid_col=paid_col,
+            has_patient_id=has["patient_id"],
+            has_status=has["status"],
+            claim_status_col=claim_status_col,
+            claim_select=claim_select,
+            range_kpi_sql=range_kpi_sql,
+            forecast_sql=forecast_sql,
+            payment_prob_sql=payment_prob_sql,
+            claim_approval_sql=claim_approval_sql,
+        )
+
+
+_INVOICE_SCHEMA: Optional[InvoiceSchema] = None
+
+
+def _invoice_schema(cur) -> InvoiceSchema:
+    global _INVOICE_SCHEMA
+    if _INVOICE_SCHEMA is None:
+        _INVOICE_SCHEMA = InvoiceSchema.from_cursor(cur)
+    return _INVOICE_SCHEMA
 
 
 def _notify_admin(
@@ -136,7 +285,6 @@ def _notify_admin(
     dedupe_key: Optional[str] = None,
     priority: Optional[int] = None,
 ) -> None:
-    safe_meta = _json_safe(meta or {})
     create_notification(
         user_role="Admin",
         title=title,
@@ -144,7 +292,7 @@ def _notify_admin(
         notif_type=notif_type,
         related_table=related_table,
         related_id=related_id,
-        meta=safe_meta,
+        meta=meta or {},  # create_notification serializes Decimal/date values itself
         dedupe_key=dedupe_key,
         priority=priority,
         conn=conn,
@@ -177,74 +325,146 @@ def _notify_patient(
         conn=conn,
     )
 
+CATALOG_PRICE_TTL_SEC = 300
+# normalized procedure key -> (expires_at monotonic, price or None)
+_CATALOG_PRICE_CACHE: Dict[str, Tuple[float, Optional[float]]] = {}
+
+
+def _catalog_cols(cur) -> Tuple[Optional[str], Optional[str]]:
+    """(key_col, price_col) of procedure_catalog, (None, None) if unusable."""
+    if not _table_exists(cur, "procedure_catalog"):
+        return None, None
+
+    key_col = None
+    if _column_exists(cur, "procedure_catalog", "procedure_type"):
+        key_col = "procedure_type"
+    elif _column_exists(cur, "procedure_catalog", "code"):
+        key_col = "code"
+
+    price_col = None
+    for col in ("default_price", "price", "amount"):
+        if _column_exists(cur, "procedure_catalog", col):
+            price_col = col
+            break
+
+    if not key_col or not price_col:
+        return None, None
+    return key_col, price_col
+
+
+def _catalog_price_sql(key_col: str, price_col: str, proc_expr: str) -> str:
+    """
+    Scalar subquery pricing `proc_expr` from procedure_catalog: the key is normalized
+    like _norm() and the first matching catalog row is used (NULL when none).
+    """
+    norm = (
+        f"COALESCE(NULLIF(LEFT(UPPER(REPLACE(REPLACE(TRIM({proc_expr}), '-', '_'), ' ', '_')), 80), ''),"
+        " 'CONSULTATION')"
+    )
+    return f"(SELECT pc.{price_col} FROM procedure_catalog pc WHERE pc.{key_col} = {norm} LIMIT 1)"
+
+
+def _get_catalog_prices(conn, procedure_types: List[Any]) -> Dict[str, Optional[float]]:
+    """
+    Catalog price per normalized procedure key. Served from a short TTL cache;
+    misses are fetched together in one IN (...) query.
+    """
+    now = time.monotonic()
+    out: Dict[str, Optional[float]] = {}
+    missing: List[str] = []
+    for pt in dict.fromkeys(_norm(p) for p in procedure_types):
+        hit = _CATALOG_PRICE_CACHE.get(pt)
+        if hit is not None and hit[0] > now:
+            out[pt] = hit[1]
+        else:
+            missing.append(pt)
+    if not missing:
+        return out
+
+    found: Dict[str, float] = {}
+    with conn.cursor() as cur:
+        key_col, price_col = _catalog_cols(cur)
+        if not key_col:
+            for pt in missing:
+                out[pt] = None
+            return out
+
+        cur.execute(
+            f"SELECT {key_col} AS k, {price_col} AS p FROM procedure_catalog "
+            f"WHERE {key_col} IN ({', '.join(['%s'] * len(missing))})",
+            tuple(missing),
+        )
+        for k, p in _row_values(cur, list(cur.fetchall() or []), "k", "p"):
+            k = _norm(k)
+            # first row per key wins, as with the old LIMIT 1 lookup
+            if p is not None and k not in found:
+                found[k] = float(p)
+
+    expires = now + CATALOG_PRICE_TTL_SEC
+    for pt in missing:
+        price = found.get(pt)
+        _CATALOG_PRICE_CACHE[pt] = (expires, price)
+        out[pt] = price
+    return out
+
+
 def _get_catalog_price(conn, procedure_type: str) -> Optional[float]:
     pt = _norm(procedure_type)
-    with conn.cursor() as cur:
-        if not _table_exists(cur, "procedure_catalog"):
-            return None
+    return _get_catalog_prices(conn, [pt]).get(pt)
 
-        key_col = None
-        if _column_exists(cur, "procedure_catalog", "procedure_type"):
-            key_col = "procedure_type"
-        elif _column_exists(cur, "procedure_catalog", "code"):
-            key_col = "code"
 
-        price_col = None
-        for col in ("default_price", "price", "amount"):
-            if _column_exists(cur, "procedure_catalog", col):
-                price_col = col
-                break
+_VISIT_ITEMS_SQL: Dict[str, Optional[str]] = {}
 
-        if not key_col or not price_col:
-            return None
 
-        cur.execute(f"SELECT {price_col} AS p FROM procedure_catalog WHERE {key_col}=%s LIMIT 1", (pt,))
-        r = cur.fetchone()
-        if r and (r.get("p") if isinstance(r, dict) else r[0]) is not None:
-            return float(r.get("p") if isinstance(r, dict) else r[0])
-    return None
+def _visit_items_sql(cur) -> Optional[str]:
+    """visit_procedures line-item SELECT (param: visit_id), built once; None if unusable."""
+    if "sql" not in _VISIT_ITEMS_SQL:
+        _VISIT_ITEMS_SQL["sql"] = _build_visit_items_sql(cur)
+    return _VISIT_ITEMS_SQL["sql"]
 
 
-def _sum_visit_items(conn, *, visit_id: int) -> List[Dict[str, Any]]:
-    with conn.cursor() as cur:
-        if not _table_exists(cur, "visit_procedures"):
-            return []
+def _build_visit_items_sql(cur) -> Optional[str]:
+    if not _table_exists(cur, "visit_procedures"):
+        return None
 
-        proc_col = None
-        if _column_exists(cur, "visit_procedures", "procedure_type"):
-            proc_col = "procedure_type"
-        elif _column_exists(cur, "visit_procedures", "procedure_code"):
-            proc_col = "procedure_code"
+    proc_col = None
+    if _column_exists(cur, "visit_procedures", "procedure_type"):
+        proc_col = "procedure_type"
+    elif _column_exists(cur, "visit_procedures", "procedure_code"):
+        proc_col = "procedure_code"
 
-        qty_col = "qty" if _column_exists(cur, "visit_procedures", "qty") else (
-            "quantity" if _column_exists(cur, "visit_procedures", "quantity") else None
-        )
-        unit_col = "unit_price" if _column_exists(cur, "visit_procedures", "unit_price") else None
-        amount_col = "amount" if _column_exists(cur, "visit_procedures", "amount") else None
+    qty_col = "qty" if _column_exists(cur, "visit_procedures", "qty") else (
+        "quantity" if _column_exists(cur, "visit_procedures", "quantity") else None
+    )
+    unit_col = "unit_price" if _column_exists(cur, "visit_procedures", "unit_price") else None
+    amount_col = "amount" if _column_exists(cur, "visit_procedures", "amount") else None
 
-        if not proc_col or not qty_col:
-            return []
+    if not proc_col or not qty_col:
+        return None
+
+    # rows without a unit_price are priced from the catalog in the same statement
+    key_col, price_col = _catalog_cols(cur)
+    catalog_sql = _catalog_price_sql(key_col, price_col, f"vp.{proc_col}") if key_col else "NULL"
+    sel_unit = f"COALESCE(vp.{unit_col}, {catalog_sql}) AS unit_price" if unit_col else f"{catalog_sql} AS unit_price"
+    sel_amt = f"vp.{amount_col} AS amount" if amount_col else "NULL AS amount"
+    return f"""
+        SELECT vp.{proc_col} AS proc, vp.{qty_col} AS qty, {sel_unit}, {sel_amt}
+        FROM visit_procedures vp
+        WHERE vp.visit_id=%s
+        """
 
-        sel_unit = f"{unit_col} AS unit_price" if unit_col else "NULL AS unit_price"
-        sel_amt = f"{amount_col} AS amount" if amount_col else "NULL AS amount"
-        cur.execute(
-            f"""
-            SELECT {proc_col} AS proc, {qty_col} AS qty, {sel_unit}, {sel_amt}
-            FROM visit_procedures
-            WHERE visit_id=%s
-            """,
-            (visit_id,),
-        )
-        rows = list(cur.fetchall() or [])
+
+def _sum_visit_items(conn, *, visit_id: int) -> List[Dict[str, Any]]:
+    with conn.cursor() as cur:
+        sql = _visit_items_sql(cur)
+        if not sql:
+            return []
+        cur.execute(sql, (visit_id,))
+        rows = _row_values(cur, list(cur.fetchall() or []), "proc", "qty", "unit_price", "amount")
 
     items: List[Dict[str, Any]] = []
-    for r in rows:
-        pt = r.get("proc") if isinstance(r, dict) else r[0]
-        qty = float(r.get("qty") if isinstance(r, dict) else r[1] or 1)
-        unit = r.get("unit_price") if isinstance(r, dict) else r[2]
-        amt = r.get("amount") if isinstance(r, dict) else r[3]
-        if unit is None:
-            unit = _get_catalog_price(conn, pt) or 0.0
+    for pt, qty, unit, amt in rows:
+        qty = float(qty if qty is not None else 1)
         unit = float(unit or 0)
         if amt is None:
             amt = unit * qty
@@ -278,15 +498,16 @@ def _ensure_provisional_invoice(conn, *, appointment_id: int, patient_id: int, p
         cols = ["appointment_id", "patient_id", "invoice_type", "status", "amount"]
         vals = [appointment_id, patient_id, "PROVISIONAL", "Pending", est]
 
+        now_s = _now_str()
         if _column_exists(cur, "invoices", "issue_date"):
             cols.append("issue_date")
-            vals.append(_today().strftime("%Y-%m-%d"))
+            vals.append(now_s[:10])
         if _column_exists(cur, "invoices", "created_at"):
             cols.append("created_at")
-            vals.append(_now_str())
+            vals.append(now_s)
         if _column_exists(cur, "invoices", "updated_at"):
             cols.append("updated_at")
-            vals.append(_now_str())
+            vals.append(now_s)
 
         placeholders = ",".join(["%s"] * len(vals))
         cur.execute(f"INSERT INTO invoices ({','.join(cols)}) VALUES ({placeholders})", tuple(vals))
@@ -309,7 +530,7 @@ def _ensure_provisional_invoice(conn, *, appointment_id: int, patient_id: int, p
                 if _column_exists(cur, "invoice_items", "amount"):
                     cols2.append("amount"); vals2.append(est)
                 if _column_exists(cur, "invoice_items", "created_at"):
-                    cols2.append("created_at"); vals2.append(_now_str())
+                    cols2.append("created_at"); vals2.append(now_s)
 
                 cur.execute(
                     f"INSERT INTO invoice_items ({','.join(cols2)}) VALUES ({','.join(['%s'] * len(vals2))})",
@@ -322,21 +543,28 @@ def _ensure_provisional_invoice(conn, *, appointment_id: int, patient_id: int, p
 
 def _calc_chair_minutes(appt: Dict[str, Any]) -> Optional[int]:
     def _parse_time(t: Any) -> Optional[int]:
+        # minutes since midnight for TIME values (timedelta from the driver) or "HH:MM[:SS]"
         if not t:
             return None
-        s = str(t)
-        for fmt in ("%H:%M:%S", "%H:%M"):
-            try:
-                dt = datetime.strptime(s, fmt)
-                return dt.hour * 60 + dt.minute
-            except Exception:
-                continue
-        return None
+        if isinstance(t, timedelta):
+            secs = int(t.total_seconds())
+            return secs // 60 if 0 <= secs < 86400 else None
+        parts = str(t).split(":")
+        if len(parts) not in (2, 3) or not all(p.isdigit() and len(p) <= 2 for p in parts):
+            return None
+        h, m = int(parts[0]), int(parts[1])
+        if h > 23 or m > 59 or (len(parts) == 3 and int(parts[2]) > 61):
+            return None
+        return h * 60 + m
+
+    def _parse_dt(v: Any) -> datetime:
+        # DATETIME columns already arrive as datetime; fromisoformat accepts the space separator
+        return v if isinstance(v, datetime) else datetime.fromisoformat(str(v))
 
     if appt.get("actual_start_at") and appt.get("actual_end_at"):
         try:
-            s = datetime.fromisoformat(str(appt["actual_start_at"]).replace(" ", "T"))
-            e = datetime.fromisoformat(str(appt["actual_end_at"]).replace(" ", "T"))
+            s = _parse_dt(appt["actual_start_at"])
+            e = _parse_dt(appt["actual_end_at"])
             return max(1, int((e - s).total_seconds() // 60))
         except Exception:
             pass
@@ -360,20 +588,39 @@ def _update_daily_analytics(
     *,
     usage_date: str,
     doctor_id: Optional[int],
-    procedure_code: str,
-    amount: float,
-    qty: float,
+    procedures: List[Tuple[str, float, float]],
     chair_minutes: Optional[int],
 ) -> None:
+    """
+    Upsert revenue_analytics_daily for each (procedure_code, amount, qty) in a single
+    multi-row statement. Items sharing a code are merged into one row first; the totals
+    (including appointment_count/chair_minutes per item) match separate upserts.
+    """
+    if not procedures:
+        return
     with conn.cursor() as cur:
         if not _table_exists(cur, "revenue_analytics_daily"):
             return
 
+        doc = int(doctor_id) if doctor_id else None
+        minutes = int(chair_minutes or 0)
+        # code -> [amount, qty, item count]
+        agg: Dict[str, List[float]] = {}
+        for procedure_code, amount, qty in procedures:
+            a = agg.setdefault(procedure_code[:64], [0.0, 0.0, 0])
+            a[0] += float(amount)
+            a[1] += float(qty)
+            a[2] += 1
+        params: List[Any] = []
+        for code, (amount, qty, n) in agg.items():
+            params.extend((usage_date, doc, code, amount, qty, n, minutes * n))
         cur.execute(
             """
             INSERT INTO revenue_analytics_daily
               (usage_date, doctor_id, procedure_code, total_revenue, total_qty, appointment_count, chair_minutes, created_at, updated_at)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
+            VALUES """
+            + ", ".join(["(%s, %s, %s, %s, %s, %s, %s, NOW(), NOW())"] * len(agg))
+            + """
             ON DUPLICATE KEY UPDATE
               total_revenue = total_revenue + VALUES(total_revenue),
               total_qty = total_qty + VALUES(total_qty),
@@ -381,15 +628,7 @@ def _update_daily_analytics(
               chair_minutes = chair_minutes + VALUES(chair_minutes),
               updated_at = NOW()
             """,
-            (
-                usage_date,
-                int(doctor_id) if doctor_id else None,
-                procedure_code[:64],
-                float(amount),
-                float(qty),
-                1,
-                int(chair_minutes or 0),
-            ),
+            tuple(params),
         )
 
 
@@ -399,16 +638,28 @@ def _detect_leakage(conn, *, appointment_id: int, visit_id: int, invoice_id: int
         if not (_table_exists(cur, "visit_procedures") and _table_exists(cur, "invoices")):
             return findings
 
-        cur.execute("SELECT COUNT(*) AS c FROM visit_procedures WHERE visit_id=%s", (visit_id,))
-        vp = int((cur.fetchone() or {}).get("c") or 0)
-
-        ii = 0
-        if _table_exists(cur, "invoice_items"):
-            cur.execute("SELECT COUNT(*) AS c FROM invoice_items WHERE invoice_id=%s", (invoice_id,))
-            ii = int((cur.fetchone() or {}).get("c") or 0)
-
-        cur.execute("SELECT amount FROM invoices WHERE id=%s", (invoice_id,))
-        amt = float((cur.fetchone() or {}).get("amount") or 0)
+        # visit/invoice counts, invoice amount and follow-up flags in one round trip
+        has_items = _table_exists(cur, "invoice_items")
+        has_follow_up = _column_exists(cur, "appointments", "follow_up_required") and _column_exists(
+            cur, "appointments", "follow_up_date"
+        )
+        sel = [
+            "(SELECT COUNT(*) FROM visit_procedures WHERE visit_id=%s) AS vp",
+            "(SELECT COUNT(*) FROM invoice_items WHERE invoice_id=%s) AS ii" if has_items else "0 AS ii",
+            "(SELECT amount FROM invoices WHERE id=%s) AS amt",
+        ]
+        params: List[Any] = [visit_id] + ([invoice_id] if has_items else []) + [invoice_id]
+        if has_follow_up:
+            sel.append(
+                "(SELECT follow_up_required FROM appointments WHERE id=%s LIMIT 1) AS fr,"
+                " (SELECT follow_up_date FROM appointments WHERE id=%s LIMIT 1) AS fd"
+            )
+            params += [appointment_id, appointment_id]
+        cur.execute("SELECT " + ", ".join(sel), tuple(params))
+        probe = cur.fetchone() or {}
+        vp = int(probe.get("vp") or 0)
+        ii = int(probe.get("ii") or 0)
+        amt = float(probe.get("amt") or 0)
 
         if vp > 0 and ii == 0:
             findings.append({"type": "REVENUE_LEAK_UNBILLED", "meta": {"visit_procedure_count": vp}})
@@ -417,7 +668,8 @@ def _detect_leakage(conn, *, appointment_id: int, visit_id: int, invoice_id: int
             findings.append({"type": "REVENUE_LEAK_MISSING_CHARGES", "meta": {"invoice_amount": amt}})
 
         expected_total = 0.0
-        if vp > 0 and _table_exists(cur, "procedure_catalog"):
+        key_col, price_col = _catalog_cols(cur) if vp > 0 else (None, None)
+        if key_col:
             proc_col = "procedure_code" if _column_exists(cur, "visit_procedures", "procedure_code") else (
                 "procedure_type" if _column_exists(cur, "visit_procedures", "procedure_type") else None
             )
@@ -425,16 +677,18 @@ def _detect_leakage(conn, *, appointment_id: int, visit_id: int, invoice_id: int
                 "quantity" if _column_exists(cur, "visit_procedures", "quantity") else None
             )
             if proc_col and qty_col:
+                # qty x catalog price summed server-side
+                price_sql = _catalog_price_sql(key_col, price_col, f"vp.{proc_col}")
                 cur.execute(
-                    f"SELECT {proc_col} AS p, {qty_col} AS q FROM visit_procedures WHERE visit_id=%s",
+                    f"""
+                    SELECT COALESCE(SUM(COALESCE(vp.{qty_col}, 1) * COALESCE({price_sql}, 0)), 0) AS expected
+                    FROM visit_procedures vp
+                    WHERE vp.visit_id=%s
+                    """,
                     (visit_id,),
                 )
-                rows = list(cur.fetchall() or [])
-                for r in rows:
-                    code = r.get("p") if isinstance(r, dict) else r[0]
-                    qty = float(r.get("q") if isinstance(r, dict) else r[1] or 1)
-                    price = _get_catalog_price(conn, code) or 0.0
-                    expected_total += price * qty
+                r = cur.fetchone()
+                expected_total = float((r.get("expected") if isinstance(r, dict) else (r or [0])[0]) or 0)
 
         if expected_total > 0 and amt > 0 and amt < expected_total * UNDERCODE_FACTOR:
             findings.append(
@@ -444,14 +698,9 @@ def _detect_leakage(conn, *, appointment_id: int, visit_id: int, invoice_id: int
                 }
             )
 
-        if _column_exists(cur, "appointments", "follow_up_required") and _column_exists(cur, "appointments", "follow_up_date"):
-            cur.execute(
-                "SELECT follow_up_required, follow_up_date FROM appointments WHERE id=%s LIMIT 1",
-                (appointment_id,),
-            )
-            row = cur.fetchone() or {}
-            required = int(row.get("follow_up_required") or 0)
-            if required and not row.get("follow_up_date"):
+        if has_follow_up:
+            required = int(probe.get("fr") or 0)
+            if required and not probe.get("fd"):
                 findings.append({"type": "REVENUE_LEAK_FOLLOW_UP", "meta": {"follow_up_required": True}})
 
     return findings
@@ -460,41 +709,9 @@ def _detect_leakage(conn, *, appointment_id: int, visit_id: int, invoice_id: int
 def _detect_claim_issues(conn, *, invoice_id: int) -> List[Dict[str, Any]]:
     issues: List[Dict[str, Any]] = []
     with conn.cursor() as cur:
-        if not _table_exists(cur, "invoices"):
-            return issues
-
-        cols = {c: _column_exists(cur, "invoices", c) for c in (
-            "claim_status",
-            "insurance_status",
-            "claim_submitted_at",
-            "claim_rejected_at",
-            "claim_denied_at",
-            "paid_date",
-        )}
-
-        if cols.get("claim_status") or cols.get("insurance_status"):
-            cur.execute(
-                """
-                SELECT
-                  {claim_status} AS claim_status,
-                  {insurance_status} AS insurance_status,
-                  {claim_submitted_at} AS claim_submitted_at,
-                  {claim_rejected_at} AS claim_rejected_at,
-                  {claim_denied_at} AS claim_denied_at,
-                  {paid_date} AS paid_date
-                FROM invoices
-                WHERE id=%s
-                LIMIT 1
-                """.format(
-                    claim_status="claim_status" if cols.get("claim_status") else "NULL",
-                    insurance_status="insurance_status" if cols.get("insurance_status") else "NULL",
-                    claim_submitted_at="claim_submitted_at" if cols.get("claim_submitted_at") else "NULL",
-                    claim_rejected_at="claim_rejected_at" if cols.get("claim_rejected_at") else "NULL",
-                    claim_denied_at="claim_denied_at" if cols.get("claim_denied_at") else "NULL",
-                    paid_date="paid_date" if cols.get("paid_date") else "NULL",
-                ),
-                (invoice_id,),
-            )
+        schema = _invoice_schema(cur)
+        if schema.claim_select:
+            cur.execute(schema.claim_select, (invoice_id,))
             row = cur.fetchone() or {}
 
             status = str(row.get("claim_status") or row.get("insurance_status") or "").upper()
@@ -525,7 +742,6 @@ def _write_revenue_insight(
         if not _table_exists(cur, "revenue_insights"):
             return
 
-        safe_payload = _json_safe(payload)
         cols = ["as_of_date", "raw_json"]
         vals: List[Any] = [as_of.strftime("%Y-%m-%d"), _json_dumps_safe(payload)]
 
@@ -533,10 +749,10 @@ def _write_revenue_insight(
             cols.append("insight_type"); vals.append(str(insight_type)[:64])
         if range_label and _column_exists(cur, "revenue_insights", "range_label"):
             cols.append("range_label"); vals.append(str(range_label)[:16])
-        if _column_exists(cur, "revenue_insights", "forecast_json") and safe_payload.get("forecast"):
-            cols.append("forecast_json"); vals.append(_json_dumps_safe({"forecast": safe_payload.get("forecast")}))
-        if _column_exists(cur, "revenue_insights", "kpi_json") and safe_payload.get("kpis"):
-            cols.append("kpi_json"); vals.append(_json_dumps_safe({"kpis": safe_payload.get("kpis")}))
+        if _column_exists(cur, "revenue_insights", "forecast_json") and payload.get("forecast"):
+            cols.append("forecast_json"); vals.append(_json_dumps_safe({"forecast": payload.get("forecast")}))
+        if _column_exists(cur, "revenue_insights", "kpi_json") and payload.get("kpis"):
+            cols.append("kpi_json"); vals.append(_json_dumps_safe({"kpis": payload.get("kpis")}))
 
         placeholders = ",".join(["%s"] * len(vals))
         col_sql = ",".join(cols)
@@ -551,41 +767,53 @@ def _write_revenue_insight(
         )
 
 
-def _compute_forecast(conn, *, days: int = 60) -> Dict[str, Any]:
+def _ai_forecast_summary(drivers_text: str) -> str:
+    """
+    LLM summary for the rounded forecast metrics. Repeated metrics are answered
+    from ai_text's response cache; failures raise and are not cached.
+    """
     from ..ai import ai_text
 
-    with conn.cursor() as cur:
-        if not _table_exists(cur, "invoices"):
-            return {}
-
-        date_col = "issue_date" if _column_exists(cur, "invoices", "issue_date") else "created_at"
-        paid_col = "paid_date" if _column_exists(cur, "invoices", "paid_date") else None
+    prompt = (
+        f"Analyze these dental clinic revenue metrics:\n{drivers_text}\n"
+        "Write a 4-5 line simple, direct management summary suggesting actions. "
+        "Focus on cash flow and trends."
+    )
+    return ai_text("You are a financial analyst.", prompt, max_tokens=200)
 
-        cur.execute(
-            f"""
-            SELECT {date_col} AS d, SUM(amount) AS total
-            FROM invoices
-            WHERE {date_col} >= DATE_SUB(CURDATE(), INTERVAL %s DAY)
-              AND (status IN ('Paid','PAID','paid') { "OR " + paid_col + " IS NOT NULL" if paid_col else "" })
-            GROUP BY {date_col}
-            ORDER BY {date_col} ASC
-            """,
-            (int(days),),
-        )
-        rows = list(cur.fetchall() or [])
 
-    series: List[Tuple[date, float]] = []
-    for r in rows:
-        d = r.get("d") if isinstance(r, dict) else r[0]
-        total = float(r.get("total") if isinstance(r, dict) else r[1] or 0)
+def _summary_on_own_conn(fn):
+    c = get_conn()
+    try:
+        return fn(c)
+    finally:
         try:
-            dd = d if isinstance(d, date) else datetime.fromisoformat(str(d)).date()
+            c.close()
         except Exception:
-            continue
-        series.append((dd, total))
+            pass
+
+
+def _compute_forecast(conn, *, days: int = 60) -> Dict[str, Any]:
+    if not FORECAST_PARALLEL:
+        return _compute_forecast_impl(conn, days=days)
 
-    series.sort(key=lambda x: x[0])
-    if not series:
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        pay_f = pool.submit(_summary_on_own_conn, _payment_probability_summary)
+        claim_f = pool.submit(_summary_on_own_conn, _claim_approval_likelihood_summary)
+        return _compute_forecast_impl(conn, days=days, summaries=(pay_f, claim_f))
+
+
+def _compute_forecast_impl(conn, *, days: int, summaries=None) -> Dict[str, Any]:
+    with conn.cursor() as cur:
+        schema = _invoice_schema(cur)
+        if not schema.has_invoices:
+            return {}
+
+        cur.execute(schema.forecast_sql, (int(days),))
+        agg = cur.fetchone() or {}
+
+    n = int(agg.get("n") or 0)
+    if not n:
         return {
             "series_days": 0,
             "forecast_7d": 0,
@@ -595,38 +823,40 @@ def _compute_forecast(conn, *, days: int = 60) -> Dict[str, Any]:
             "ai_summary": "Not enough data to generate summary.",
         }
 
-    totals = [v for _, v in series]
-    avg7 = sum(totals[-7:]) / max(1, min(7, len(totals)))
-    avg30 = sum(totals[-30:]) / max(1, min(30, len(totals)))
+    avg7 = float(agg.get("s7") or 0) / min(7, n)
+    avg30 = float(agg.get("s30") or 0) / min(30, n)
 
     trend = 0.0
-    if len(totals) >= 14:
-        prev7 = sum(totals[-14:-7]) / 7.0
+    if n >= 14:
+        prev7 = float(agg.get("s_prev7") or 0) / 7.0
         trend = avg7 - prev7
 
-    pay_prob = _payment_probability_summary(conn)
-    claim_prob = _claim_approval_likelihood_summary(conn)
+    ok = False
+    if summaries is not None:
+        try:
+            pay_prob, claim_prob = summaries[0].result(), summaries[1].result()
+            ok = True
+        except Exception:
+            pass  # a side connection failed; fall back to the worker connection
+    if not ok:
+        pay_prob = _payment_probability_summary(conn)
+        claim_prob = _claim_approval_likelihood_summary(conn)
 
     # Generate AI Summary
     ai_summary = ""
     try:
         drivers_text = f"7-day Avg: {avg7:.2f}, 30-day Avg: {avg30:.2f}, Trend: {trend:.2f}"
         if pay_prob: drivers_text += f", Payment Prob: {pay_prob:.2f}"
-        
-        prompt = (
-            f"Analyze these dental clinic revenue metrics:\n{drivers_text}\n"
-            "Write a 4-5 line simple, direct management summary suggesting actions. "
-            "Focus on cash flow and trends."
-        )
-        ai_summary = ai_text("You are a financial analyst.", prompt, max_tokens=200)
+
+        ai_summary = _ai_forecast_summary(drivers_text)
     except Exception:
         ai_summary = "AI summary temporarily unavailable."
 
     forecast = {
-        "series_days": len(totals),
+        "series_days": n,
         "forecast_7d": round(avg7 * 7, 2),
         "forecast_30d": round(avg30 * 30, 2),
-        "confidence": round(min(1.0, max(0.2, len(totals) / 30.0)), 2),
+        "confidence": round(min(1.0, max(0.2, n / 30.0)), 2),
         "payment_probability_avg": pay_prob,
         "claim_approval_likelihood": claim_prob,
         "drivers": [
@@ -641,59 +871,24 @@ def _compute_forecast(conn, *, days: int = 60) -> Dict[str, Any]:
 
 def _payment_probability_summary(conn) -> Optional[float]:
     with conn.cursor() as cur:
-        if not _table_exists(cur, "invoices"):
+        schema = _invoice_schema(cur)
+        if not schema.payment_prob_sql:
             return None
-        if not _column_exists(cur, "invoices", "patient_id"):
-            return None
-        if not _column_exists(cur, "invoices", "status"):
-            return None
-        date_col = "issue_date" if _column_exists(cur, "invoices", "issue_date") else "created_at"
-        cur.execute(
-            f"""
-            SELECT patient_id,
-                   SUM(CASE WHEN status IN ('Paid','PAID','paid') THEN 1 ELSE 0 END) AS paid_cnt,
-                   COUNT(*) AS total_cnt
-            FROM invoices
-            WHERE {date_col} >= DATE_SUB(CURDATE(), INTERVAL 180 DAY)
-            GROUP BY patient_id
-            """
-        )
-        rows = list(cur.fetchall() or [])
-
-    if not rows:
-        return None
+        cur.execute(schema.payment_prob_sql)
+        row = cur.fetchone() or {}
 
-    probs = []
-    for r in rows:
-        paid = float(r.get("paid_cnt") if isinstance(r, dict) else r[1] or 0)
-        total = float(r.get("total_cnt") if isinstance(r, dict) else r[2] or 0)
-        if total > 0:
-            probs.append(paid / total)
-    if not probs:
+    p = row.get("p") if isinstance(row, dict) else row[0]
+    if p is None:
         return None
-    return round(sum(probs) / len(probs), 2)
+    return round(float(p), 2)
 
 
 def _claim_approval_likelihood_summary(conn) -> Optional[float]:
     with conn.cursor() as cur:
-        if not _table_exists(cur, "invoices"):
+        schema = _invoice_schema(cur)
+        if not schema.claim_approval_sql:
             return None
-        has_claim = _column_exists(cur, "invoices", "claim_status")
-        has_ins = _column_exists(cur, "invoices", "insurance_status")
-        if not (has_claim or has_ins):
-            return None
-        status_col = "claim_status" if has_claim else "insurance_status"
-        date_col = "issue_date" if _column_exists(cur, "invoices", "issue_date") else "created_at"
-
-        cur.execute(
-            f"""
-            SELECT
-              SUM(CASE WHEN {status_col} IN ('APPROVED','Approved','PAID','Paid') THEN 1 ELSE 0 END) AS ok_cnt,
-              SUM(CASE WHEN {status_col} IN ('REJECTED','Rejected','DENIED','Denied') THEN 1 ELSE 0 END) AS bad_cnt
-            FROM invoices
-            WHERE {date_col} >= DATE_SUB(CURDATE(), INTERVAL 180 DAY)
-            """
-        )
+        cur.execute(schema.claim_approval_sql)
         row = cur.fetchone() or {}
 
     ok_cnt = float(row.get("ok_cnt") if isinstance(row, dict) else row[0] or 0)
@@ -709,22 +904,11 @@ def _write_reports(conn) -> None:
 
     def _range_kpi(days: int) -> Dict[str, Any]:
         with conn.cursor() as cur:
-            if not _table_exists(cur, "invoices"):
+            schema = _invoice_schema(cur)
+            if not schema.has_invoices:
                 return {}
 
-            date_col = "issue_date" if _column_exists(cur, "invoices", "issue_date") else "created_at"
-            cur.execute(
-                f"""
-                SELECT
-                  COUNT(*) AS invoice_count,
-                  COALESCE(SUM(amount),0) AS total_billed,
-                  COALESCE(SUM(CASE WHEN status IN ('Paid','PAID','paid') THEN amount ELSE 0 END),0) AS total_paid,
-                  COALESCE(SUM(CASE WHEN status IN ('Pending','PENDING','Overdue','OVERDUE') THEN amount ELSE 0 END),0) AS total_pending
-                FROM invoices
-                WHERE {date_col} >= DATE_SUB(CURDATE(), INTERVAL %s DAY)
-                """,
-                (int(days),),
-            )
+            cur.execute(schema.range_kpi_sql, (int(days),))
             return cur.fetchone() or {}
 
     for label, days in (("7d", 7), ("30d", 30), ("90d", 90)):
@@ -753,67 +937,67 @@ def _ar_reminders_sweep(conn) -> None:
         if not _column_exists(cur, "invoices", "issue_date"):
             return
 
+        # overdue days and reminder level come back from the server; only invoices at least
+        # AR_REMINDER_1_DAYS old are read (issue_date range keeps the predicate index-friendly)
+        today = _today()
         cur.execute(
             """
-            SELECT id, patient_id, amount, status, issue_date
+            SELECT id, patient_id, amount,
+                   DATEDIFF(%s, issue_date) AS d_over,
+                   CASE
+                     WHEN DATEDIFF(%s, issue_date) >= %s THEN 'AR_ESCALATION_CALL'
+                     WHEN DATEDIFF(%s, issue_date) >= %s THEN 'AR_REMINDER_2'
+                     ELSE 'AR_REMINDER_1'
+                   END AS level
             FROM invoices
             WHERE status IN ('Pending','PENDING','Overdue','OVERDUE')
               AND issue_date IS NOT NULL
+              AND issue_date < %s
             ORDER BY issue_date ASC
             LIMIT 500
-            """
+            """,
+            (
+                today,
+                today,
+                AR_ESCALATION_DAYS,
+                today,
+                AR_REMINDER_2_DAYS,
+                today - timedelta(days=AR_REMINDER_1_DAYS - 1),
+            ),
         )
-        rows = list(cur.fetchall() or [])
-
-    for r in rows:
-        inv_id = int(r.get("id") if isinstance(r, dict) else r[0])
-        patient_id = int(r.get("patient_id") if isinstance(r, dict) else r[1] or 0)
-        amount = float(r.get("amount") if isinstance(r, dict) else r[2] or 0)
-        issue_date = r.get("issue_date") if isinstance(r, dict) else r[4]
+        rows = _row_values(cur, list(cur.fetchall() or []), "id", "patient_id", "amount", "d_over", "level")
 
-        try:
-            issued = issue_date if isinstance(issue_date, date) else datetime.fromisoformat(str(issue_date)).date()
-        except Exception:
-            continue
+    due: List[Tuple[str, int, int, float, int, str]] = []  # (dedupe, inv_id, patient_id, amount, days, level)
+    for inv_id, patient_id, amount, days_overdue, level in rows:
+        inv_id = int(inv_id)
+        patient_id = int(patient_id or 0)
+        amount = float(amount or 0)
+        days_overdue = int(days_overdue)
+        level = str(level)
 
-        days_overdue = (_today() - issued).days
-        if days_overdue < AR_REMINDER_1_DAYS:
-            continue
+        dedupe = f"ar_reminder:{level}:{inv_id}:{today.strftime('%Y-%m-%d')}"
+        due.append((dedupe, inv_id, patient_id, amount, days_overdue, level))
 
-        if days_overdue >= AR_ESCALATION_DAYS:
-            level = "AR_ESCALATION_CALL"
-        elif days_overdue >= AR_REMINDER_2_DAYS:
-            level = "AR_REMINDER_2"
-        else:
-            level = "AR_REMINDER_1"
+    if not due:
+        return
+    # claim every reminder's dedupe key in one statement; only claimed ones are sent
+    with conn.cursor() as cur:
+        claimed = _claim_idempotency_locks(cur, [d[0] for d in due], ttl_hours=24, locked_by="revenue-agent")
 
-        dedupe = f"ar_reminder:{level}:{inv_id}:{_today().strftime('%Y-%m-%d')}"
-        with conn.cursor() as cur:
-            if not _insert_idempotency_lock(cur, dedupe, ttl_hours=24):
-                continue
+    # patient + admin notifications for every claimed reminder go out as one batch
+    notes: List[Dict[str, Any]] = []
+    for dedupe, inv_id, patient_id, amount, days_overdue, level in due:
+        if dedupe not in claimed:
+            continue
 
         msg = f"Invoice #{inv_id} is overdue by {days_overdue} days. Amount due: INR {amount:.2f}."
+        common = {"notif_type": level, "message": msg, "related_table": "invoices", "related_id": inv_id}
+        if patient_id:
+            notes.append({"user_id": patient_id, "title": "Payment reminder", **common})
+        notes.append({"user_role": "Admin", "title": "Accounts receivable reminder", "meta": {}, **common})
 
-        _notify_patient(
-            conn,
-            patient_id=patient_id,
-            notif_type=level,
-            title="Payment reminder",
-            message=msg,
-            related_table="invoices",
-            related_id=inv_id,
-            dedupe_key=None,
-        )
-
-        _notify_admin(
-            conn,
-            notif_type=level,
-            title="Accounts receivable reminder",
-            message=msg,
-            related_table="invoices",
-            related_id=inv_id,
-            dedupe_key=None,
-        )
+    if notes:
+        create_notifications(notes, conn=conn)
 
 
 def on_appointment_created(conn, payload: Dict[str, Any]) -> None:
@@ -822,11 +1006,6 @@ def on_appointment_created(conn, payload: Dict[str, Any]) -> None:
         return
 
     with conn.cursor() as cur:
-        try:
-            cur.execute("SET time_zone = '+05:30'")
-        except Exception:
-            pass
-
         if not _table_exists(cur, "appointments"):
             return
 
@@ -854,25 +1033,40 @@ def on_appointment_created(conn, payload: Dict[str, Any]) -> None:
     conn.commit()
 
 
+_APPT_COMPLETION_COLS = (
+    "id",
+    "patient_id",
+    "doctor_id",
+    "type",
+    "scheduled_date",
+    "scheduled_time",
+    "scheduled_end_time",
+    "predicted_duration_min",
+    "actual_start_at",
+    "actual_end_at",
+)
+
+
 def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
     appt_id = int(payload.get("appointmentId") or 0)
     if not appt_id:
         return
 
+    # one clock read per event: every row stamped below shares it
+    now_s = _now_str()
+    today_s = now_s[:10]
+
     visit_id = 0
     inv_id = 0
     appt: Dict[str, Any] = {}
 
     with conn.cursor() as cur:
-        try:
-            cur.execute("SET time_zone = '+05:30'")
-        except Exception:
-            pass
-
         if not _table_exists(cur, "appointments"):
             return
 
-        cur.execute("SELECT * FROM appointments WHERE id=%s", (appt_id,))
+        # only the columns read below (billing, analytics and _calc_chair_minutes)
+        picks = ", ".join(c for c in _APPT_COMPLETION_COLS if _column_exists(cur, "appointments", c))
+        cur.execute(f"SELECT {picks} FROM appointments WHERE id=%s", (appt_id,))
         appt = cur.fetchone() or {}
         if not appt:
             return
@@ -884,80 +1078,90 @@ def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
                 visit_id = int(vr["id"] if isinstance(vr, dict) else vr[0])
 
         if _table_exists(cur, "invoices") and _column_exists(cur, "invoices", "appointment_id"):
-            cur.execute(
-                """
-                SELECT id, invoice_type
-                FROM invoices
-                WHERE appointment_id=%s
-                ORDER BY (invoice_type='PROVISIONAL') DESC, id DESC
-                LIMIT 1
-                """,
-                (appt_id,),
-            )
-            ir = cur.fetchone()
-            if ir:
-                inv_id = int(ir["id"] if isinstance(ir, dict) else ir[0])
+            cols = ["appointment_id", "patient_id", "invoice_type", "status", "amount"]
+            vals = [appt_id, appt.get("patient_id"), "FINAL", "Pending", 0.0]
+            if _column_exists(cur, "invoices", "issue_date"):
+                cols.append("issue_date"); vals.append(today_s)
+            if _column_exists(cur, "invoices", "created_at"):
+                cols.append("created_at"); vals.append(now_s)
+            if _column_exists(cur, "invoices", "updated_at"):
+                cols.append("updated_at"); vals.append(now_s)
+            insert_sql = f"INSERT INTO invoices ({','.join(cols)}) VALUES ({','.join(['%s']*len(vals))})"
+
+            if _has_unique_key(cur, "invoices", "appointment_id"):
+                # one statement either creates the invoice or hands back the existing id
+                cur.execute(insert_sql + " ON DUPLICATE KEY UPDATE id=LAST_INSERT_ID(id)", tuple(vals))
+                inv_id = int(cur.lastrowid or 0)
             else:
-                cols = ["appointment_id", "patient_id", "invoice_type", "status", "amount"]
-                vals = [appt_id, appt.get("patient_id"), "FINAL", "Pending", 0.0]
-                if _column_exists(cur, "invoices", "issue_date"):
-                    cols.append("issue_date"); vals.append(_today().strftime("%Y-%m-%d"))
-                if _column_exists(cur, "invoices", "created_at"):
-                    cols.append("created_at"); vals.append(_now_str())
-                if _column_exists(cur, "invoices", "updated_at"):
-                    cols.append("updated_at"); vals.append(_now_str())
                 cur.execute(
-                    f"INSERT INTO invoices ({','.join(cols)}) VALUES ({','.join(['%s']*len(vals))})",
-                    tuple(vals),
+                    """
+                    SELECT id, invoice_type
+                    FROM invoices
+                    WHERE appointment_id=%s
+                    ORDER BY (invoice_type='PROVISIONAL') DESC, id DESC
+                    LIMIT 1
+                    """,
+                    (appt_id,),
                 )
-                inv_id = int(cur.lastrowid)
+                ir = cur.fetchone()
+                if ir:
+                    inv_id = int(ir["id"] if isinstance(ir, dict) else ir[0])
+                else:
+                    cur.execute(insert_sql, tuple(vals))
+                    inv_id = int(cur.lastrowid)
 
-    items: List[Dict[str, Any]] = []
-    if visit_id:
-        items = _sum_visit_items(conn, visit_id=visit_id)
+        # cursors are buffered, so the helpers below can run their own while this one stays open
+        items: List[Dict[str, Any]] = []
+        if visit_id:
+            items = _sum_visit_items(conn, visit_id=visit_id)
 
-    appt_type = appt.get("type") or "CONSULTATION"
-    if not items:
-        est = float(_get_catalog_price(conn, appt_type) or 0.0)
-        items = [{"procedure_type": _norm(appt_type), "qty": 1.0, "unit_price": est, "amount": est}]
+        appt_type = appt.get("type") or "CONSULTATION"
+        if not items:
+            est = float(_get_catalog_price(conn, appt_type) or 0.0)
+            items = [{"procedure_type": _norm(appt_type), "qty": 1.0, "unit_price": est, "amount": est}]
 
-    total = float(sum(float(x["amount"]) for x in items))
+        total = float(sum(float(x["amount"]) for x in items))
 
-    with conn.cursor() as cur:
         if inv_id and _table_exists(cur, "invoice_items"):
             try:
                 cur.execute("DELETE FROM invoice_items WHERE invoice_id=%s", (inv_id,))
             except Exception:
                 pass
 
-            for it in items:
-                cols = ["invoice_id"]
-                vals: List[Any] = [inv_id]
+            # the column list and statement are fixed for the whole invoice; only values vary per item
+            cols = ["invoice_id"] + [
+                c
+                for c in ("item_type", "code", "description", "qty", "unit_price", "amount", "created_at", "updated_at")
+                if _column_exists(cur, "invoice_items", c)
+            ]
+            sql = f"INSERT INTO invoice_items ({','.join(cols)}) VALUES ({','.join(['%s'] * len(cols))})"
 
-                if _column_exists(cur, "invoice_items", "item_type"):
-                    cols.append("item_type"); vals.append("PROCEDURE")
-                if _column_exists(cur, "invoice_items", "code"):
-                    cols.append("code"); vals.append(_norm(it["procedure_type"]))
-                if _column_exists(cur, "invoice_items", "description"):
-                    cols.append("description"); vals.append(_norm(it["procedure_type"]))
-                if _column_exists(cur, "invoice_items", "qty"):
-                    cols.append("qty"); vals.append(float(it["qty"]))
-                if _column_exists(cur, "invoice_items", "unit_price"):
-                    cols.append("unit_price"); vals.append(float(it["unit_price"]))
-                if _column_exists(cur, "invoice_items", "amount"):
-                    cols.append("amount"); vals.append(float(it["amount"]))
-                if _column_exists(cur, "invoice_items", "created_at"):
-                    cols.append("created_at"); vals.append(_now_str())
-                if _column_exists(cur, "invoice_items", "updated_at"):
-                    cols.append("updated_at"); vals.append(_now_str())
+            rows: List[Tuple[Any, ...]] = []
+            for it in items:
+                code = _norm(it["procedure_type"])
+                row = {
+                    "invoice_id": inv_id,
+                    "item_type": "PROCEDURE",
+                    "code": code,
+                    "description": code,
+                    "qty": float(it["qty"]),
+                    "unit_price": float(it["unit_price"]),
+                    "amount": float(it["amount"]),
+                    "created_at": now_s,
+                    "updated_at": now_s,
+                }
+                rows.append(tuple(row[c] for c in cols))
 
-                try:
-                    cur.execute(
-                        f"INSERT INTO invoice_items ({','.join(cols)}) VALUES ({','.join(['%s'] * len(vals))})",
-                        tuple(vals),
-                    )
-                except Exception:
-                    pass
+            # executemany sends a plain INSERT ... VALUES as one multi-row statement; if that
+            # fails, fall back to per-row inserts so one bad item does not drop the rest
+            try:
+                cur.executemany(sql, rows)
+            except Exception:
+                for r in rows:
+                    try:
+                        cur.execute(sql, r)
+                    except Exception:
+                        pass
 
         if inv_id and _table_exists(cur, "invoices"):
             try:
@@ -985,24 +1189,21 @@ def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
             related_id=inv_id,
         )
 
-    usage_date = str(appt.get("scheduled_date") or _today().strftime("%Y-%m-%d"))
+    usage_date = str(appt.get("scheduled_date") or today_s)
     chair_minutes = _calc_chair_minutes(appt)
     doctor_id = int(appt.get("doctor_id") or 0) if appt.get("doctor_id") else None
-    for it in items:
-        _update_daily_analytics(
-            conn,
-            usage_date=usage_date,
-            doctor_id=doctor_id,
-            procedure_code=_norm(it["procedure_type"]),
-            amount=float(it["amount"]),
-            qty=float(it["qty"]),
-            chair_minutes=chair_minutes,
-        )
+    _update_daily_analytics(
+        conn,
+        usage_date=usage_date,
+        doctor_id=doctor_id,
+        procedures=[(_norm(it["procedure_type"]), float(it["amount"]), float(it["qty"])) for it in items],
+        chair_minutes=chair_minutes,
+    )
 
     if inv_id and visit_id:
         for finding in _detect_leakage(conn, appointment_id=appt_id, visit_id=visit_id, invoice_id=inv_id):
             ftype = finding["type"]
-            dedupe = f"revenue_leak:{ftype}:{appt_id}:{_today().strftime('%Y-%m-%d')}"
+            dedupe = f"revenue_leak:{ftype}:{appt_id}:{today_s}"
             _notify_admin(
                 conn,
                 notif_type=ftype,
@@ -1016,7 +1217,7 @@ def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
 
         for issue in _detect_claim_issues(conn, invoice_id=inv_id):
             itype = issue["type"]
-            dedupe = f"revenue_leak:{itype}:{inv_id}:{_today().strftime('%Y-%m-%d')}"
+            dedupe = f"revenue_leak:{itype}:{inv_id}:{today_s}"
             _notify_admin(
                 conn,
                 notif_type=itype,
@@ -1033,8 +1234,9 @@ def on_appointment_completed(conn, payload: Dict[str, Any]) -> None:
 
 def revenue_monitor_tick(conn, *, horizon_days: int = 30) -> None:
     forecast = _compute_forecast(conn, days=max(30, horizon_days))
-    payload = {"forecast": forecast, "as_of_date": str(_today())}
-    _write_revenue_insight(conn, as_of=_today(), insight_type="FORECAST", payload=payload, range_label="30d")
+    today = _today()
+    payload = {"forecast": forecast, "as_of_date": str(today)}
+    _write_revenue_insight(conn, as_of=today, insight_type="FORECAST", payload=payload, range_label="30d")
     _write_reports(conn)
     _ar_reminders_sweep(conn)
     conn.commit()
@@ -1,12 +1,49 @@
+import hashlib
 import json
+import threading
+import time
+from collections import OrderedDict
+
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Any, Dict
 from .config import OPENAI_API_KEY, OPENAI_MODEL
 
+try:
+    import orjson  # optional: faster parsing of API responses and model JSON
+    _loads = orjson.loads
+except Exception:
+    orjson = None  # type: ignore
+    _loads = json.loads
+
+# one keep-alive session per process: later calls reuse the pooled TCP/TLS connection
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# identical prompts (templated summaries/notifications) reuse an earlier answer for up to
+# AI_CACHE_TTL_SEC: LRU of (expires_at, text), keyed by a digest of the request
+AI_CACHE_TTL_SEC = 3600
+AI_CACHE_MAX = 1024
+_AI_CACHE: "OrderedDict[bytes, tuple]" = OrderedDict()
+_AI_CACHE_LOCK = threading.Lock()
+
+
+def _cache_key(system: str, user: str, model: str, max_tokens: int) -> bytes:
+    raw = "\x00".join((system, user, model, str(max_tokens))).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).digest()
+
 def ai_text(system: str, user: str, max_tokens: int = 400) -> str:
     if not OPENAI_API_KEY:
         return ""
 
+    key = _cache_key(system, user, OPENAI_MODEL, max_tokens)
+    now = time.monotonic()
+    with _AI_CACHE_LOCK:
+        hit = _AI_CACHE.get(key)
+        if hit is not None and hit[0] > now:
+            _AI_CACHE.move_to_end(key)
+            return hit[1]
+
     url = "https://api.openai.com/v1/chat/completions"
     headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
     payload = {
@@ -15,22 +52,29 @@ def ai_text(system: str, user: str, max_tokens: int = 400) -> str:
         "temperature": 0.2,
         "max_tokens": max_tokens,
     }
-    r = requests.post(url, headers=headers, json=payload, timeout=25)
+    r = _SESSION.post(url, headers=headers, json=payload, timeout=25)
     r.raise_for_status()
-    data = r.json()
-    return (data["choices"][0]["message"]["content"] or "").strip()
+    data = _loads(r.content)
+    text = (data["choices"][0]["message"]["content"] or "").strip()
+    if text:
+        with _AI_CACHE_LOCK:
+            _AI_CACHE[key] = (time.monotonic() + AI_CACHE_TTL_SEC, text)
+            _AI_CACHE.move_to_end(key)
+            while len(_AI_CACHE) > AI_CACHE_MAX:
+                _AI_CACHE.popitem(last=False)
+    return text
 
 def ai_json(system: str, user: str, schema_hint: str) -> Dict[str, Any]:
     txt = ai_text(system, user + "\n\nReturn ONLY valid JSON.\nSchema hint:\n" + schema_hint, max_tokens=700)
     if not txt:
         return {}
     try:
-        return json.loads(txt)
+        return _loads(txt)
     except Exception:
         if "{" in txt and "}" in txt:
             txt2 = txt[txt.find("{"): txt.rfind("}") + 1]
             try:
-                return json.loads(txt2)
+                return _loads(txt2)
             except Exception:
                 return {}
         return {}
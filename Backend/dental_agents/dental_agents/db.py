@@ -4,9 +4,10 @@ from __future__ import annotations
 import json
 import os
 import time
+import uuid
 from datetime import datetime, timedelta
 from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import mysql.connector
 from mysql.connector import Error as MySQLError
@@ -45,6 +46,7 @@ class DbConfig:
 
     connect_timeout: int = 10
     autocommit: bool = False
+    time_zone: str = "+05:30"  # session time_zone, set once per connection
 
 
 def get_db_config() -> DbConfig:
@@ -57,6 +59,7 @@ def get_db_config() -> DbConfig:
         database=_env("DB_NAME", "dental_clinic") or "dental_clinic",
         connect_timeout=_int_env("DB_CONNECT_TIMEOUT", 10),
         autocommit=_bool_env("DB_AUTOCOMMIT", False),
+        time_zone=_env("TIME_ZONE", "+05:30") or "+05:30",
     )
 
 
@@ -91,10 +94,66 @@ def get_conn():
         database=cfg.database,
         connection_timeout=cfg.connect_timeout,
         autocommit=cfg.autocommit,
+        init_command="SET time_zone = '%s'" % cfg.time_zone.replace("'", ""),
     )
     return _ConnWrapper(conn)
 
 
+def _run_prepared(conn, sql: str, params: Tuple[Any, ...]) -> Tuple[int, int]:
+    """
+    Execute `sql` on a per-connection prepared cursor (binary protocol) and return
+    (lastrowid, rowcount). Cursors are cached by SQL text on the connection, so the
+    server parses/plans each statement once and later calls only bind params.
+    Falls back to a regular cursor if the driver cannot prepare.
+    """
+    cache = getattr(conn, "_prepared_cursors", None)
+    if cache is None:
+        cache = {}
+        try:
+            conn._prepared_cursors = cache
+        except Exception:
+            pass
+
+    cur = cache.get(sql)
+    if cur is None:
+        try:
+            # prepared cursors cannot be combined with dictionary/buffered
+            cur = conn.cursor(prepared=True, dictionary=False, buffered=False)
+        except (TypeError, ValueError):
+            with conn.cursor() as c:
+                c.execute(sql, params)
+                return int(c.lastrowid or 0), int(c.rowcount or 0)
+        cache[sql] = cur
+
+    try:
+        cur.execute(sql, params)
+    except Exception:
+        # drop a possibly broken statement handle; next call re-prepares
+        cache.pop(sql, None)
+        try:
+            cur.close()
+        except Exception:
+            pass
+        raise
+    return int(cur.lastrowid or 0), int(cur.rowcount or 0)
+
+
+def execute_prepared(conn, sql: str, params: Tuple[Any, ...]) -> int:
+    """
+    Execute a write statement on a cached prepared cursor (see _run_prepared).
+    Returns lastrowid (0 if none).
+    """
+    return _run_prepared(conn, sql, params)[0]
+
+
+def execute_prepared_rowcount(conn, sql: str, params: Tuple[Any, ...]) -> int:
+    """
+    Like execute_prepared, for UPDATE / upsert statements whose affected-row
+    count is the result. Returns rowcount (0 if unknown).
+    """
+    return max(_run_prepared(conn, sql, params)[1], 0)
+
+
 def safe_rollback(conn) -> None:
     try:
         if getattr(conn, "in_transaction", False):
@@ -110,48 +169,74 @@ def safe_commit(conn) -> None:
         pass
 
 
+# ----------------------------
+# schema cache: one INFORMATION_SCHEMA.COLUMNS read, shared by db, notifications and the agents
+# ----------------------------
+_SCHEMA_COLUMNS: Optional[Dict[str, Dict[str, str]]] = None  # table -> {column: COLUMN_TYPE}, lower-cased
+_SCHEMA_CLEAR_HOOKS: List[Callable[[], None]] = []
+
+
+def on_schema_clear(fn: Callable[[], None]) -> Callable[[], None]:
+    """Registers fn to run on schema_cache_clear(), for caches derived from the schema."""
+    _SCHEMA_CLEAR_HOOKS.append(fn)
+    return fn
+
+
+def schema_cache_clear() -> None:
+    """
+    Drops the cached schema and every cache registered with on_schema_clear.
+    The worker calls this every SCHEMA_REFRESH_MIN so migrations run by the server are picked up.
+    """
+    global _SCHEMA_COLUMNS
+    _SCHEMA_COLUMNS = None
+    for fn in _SCHEMA_CLEAR_HOOKS:
+        fn()
+
+
+def _as_text(v: Any) -> str:
+    if isinstance(v, (bytes, bytearray)):
+        return v.decode("utf-8", errors="replace")
+    return str(v or "")
+
+
+def load_schema(cur) -> Dict[str, Dict[str, str]]:
+    """Every table of the current database with its column types, read once per schema_cache_clear()."""
+    global _SCHEMA_COLUMNS
+    cols = _SCHEMA_COLUMNS
+    if cols is None:
+        cur.execute(
+            """
+            SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE
+            FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_SCHEMA=DATABASE()
+            """
+        )
+        cols = {}
+        for row in cur.fetchall() or []:
+            if isinstance(row, dict):
+                t, c, ct = row.get("TABLE_NAME"), row.get("COLUMN_NAME"), row.get("COLUMN_TYPE")
+            else:
+                t, c, ct = row[0], row[1], row[2]
+            cols.setdefault(_as_text(t).lower(), {})[_as_text(c).lower()] = _as_text(ct)
+        _SCHEMA_COLUMNS = cols
+    return cols
+
+
+def schema_columns(cur, table: str) -> Dict[str, str]:
+    """{column: COLUMN_TYPE} for table ({} if it does not exist)."""
+    return load_schema(cur).get(table.lower(), {})
+
+
 def _table_exists(cur, name: str) -> bool:
-    cur.execute(
-        """
-        SELECT 1
-        FROM INFORMATION_SCHEMA.TABLES
-        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s
-        LIMIT 1
-        """,
-        (name,),
-    )
-    return cur.fetchone() is not None
+    return name.lower() in load_schema(cur)
 
 
 def _column_exists(cur, table: str, col: str) -> bool:
-    cur.execute(
-        """
-        SELECT 1
-        FROM INFORMATION_SCHEMA.COLUMNS
-        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME=%s
-        LIMIT 1
-        """,
-        (table, col),
-    )
-    return cur.fetchone() is not None
+    return col.lower() in schema_columns(cur, table)
 
 
 def _get_column_type(cur, table: str, col: str) -> Optional[str]:
-    cur.execute(
-        """
-        SELECT COLUMN_TYPE
-        FROM INFORMATION_SCHEMA.COLUMNS
-        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME=%s
-        LIMIT 1
-        """,
-        (table, col),
-    )
-    row = cur.fetchone()
-    if not row:
-        return None
-    if isinstance(row, dict):
-        return row.get("COLUMN_TYPE")
-    return row[0]
+    return schema_columns(cur, table).get(col.lower())
 
 
 def _parse_enum_vals(coltype: Optional[str]) -> List[str]:
@@ -209,14 +294,59 @@ def _insert_idempotency_lock(cur, key: str, ttl_hours: int = 24, locked_by: str
 
     placeholders = ", ".join(["%s"] * len(cols))
     col_sql = ", ".join([f"`{c}`" for c in cols])
-    try:
-        cur.execute(
-            f"INSERT INTO idempotency_locks ({col_sql}) VALUES ({placeholders})",
-            tuple(vals),
-        )
-        return True
-    except Exception:
-        return False
+    # duplicate keys are skipped rather than raised: rowcount 1 = claimed, 0 = already held
+    cur.execute(
+        f"INSERT IGNORE INTO idempotency_locks ({col_sql}) VALUES ({placeholders})",
+        tuple(vals),
+    )
+    return cur.rowcount == 1
+
+
+def _claim_idempotency_locks(cur, keys: List[str], ttl_hours: int = 24, locked_by: str = "worker") -> set:
+    """
+    Batch form of _insert_idempotency_lock: returns the subset of keys this call claimed.
+    With a locked_by column, rows are tagged with a per-call token and read back, so a key
+    claimed concurrently by someone else is never reported as ours. Without one, ownership
+    comes from each key's own INSERT IGNORE rowcount. Insert errors propagate.
+    """
+    keys = list(dict.fromkeys(k[:190] for k in keys if k))
+    if not keys:
+        return set()
+    if not _table_exists(cur, "idempotency_locks") or not _column_exists(cur, "idempotency_locks", "lock_key"):
+        return set(keys)
+
+    if not _column_exists(cur, "idempotency_locks", "locked_by"):
+        # no per-call tag to read back: a multi-row INSERT IGNORE cannot say which keys it took
+        return {k for k in keys if _insert_idempotency_lock(cur, k, ttl_hours=ttl_hours, locked_by=locked_by)}
+
+    token = f"{locked_by}:{uuid.uuid4().hex[:16]}"
+    in_sql = ", ".join(["%s"] * len(keys))
+
+    cols: List[str] = ["lock_key", "locked_by"]
+    per_row: List[Any] = [token]
+    if _column_exists(cur, "idempotency_locks", "expires_at"):
+        exp = datetime.now() + timedelta(hours=int(ttl_hours or 24))
+        cols.append("expires_at")
+        per_row.append(exp.strftime("%Y-%m-%d %H:%M:%S"))
+    if _column_exists(cur, "idempotency_locks", "created_at"):
+        cols.append("created_at")
+        per_row.append(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+    row_sql = "(" + ", ".join(["%s"] * len(cols)) + ")"
+    col_sql = ", ".join([f"`{c}`" for c in cols])
+    params: List[Any] = []
+    for k in keys:
+        params.append(k)
+        params.extend(per_row)
+    cur.execute(
+        f"INSERT IGNORE INTO idempotency_locks ({col_sql}) VALUES {', '.join([row_sql] * len(keys))}",
+        tuple(params),
+    )
+    cur.execute(
+        f"SELECT lock_key FROM idempotency_locks WHERE locked_by=%s AND lock_key IN ({in_sql})",
+        (token, *keys),
+    )
+    return {_as_text(r["lock_key"] if isinstance(r, dict) else r[0]) for r in cur.fetchall() or []}
 
 
 def _event_status_values(cur) -> List[str]:
@@ -502,6 +632,66 @@ def mark_failed(conn, event_id: int, err_text: str, retry_delay_sec: int = 20) -
         safe_commit(conn)
 
 
+def _insert_event(
+    cur,
+    event_type: str,
+    payload: Dict[str, Any],
+    *,
+    status: str,
+    priority: int,
+    run_at: Optional[str],
+    dedupe_key: Optional[str],
+    created_by_user_id: Optional[int],
+    correlation_id: Optional[str],
+    max_attempts: Optional[int],
+) -> int:
+    """agent_events INSERT on `cur` with no transaction control; 0 if deduped/unsupported."""
+    if not _table_exists(cur, "agent_events"):
+        return 0
+
+    if dedupe_key:
+        ok = _insert_idempotency_lock(cur, dedupe_key, ttl_hours=24, locked_by="enqueue_event")
+        if not ok:
+            return 0
+
+    cols: List[str] = []
+    vals: List[Any] = []
+
+    def add(col: str, value: Any) -> None:
+        cols.append(col)
+        vals.append(value)
+
+    add("event_type", str(event_type)[:64])
+    if _column_exists(cur, "agent_events", "payload_json"):
+        add("payload_json", json.dumps(payload or {}, ensure_ascii=False))
+
+    if _column_exists(cur, "agent_events", "status"):
+        enum_vals = _event_status_values(cur)
+        add("status", _pick_from_enum(enum_vals, status) or status)
+
+    if _column_exists(cur, "agent_events", "priority"):
+        add("priority", int(priority))
+    if max_attempts is not None and _column_exists(cur, "agent_events", "max_attempts"):
+        add("max_attempts", int(max_attempts))
+    if created_by_user_id is not None and _column_exists(cur, "agent_events", "created_by_user_id"):
+        add("created_by_user_id", int(created_by_user_id))
+    if correlation_id and _column_exists(cur, "agent_events", "correlation_id"):
+        add("correlation_id", str(correlation_id)[:64])
+
+    if _column_exists(cur, "agent_events", "available_at"):
+        add("available_at", run_at if run_at else datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    if _column_exists(cur, "agent_events", "created_at"):
+        add("created_at", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+    if not cols:
+        return 0
+
+    placeholders = ", ".join(["%s"] * len(cols))
+    col_sql = ", ".join([f"`{c}`" for c in cols])
+    cur.execute(f"INSERT INTO agent_events ({col_sql}) VALUES ({placeholders})", tuple(vals))
+    return int(cur.lastrowid or 0)
+
+
 def enqueue_event(
     conn,
     event_type: str,
@@ -516,54 +706,54 @@ def enqueue_event(
     max_attempts: Optional[int] = None,
 ) -> int:
     """
-    Insert an event into agent_events (schema-adaptive).
+    Insert an event into agent_events (schema-adaptive) in its own transaction.
     Returns inserted id or 0 if deduped/failed.
     """
     safe_rollback(conn)
     with conn.cursor() as cur:
-        if not _table_exists(cur, "agent_events"):
-            return 0
-
-        if dedupe_key:
-            ok = _insert_idempotency_lock(cur, dedupe_key, ttl_hours=24, locked_by="enqueue_event")
-            if not ok:
-                safe_commit(conn)
-                return 0
-
-        cols: List[str] = []
-        vals: List[Any] = []
-
-        def add(col: str, value: Any) -> None:
-            cols.append(col)
-            vals.append(value)
-
-        add("event_type", str(event_type)[:64])
-        if _column_exists(cur, "agent_events", "payload_json"):
-            add("payload_json", json.dumps(payload or {}, ensure_ascii=False))
-
-        if _column_exists(cur, "agent_events", "status"):
-            enum_vals = _event_status_values(cur)
-            add("status", _pick_from_enum(enum_vals, status) or status)
-
-        if _column_exists(cur, "agent_events", "priority"):
-            add("priority", int(priority))
-        if max_attempts is not None and _column_exists(cur, "agent_events", "max_attempts"):
-            add("max_attempts", int(max_attempts))
-        if created_by_user_id is not None and _column_exists(cur, "agent_events", "created_by_user_id"):
-            add("created_by_user_id", int(created_by_user_id))
-        if correlation_id and _column_exists(cur, "agent_events", "correlation_id"):
-            add("correlation_id", str(correlation_id)[:64])
-
-        if _column_exists(cur, "agent_events", "available_at"):
-            add("available_at", run_at if run_at else datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
-        if _column_exists(cur, "agent_events", "created_at"):
-            add("created_at", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        event_id = _insert_event(
+            cur,
+            event_type,
+            payload,
+            status=status,
+            priority=priority,
+            run_at=run_at,
+            dedupe_key=dedupe_key,
+            created_by_user_id=created_by_user_id,
+            correlation_id=correlation_id,
+            max_attempts=max_attempts,
+        )
+    safe_commit(conn)
+    return event_id
 
-        if not cols:
-            return 0
 
-        placeholders = ", ".join(["%s"] * len(cols))
-        col_sql = ", ".join([f"`{c}`" for c in cols])
-        cur.execute(f"INSERT INTO agent_events ({col_sql}) VALUES ({placeholders})", tuple(vals))
-        safe_commit(conn)
-        return int(cur.lastrowid or 0)
+def enqueue_event_in_tx(
+    conn,
+    event_type: str,
+    payload: Dict[str, Any],
+    *,
+    status: str = "NEW",
+    priority: int = 50,
+    run_at: Optional[str] = None,
+    dedupe_key: Optional[str] = None,
+    created_by_user_id: Optional[int] = None,
+    correlation_id: Optional[str] = None,
+    max_attempts: Optional[int] = None,
+) -> int:
+    """
+    enqueue_event inside the caller's open transaction: no rollback before and no commit
+    after, so the event (and its dedupe lock) commit or roll back with the caller's writes.
+    """
+    with conn.cursor() as cur:
+        return _insert_event(
+            cur,
+            event_type,
+            payload,
+            status=status,
+            priority=priority,
+            run_at=run_at,
+            dedupe_key=dedupe_key,
+            created_by_user_id=created_by_user_id,
+            correlation_id=correlation_id,
+            max_attempts=max_attempts,
+        )
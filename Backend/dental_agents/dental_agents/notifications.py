@@ -1,12 +1,12 @@
 from __future__ import annotations
 
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, Optional
 import json
 import logging
 from datetime import datetime, timedelta, date
 from decimal import Decimal
 
-from .db import get_conn
+from .db import _claim_idempotency_locks, _column_exists, _get_column_type, _parse_enum_vals, _table_exists, get_conn
 
 log = logging.getLogger(__name__)
 
@@ -40,54 +40,9 @@ def _json_dumps_safe(payload: Dict[str, Any]) -> str:
     return json.dumps(safe_payload, ensure_ascii=False, default=str)
 
 
-def _table_exists(cur, name: str) -> bool:
-    cur.execute(
-        """
-        SELECT 1 FROM INFORMATION_SCHEMA.TABLES
-        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s
-        LIMIT 1
-        """,
-        (name,),
-    )
-    return cur.fetchone() is not None
-
-
-def _column_exists(cur, table: str, col: str) -> bool:
-    cur.execute(
-        """
-        SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS
-        WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME=%s
-        LIMIT 1
-        """,
-        (table, col),
-    )
-    return cur.fetchone() is not None
-
-
 def _get_enum_values(cur, table: str, col: str) -> list[str]:
     try:
-        cur.execute(
-            """
-            SELECT COLUMN_TYPE
-            FROM INFORMATION_SCHEMA.COLUMNS
-            WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=%s AND COLUMN_NAME=%s
-            LIMIT 1
-            """,
-            (table, col),
-        )
-        row = cur.fetchone()
-        if not row:
-            return []
-        coltype = row["COLUMN_TYPE"] if isinstance(row, dict) else row[0]
-        if not coltype or "enum(" not in str(coltype).lower():
-            return []
-        inside = str(coltype)[str(coltype).find("(") + 1 : str(coltype).rfind(")")]
-        vals = []
-        for part in inside.split(","):
-            p = part.strip().strip("'").strip('"')
-            if p:
-                vals.append(p)
-        return vals
+        return _parse_enum_vals(_get_column_type(cur, table, col))
     except Exception:
         return []
 
@@ -132,14 +87,124 @@ def _insert_idempotency_lock(cur, key: str, ttl_hours: int = 24) -> bool:
 
     placeholders = ", ".join(["%s"] * len(cols))
     col_sql = ", ".join([f"`{c}`" for c in cols])
-    try:
-        cur.execute(
-            f"INSERT INTO idempotency_locks ({col_sql}) VALUES ({placeholders})",
-            tuple(vals),
-        )
-        return True
-    except Exception:
-        return False
+    # duplicate keys are skipped rather than raised: rowcount 1 = claimed, 0 = already held
+    cur.execute(
+        f"INSERT IGNORE INTO idempotency_locks ({col_sql}) VALUES ({placeholders})",
+        tuple(vals),
+    )
+    return cur.rowcount == 1
+
+
+def _normalize_channel_status(channel: Optional[str], status: Optional[str]) -> tuple[str, str]:
+    ch = (channel or "IN_APP").strip().upper()
+    if ch not in _ALLOWED_CHANNEL:
+        ch = "IN_APP"
+
+    st = (status or "PENDING").strip().upper()
+    if st not in _ALLOWED_STATUS:
+        st = "PENDING"
+    # For in-app notifications, mark as SENT immediately (no external delivery step)
+    if ch == "IN_APP" and st in ("PENDING", "NEW"):
+        st = "SENT"
+    return ch, st
+
+
+def _notification_fields(
+    has_col: Callable[[str], bool],
+    status_enum: Callable[[], list[str]],
+    *,
+    user_id: Optional[int],
+    user_role: Optional[str],
+    title: str,
+    message: str,
+    notif_type: str,
+    related_table: Optional[str],
+    related_id: Optional[int],
+    ch: str,
+    st: str,
+    meta: Optional[Dict[str, Any]],
+    scheduled_at: Optional[datetime],
+    priority: Optional[int],
+    now_str: str,
+    meta_encoded: Optional[str] = None,
+) -> tuple[list[str], list[Any]]:
+    """
+    (cols, vals) for one notifications row; has_col(col) answers for the notifications table.
+    meta_encoded, when given, is stored verbatim in place of the encoded meta payload.
+    """
+    cols: list[str] = []
+    vals: list[Any] = []
+
+    def add(col: str, value: Any) -> None:
+        cols.append(col)
+        vals.append(value)
+
+    # Targets
+    if user_id and int(user_id) > 0 and has_col("user_id"):
+        add("user_id", int(user_id))
+
+    if user_role and has_col("user_role"):
+        add("user_role", str(user_role)[:30])
+
+    # Core fields
+    if has_col("channel"):
+        add("channel", ch)
+
+    if has_col("status"):
+        add("status", _pick_status_value(status_enum(), st))
+
+    if has_col("title"):
+        add("title", (title or "")[:200])
+
+    if has_col("message"):
+        add("message", (message or "")[:5000])
+
+    if has_col("type"):
+        add("type", (notif_type or "INFO")[:64])
+
+    if priority is not None and has_col("priority"):
+        add("priority", int(priority))
+
+    # Related entity (support both schema styles)
+    if related_table:
+        if has_col("related_entity_type"):
+            add("related_entity_type", str(related_table)[:40])
+        elif has_col("related_table"):
+            add("related_table", str(related_table)[:80])
+
+    if related_id:
+        if has_col("related_entity_id"):
+            add("related_entity_id", int(related_id))
+        elif has_col("related_id"):
+            add("related_id", int(related_id))
+
+    # meta_json
+    meta_payload = dict(meta or {})
+    meta_payload.setdefault("notif_type", notif_type)
+    if related_table:
+        meta_payload.setdefault("related_table", related_table)
+    if related_id:
+        meta_payload.setdefault("related_id", related_id)
+
+    # scheduled_at handling
+    if scheduled_at:
+        if has_col("scheduled_at"):
+            add("scheduled_at", scheduled_at.strftime("%Y-%m-%d %H:%M:%S"))
+        else:
+            meta_payload["scheduled_at"] = scheduled_at.isoformat()
+
+    # _json_dumps_safe already runs _json_safe; serialize once, only if a meta column exists
+    meta_col = "meta_json" if has_col("meta_json") else ("meta" if has_col("meta") else None)
+    if meta_col:
+        add(meta_col, meta_encoded if meta_encoded is not None else _json_dumps_safe(meta_payload))
+
+    # timestamps
+    if has_col("created_at"):
+        add("created_at", now_str)
+    if has_col("updated_at"):
+        add("updated_at", now_str)
+
+    return cols, vals
 
 
 def create_notification(
@@ -158,9 +223,11 @@ def create_notification(
     dedupe_key: Optional[str] = None,
     priority: Optional[int] = None,
     conn=None,
+    meta_encoded: Optional[str] = None,
 ) -> None:
     """
     Insert a notification row (schema-adaptive).
+    meta_encoded: meta already encoded as JSON (shared with another row); stored as-is.
 
     ✅ Supports:
     - direct user notification (user_id)
@@ -174,16 +241,7 @@ def create_notification(
         return
 
     # Normalize channel/status
-    ch = (channel or "IN_APP").strip().upper()
-    if ch not in _ALLOWED_CHANNEL:
-        ch = "IN_APP"
-
-    st = (status or "PENDING").strip().upper()
-    if st not in _ALLOWED_STATUS:
-        st = "PENDING"
-    # For in-app notifications, mark as SENT immediately (no external delivery step)
-    if ch == "IN_APP" and st in ("PENDING", "NEW"):
-        st = "SENT"
+    ch, st = _normalize_channel_status(channel, status)
 
     owns_conn = conn is None
     if owns_conn:
@@ -200,80 +258,24 @@ def create_notification(
                 if not ok:
                     return
 
-            cols: list[str] = []
-            vals: list[Any] = []
-
-            def add(col: str, value: Any) -> None:
-                cols.append(col)
-                vals.append(value)
-
-            # Targets
-            if user_id and int(user_id) > 0 and _column_exists(cur, "notifications", "user_id"):
-                add("user_id", int(user_id))
-
-            if user_role and _column_exists(cur, "notifications", "user_role"):
-                add("user_role", str(user_role)[:30])
-
-            # Core fields
-            if _column_exists(cur, "notifications", "channel"):
-                add("channel", ch)
-
-            if _column_exists(cur, "notifications", "status"):
-                enum_vals = _get_enum_values(cur, "notifications", "status")
-                add("status", _pick_status_value(enum_vals, st))
-
-            if _column_exists(cur, "notifications", "title"):
-                add("title", (title or "")[:200])
-
-            if _column_exists(cur, "notifications", "message"):
-                add("message", (message or "")[:5000])
-
-            if _column_exists(cur, "notifications", "type"):
-                add("type", (notif_type or "INFO")[:64])
-
-            if priority is not None and _column_exists(cur, "notifications", "priority"):
-                add("priority", int(priority))
-
-            # Related entity (support both schema styles)
-            if related_table:
-                if _column_exists(cur, "notifications", "related_entity_type"):
-                    add("related_entity_type", str(related_table)[:40])
-                elif _column_exists(cur, "notifications", "related_table"):
-                    add("related_table", str(related_table)[:80])
-
-            if related_id:
-                if _column_exists(cur, "notifications", "related_entity_id"):
-                    add("related_entity_id", int(related_id))
-                elif _column_exists(cur, "notifications", "related_id"):
-                    add("related_id", int(related_id))
-
-            # meta_json
-            meta_payload = dict(meta or {})
-            meta_payload.setdefault("notif_type", notif_type)
-            if related_table:
-                meta_payload.setdefault("related_table", related_table)
-            if related_id:
-                meta_payload.setdefault("related_id", related_id)
-
-            # scheduled_at handling
-            if scheduled_at:
-                if _column_exists(cur, "notifications", "scheduled_at"):
-                    add("scheduled_at", scheduled_at.strftime("%Y-%m-%d %H:%M:%S"))
-                else:
-                    meta_payload["scheduled_at"] = scheduled_at.isoformat()
-
-            safe_meta = _json_safe(meta_payload)
-            if _column_exists(cur, "notifications", "meta_json"):
-                add("meta_json", _json_dumps_safe(safe_meta))
-            elif _column_exists(cur, "notifications", "meta"):
-                add("meta", _json_dumps_safe(safe_meta))
-
-            # timestamps
-            now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            if _column_exists(cur, "notifications", "created_at"):
-                add("created_at", now_str)
-            if _column_exists(cur, "notifications", "updated_at"):
-                add("updated_at", now_str)
+            cols, vals = _notification_fields(
+                lambda col: _column_exists(cur, "notifications", col),
+                lambda: _get_enum_values(cur, "notifications", "status"),
+                user_id=user_id,
+                user_role=user_role,
+                title=title,
+                message=message,
+                notif_type=notif_type,
+                related_table=related_table,
+                related_id=related_id,
+                ch=ch,
+                st=st,
+                meta=meta,
+                scheduled_at=scheduled_at,
+                priority=priority,
+                now_str=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                meta_encoded=meta_encoded,
+            )
 
             if not cols:
                 return
@@ -298,3 +300,82 @@ def create_notification(
                 conn.close()
             except Exception:
                 pass
+
+
+def create_notifications(rows: list[Dict[str, Any]], *, conn=None) -> int:
+    """
+    Batch form of create_notification: each row holds its keyword arguments (minus conn).
+    Dedupe keys are claimed together and rows sharing a column set go out as one
+    multi-VALUES INSERT. Returns the number of rows inserted.
+    """
+    prepared: list[tuple[Dict[str, Any], str, str]] = []
+    for r in rows or []:
+        user_id = r.get("user_id")
+        if (not user_id or int(user_id) <= 0) and not r.get("user_role"):
+            continue
+        ch, st = _normalize_channel_status(r.get("channel"), r.get("status"))
+        prepared.append((r, ch, st))
+    if not prepared:
+        return 0
+
+    owns_conn = conn is None
+    if owns_conn:
+        conn = get_conn()
+
+    inserted = 0
+    try:
+        with conn.cursor() as cur:
+            if not _table_exists(cur, "notifications"):
+                return 0
+
+            keys = [r["dedupe_key"] for r, _, _ in prepared if r.get("dedupe_key")]
+            if keys:
+                claimed = _claim_idempotency_locks(cur, keys, ttl_hours=24, locked_by="notifications")
+                prepared = [p for p in prepared if not p[0].get("dedupe_key") or p[0]["dedupe_key"][:190] in claimed]
+
+            now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            groups: Dict[tuple[str, ...], list[list[Any]]] = {}
+            for r, ch, st in prepared:
+                cols, vals = _notification_fields(
+                    lambda col: _column_exists(cur, "notifications", col),
+                    lambda: _get_enum_values(cur, "notifications", "status"),
+                    user_id=r.get("user_id"),
+                    user_role=r.get("user_role"),
+                    title=r.get("title") or "",
+                    message=r.get("message") or "",
+                    notif_type=r.get("notif_type") or "INFO",
+                    related_table=r.get("related_table"),
+                    related_id=r.get("related_id"),
+                    ch=ch,
+                    st=st,
+                    meta=r.get("meta"),
+                    scheduled_at=r.get("scheduled_at"),
+                    priority=r.get("priority"),
+                    now_str=now_str,
+                    meta_encoded=r.get("meta_encoded"),
+                )
+                if cols:
+                    groups.setdefault(tuple(cols), []).append(vals)
+
+            for cols, vals_list in groups.items():
+                row_sql = "(" + ", ".join(["%s"] * len(cols)) + ")"
+                col_sql = ", ".join([f"`{c}`" for c in cols])
+                try:
+                    cur.execute(
+                        f"INSERT INTO notifications ({col_sql}) VALUES {', '.join([row_sql] * len(vals_list))}",
+                        tuple(v for vals in vals_list for v in vals),
+                    )
+                except Exception as e:
+                    log.exception("create_notifications INSERT failed: %s", e)
+                    raise
+                inserted += len(vals_list)
+
+        if owns_conn:
+            conn.commit()
+    finally:
+        if owns_conn:
+            try:
+                conn.close()
+            except Exception:
+                pass
+    return inserted
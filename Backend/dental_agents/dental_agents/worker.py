@@ -17,6 +17,7 @@ from .db import (
     mark_failed,
     safe_rollback,
     enqueue_event,
+    schema_cache_clear,
 )
 
 # Agents
@@ -87,6 +88,8 @@ def main() -> None:
     monitor_interval_min = _int_env_any(["INVENTORY_MONITOR_INTERVAL_MIN"], 60)
     revenue_monitor_interval_min = _int_env_any(["REVENUE_MONITOR_INTERVAL_MIN"], 60)
     case_monitor_interval_min = _int_env_any(["CASE_MONITOR_INTERVAL_MIN"], 1440)  # default daily
+    # migrations are applied by the Node server, so the schema cache is re-read on an interval
+    schema_refresh_min = _int_env_any(["SCHEMA_REFRESH_MIN"], 5)
 
     try:
         conn = get_conn()
@@ -110,6 +113,7 @@ def main() -> None:
         last_monitor = 0.0
         last_revenue_monitor = 0.0
         last_case_monitor = 0.0
+        last_schema_refresh = time.time()
 
         while True:
             # heartbeat
@@ -166,6 +170,10 @@ def main() -> None:
                 except Exception as e:
                     _log(worker_id, f"case monitor enqueue error={e}")
 
+            if now_t - last_schema_refresh >= max(60, schema_refresh_min * 60):
+                schema_cache_clear()
+                last_schema_refresh = now_t
+
             # Ensure no stuck tx from prior loop
             safe_rollback(conn)
 
@@ -33,3 +33,24 @@ CREATE TABLE IF NOT EXISTS inventory_anomaly_logs (
   KEY idx_anom_item (item_code),
   KEY idx_anom_created (created_at)
 ) ENGINE=InnoDB;
+
+-- Covering index for the daily manual-edit spike query
+-- (WHERE source IN (...) AND created_at >= ... GROUP BY item_code)
+SET @has_iul_src_time_code := (
+  SELECT COUNT(1) FROM information_schema.STATISTICS
+  WHERE TABLE_SCHEMA=DATABASE()
+    AND TABLE_NAME='inventory_usage_logs'
+    AND INDEX_NAME='idx_iul_src_time_code'
+);
+
+SET @has_iul := (
+  SELECT COUNT(1) FROM information_schema.TABLES
+  WHERE TABLE_SCHEMA=DATABASE()
+    AND TABLE_NAME='inventory_usage_logs'
+);
+
+SET @sql_iul_idx := IF(@has_iul>0 AND @has_iul_src_time_code=0,
+  'ALTER TABLE inventory_usage_logs ADD KEY idx_iul_src_time_code (source, created_at, item_code)',
+  'SELECT 1'
+);
+PREPARE i1 FROM @sql_iul_idx; EXECUTE i1; DEALLOCATE PREPARE i1;
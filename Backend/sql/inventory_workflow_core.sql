@@ -26,7 +26,8 @@ CREATE TABLE IF NOT EXISTS inventory_usage_logs (
   KEY idx_usage_appt (appointment_id),
   KEY idx_usage_visit (visit_id),
   KEY idx_usage_doctor (doctor_id),
-  KEY idx_usage_item (item_code)
+  KEY idx_usage_item (item_code),
+  KEY idx_iul_src_time_code (source, created_at, item_code)
 ) ENGINE=InnoDB;
 
 CREATE TABLE IF NOT EXISTS inventory_alerts (
@@ -81,4 +81,49 @@ SET @sql_add := IF(@has_uq_as_of_type=0,
 );
 PREPARE r2 FROM @sql_add; EXECUTE r2; DEALLOCATE PREPARE r2;
 
+-- One invoice per appointment: lets the completion handler upsert by appointment_id.
+-- Skipped while existing data still has several invoices for one appointment.
+SET @has_uq_invoice_appt := (
+  SELECT COUNT(1) FROM information_schema.STATISTICS
+  WHERE TABLE_SCHEMA=DATABASE()
+    AND TABLE_NAME='invoices'
+    AND INDEX_NAME='uq_invoice_appt'
+);
+
+SET @dup_invoice_appts := (
+  SELECT COUNT(1) FROM (
+    SELECT appointment_id FROM invoices
+    WHERE appointment_id IS NOT NULL
+    GROUP BY appointment_id
+    HAVING COUNT(*) > 1
+  ) d
+);
+
+SET @sql_uq_inv := IF(@has_uq_invoice_appt=0 AND @dup_invoice_appts=0,
+  'ALTER TABLE invoices ADD UNIQUE KEY uq_invoice_appt (appointment_id)',
+  'SELECT 1'
+);
+PREPARE r3 FROM @sql_uq_inv; EXECUTE r3; DEALLOCATE PREPARE r3;
+
+-- The unique key covers appointment_id (and fk_invoice_appt), so the plain index is redundant.
+SET @has_uq_invoice_appt := (
+  SELECT COUNT(1) FROM information_schema.STATISTICS
+  WHERE TABLE_SCHEMA=DATABASE()
+    AND TABLE_NAME='invoices'
+    AND INDEX_NAME='uq_invoice_appt'
+);
+
+SET @has_idx_invoice_appt := (
+  SELECT COUNT(1) FROM information_schema.STATISTICS
+  WHERE TABLE_SCHEMA=DATABASE()
+    AND TABLE_NAME='invoices'
+    AND INDEX_NAME='idx_invoice_appt'
+);
+
+SET @sql_drop_idx_inv := IF(@has_uq_invoice_appt>0 AND @has_idx_invoice_appt>0,
+  'ALTER TABLE invoices DROP INDEX idx_invoice_appt',
+  'SELECT 1'
+);
+PREPARE r4 FROM @sql_drop_idx_inv; EXECUTE r4; DEALLOCATE PREPARE r4;
+
 DROP PROCEDURE IF EXISTS add_col_if_missing;